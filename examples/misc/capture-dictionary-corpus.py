@@ -0,0 +1,91 @@
+"""Captures a training corpus for DICT compression dictionaries from a real client session.
+
+Runs a directory test server and test client, drives the common round trips through the client library (the same
+calls packcli makes), and saves the packed body of every request and response the client logged. Train a dictionary
+from the saved corpus with compression.train_dictionary().
+
+    python capture-dictionary-corpus.py [corpus file]
+
+The corpus DICTIONARY_V1 was trained from is dictionary-corpus-v1.msgpack, next to this script."""
+
+import msgpack
+
+from packetserver.common import Request
+from packetserver.common.dictionaries import corpus_from_log
+from packetserver.server.testserver import DirectoryTestServer
+from packetserver.client.testing import TestClient
+from packetserver.client import users, messages, objects, bulletins, jobs
+import os
+import os.path
+import sys
+import tempfile
+import time
+
+server_callsign = "KQ4PEC"
+client_callsigns = ['KQ4PEC-7', 'KQ4PED']
+corpus_file = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__),
+                                                                  "dictionary-corpus-v1.msgpack")
+
+conn_dir = tempfile.mkdtemp()
+data_dir = tempfile.mkdtemp()
+ts = DirectoryTestServer(server_callsign, connection_directory=conn_dir, data_dir=data_dir, zeo=False)
+ts.start()
+
+
+def greet(tc: TestClient):
+    # the first request from a callsign registers its user, so do this for every client before any messages go out
+    tc.start()
+    tc.connection_for(server_callsign)
+    time.sleep(1)
+    root = Request.blank()
+    root.path = ""
+    root.method = Request.Method.GET
+    tc.send_receive_callsign(root, server_callsign)
+
+
+def session(tc: TestClient, other: str):
+    me = tc.callsign.split("-")[0]
+    users.get_user_by_username(tc, server_callsign, me)
+    users.update_self(tc, server_callsign, bio="Operating portable this week.", status="QRV on 2m",
+                      location="EM73")
+    users.get_users(tc, server_callsign, limit=10)
+
+    bid = bulletins.post_bulletin(tc, server_callsign, "Net tonight",
+                                  "Check in at 8pm local on the club repeater.")
+    bulletins.get_bulletins_recent(tc, server_callsign, limit=10)
+    bulletins.get_bulletin_by_id(tc, server_callsign, bid)
+
+    messages.send_message(tc, server_callsign, "Testing the new mailbox. 73", [other])
+    messages.send_message(tc, server_callsign, "Log file from last night attached.", [other, me],
+                          attachments=[messages.MsgAttachment("netlog.txt", "20:00 KQ4PED\n20:02 KQ4PEC\n")])
+    messages.get_messages(tc, server_callsign, limit=10)
+    messages.get_messages(tc, server_callsign, get_text=True, limit=5)
+
+    uid = objects.post_object(tc, server_callsign, "hello-world.txt", "Hello world.", private=True)
+    objects.post_object(tc, server_callsign, "beacon.bin", os.urandom(64), private=False)
+    objects.get_user_objects(tc, server_callsign, limit=10, include_data=False)
+    objects.get_object_by_uuid(tc, server_callsign, uid, include_data=True)
+    objects.update_object_by_uuid(tc, server_callsign, uid, name="hello.txt")
+
+    try:
+        jobs.get_user_jobs(tc, server_callsign)
+    except RuntimeError:
+        # jobs aren't enabled on the test server; the refusal is still a round trip worth capturing
+        pass
+
+
+clients = [TestClient(conn_dir, callsign) for callsign in client_callsigns]
+for tc in clients:
+    greet(tc)
+log = []
+for tc in clients:
+    other = [c for c in client_callsigns if c != tc.callsign][0].split("-")[0]
+    session(tc, other)
+    log.extend(tc.request_log)
+    tc.stop()
+ts.stop()
+
+corpus = corpus_from_log(log)
+with open(corpus_file, 'wb') as f:
+    f.write(msgpack.packb(corpus))
+print(f"Saved {len(corpus)} packed bodies, {sum(len(s) for s in corpus)} bytes, to {corpus_file}")
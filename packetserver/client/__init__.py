@@ -3,25 +3,151 @@ import pe.app
 from ZEO.asyncio.server import new_connection
 from packetserver.common.testing import SimpleDirectoryConnection
 from packetserver.common import Response, Message, Request, PacketServerConnection, send_response, send_blank_response
+from packetserver.common.compression import dictionary_versions
+from packetserver.common.constants import cursor_var, next_cursor_var
+from packetserver.common.util import expand_rows
+from packetserver.common.chunked import (ChunkReceiver, ChunkError, is_chunk_frame, default_chunk_size, file_digest,
+                                         read_blocks)
 import ax25
 import logging
 import signal
 import time
-from threading import Lock
+from threading import Lock, RLock
 from msgpack import Unpacker
 from msgpack.exceptions import OutOfData
-from typing import Callable, Self, Union, Optional
+from typing import Callable, Self, Union, Optional, Iterator
 from traceback import  format_exc
 from os import linesep
 from shutil import rmtree
+import shutil
 from threading import Thread
+import hashlib
+import os
 
 class ConnectionClosedError(Exception):
     """Raised when a connection closes unexpectedly."""
     pass
 
+def resume_download(fetch: Callable[[int, int], Optional[Response]], file_path: str, piece_size: int = 16384) -> str:
+    """Downloads into file_path + '.part' one byte range at a time, picking up from whatever an earlier attempt
+    left there, and renames it to file_path once the whole file matches the server's sha256.
+
+    fetch(offset, length) sends one ranged GET and returns its response. If the connection drops, the partial file
+    stays on disk and calling this again continues where it stopped."""
+    part_path = file_path + ".part"
+    digest_path = part_path + ".sha256"
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    expected = open(digest_path).read().strip() if os.path.isfile(digest_path) else None
+    while True:
+        response = fetch(offset, piece_size)
+        if response is None:
+            raise RuntimeError(f"Download timed out at byte {offset}; partial download kept at {part_path}")
+        if (response.status_code == 416) and (offset > 0):
+            logging.warning(f"{part_path} is longer than the file on the server; starting over")
+            open(part_path, 'wb').close()
+            offset = 0
+            continue
+        if response.status_code not in (200, 206):
+            raise RuntimeError(f"Ranged download failed: {response.status_code}: {response.payload}")
+        piece = response.payload
+        if (type(piece) is not dict) or ('sha256' not in piece):
+            raise RuntimeError("Server did not answer with a byte range; it may not support resuming downloads.")
+        digest = piece['sha256'].hex()
+        if expected is None:
+            expected = digest
+            open(digest_path, 'w').write(digest)
+        elif digest != expected:
+            logging.warning(f"File changed on the server since {part_path} was started; starting over")
+            open(part_path, 'wb').close()
+            open(digest_path, 'w').write(digest)
+            expected = digest
+            offset = 0
+            continue
+        with open(part_path, 'ab') as f:
+            f.write(piece['data'])
+        offset = offset + len(piece['data'])
+        logging.debug(f"Downloaded {offset}/{piece['total_size']} bytes into {part_path}")
+        if offset >= piece['total_size']:
+            break
+        if len(piece['data']) == 0:
+            raise RuntimeError(f"Server sent an empty range at byte {offset} of {piece['total_size']}")
+
+    h = hashlib.sha256()
+    with open(part_path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            h.update(block)
+    if h.hexdigest() != expected:
+        os.remove(part_path)
+        os.remove(digest_path)
+        raise RuntimeError(f"Downloaded file failed its sha256 check; removed {part_path}")
+    os.replace(part_path, file_path)
+    os.remove(digest_path)
+    return file_path
+
+def save_response_body(response: Response, file_path: str, field: str = 'data') -> str:
+    """Writes a response's data to file_path. A body streamed as a chunked transfer is copied from its spool a
+    block at a time instead of being read into memory; otherwise it's the payload, or the payload's field."""
+    if response.body_file is not None:
+        with response.body_file as src, open(file_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        response.body_file = None
+        return file_path
+    data = response.payload
+    if type(data) is dict:
+        data = data[field]
+    if type(data) is str:
+        data = data.encode()
+    with open(file_path, 'wb') as f:
+        f.write(data)
+    return file_path
+
+def expand_compact(resp: Response) -> Response:
+    """Turns a payload the server sent as compact rows back into a list of dicts."""
+    if resp.vars.get('compact') and (type(resp.payload) is dict) and ('k' in resp.payload) and ('r' in resp.payload):
+        resp.payload = expand_rows(resp.payload)
+        del resp.data['v']['compact']
+    return resp
+
+class Pipeline:
+    """Requests in flight on one connection, waiting for responses matched up by request id."""
+    def __init__(self):
+        self.lock = RLock()
+        self.next_id = 1
+        self.pending = []
+        self.responses = {}
+        self.chunks = ChunkReceiver()
+
+    @property
+    def idle(self) -> bool:
+        return (len(self.pending) == 0) and (len(self.responses) == 0)
+
+    def add(self) -> int:
+        rid = self.next_id
+        self.next_id = self.next_id + 1
+        self.pending.append(rid)
+        return rid
+
+    def deliver(self, resp: Response):
+        rid = resp.request_id
+        if rid not in self.pending:
+            # servers that don't echo request ids answer in order
+            if len(self.pending) == 0:
+                logging.warning(f"Discarding response {resp} that matches no pending request")
+                return
+            rid = self.pending[0]
+        self.pending.remove(rid)
+        self.responses[rid] = expand_compact(resp)
+
+    def forget(self, rid: int):
+        with self.lock:
+            if rid in self.pending:
+                self.pending.remove(rid)
+            self.responses.pop(rid, None)
+
 class Client:
-    def __init__(self, pe_server: str, port: int, client_callsign: str, keep_log=False):
+    def __init__(self, pe_server: str, port: int, client_callsign: str, keep_log=False,
+                 response_compression: Optional[Union[str, int]] = None, chunked: bool = False,
+                 chunk_size: int = default_chunk_size):
         if not ax25.Address.valid_call(client_callsign):
             raise ValueError(f"Provided callsign '{client_callsign}' is invalid.")
         self.pe_server = pe_server
@@ -31,8 +157,14 @@ class Client:
         self.started = False
         self._connection_locks = {}
         self.lock_locker = Lock()
+        self._pipelines = {}
         self.keep_log = keep_log
         self.request_log = []
+        # compression asked of the server for responses (e.g. 'AUTO', 'DICT'); None leaves it to the server
+        self.response_compression = response_compression
+        # chunked transfers in both directions; only for servers new enough to understand them
+        self.chunked = chunked
+        self.chunk_size = chunk_size
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
 
@@ -117,45 +249,177 @@ class Client:
         time.sleep(8)
         return conn
 
+    def pipeline_for(self, conn: Union[PacketServerConnection, SimpleDirectoryConnection]) -> "Pipeline":
+        dest = conn.remote_callsign.upper()
+        with self.lock_locker:
+            if dest not in self._pipelines:
+                self._pipelines[dest] = Pipeline()
+            return self._pipelines[dest]
+
     def receive(self, req: Request, conn: Union[PacketServerConnection,SimpleDirectoryConnection], timeout: int = 300):
+        """Waits for the response to req. Responses to other pipelined requests that arrive first are held for
+        whoever is waiting on them."""
         cutoff_date = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
         logging.debug(f"{datetime.datetime.now()}: Request timeout date is {cutoff_date}")
+        pipeline = self.pipeline_for(conn)
+        rid = req.request_id
         while datetime.datetime.now() < cutoff_date:
             if conn.state.name != "CONNECTED":
                 logging.error(f"Connection {conn} disconnected.")
+                pipeline.forget(rid)
                 if self.keep_log:
                     self.request_log.append((req, None))
                 raise ConnectionClosedError(f"Connection to {conn.remote_callsign} closed unexpectedly.")
-            try:
-                unpacked = conn.data.unpack()
-            except:
-                time.sleep(.1)
-                continue
-            msg = Message.partial_unpack(unpacked)
-            resp = Response(msg)
-            return resp
+            with pipeline.lock:
+                if rid in pipeline.responses:
+                    return pipeline.responses.pop(rid)
+                try:
+                    unpacked = conn.data.unpack()
+                except:
+                    unpacked = None
+                if unpacked is not None and is_chunk_frame(unpacked):
+                    try:
+                        assembler = pipeline.chunks.accept(unpacked)
+                    except ChunkError:
+                        pipeline.chunks.clear()
+                        pipeline.forget(rid)
+                        raise
+                    # a transfer that keeps making progress shouldn't time out partway through
+                    cutoff_date = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
+                    unpacked = None
+                    if assembler is not None:
+                        # a streamed payload stays in the assembler's spool, as the response's body_file
+                        pipeline.deliver(Response(Message.from_assembler(assembler)))
+                        assembler.close()
+                        if rid in pipeline.responses:
+                            return pipeline.responses.pop(rid)
+                        continue
+                if unpacked is not None:
+                    pipeline.deliver(Response(Message.partial_unpack(unpacked)))
+                    if rid in pipeline.responses:
+                        return pipeline.responses.pop(rid)
+                    continue
+            time.sleep(.1)
         logging.warning(f"{datetime.datetime.now()}: Request {req} timed out.")
+        pipeline.forget(rid)
         return None
 
-    def send_and_receive(self, req: Request, conn: Union[PacketServerConnection,SimpleDirectoryConnection],
-                         timeout: int = 300) -> Optional[Response]:
+    def send_request(self, req: Request, conn: Union[PacketServerConnection,SimpleDirectoryConnection]) -> Request:
+        """Sends req tagged with a new request id without waiting for the response. Pass the returned request to
+        receive() to collect it; any number of requests can be in flight on one connection. A request with a
+        body_file (an open binary file, with body_field naming where it goes in the payload) has it streamed as a
+        chunked transfer when the client is chunked, and read into the payload otherwise; the file is closed."""
         if conn.state.name != "CONNECTED":
             raise ConnectionClosedError(f"Connection to {conn.remote_callsign} closed unexpectedly.")
         logging.debug(f"Sending request {req}")
+        if (self.response_compression is not None) and ('c' not in req.vars):
+            req.set_var('c', self.response_compression)
+            req.set_var('cd', dictionary_versions())
+        if self.chunked and ('chunked' not in req.vars):
+            req.set_var('chunked', self.chunk_size)
         dest = conn.remote_callsign.upper()
         with self.lock_locker:
             if dest not in self._connection_locks:
                 self._connection_locks[dest] = Lock()
+        pipeline = self.pipeline_for(conn)
         with self._connection_locks[dest]:
-            conn.data = Unpacker()
-            conn.send_data(req.pack())
+            with pipeline.lock:
+                if pipeline.idle:
+                    # nothing in flight, so anything left in the buffer is stale
+                    conn.data = Unpacker()
+                    pipeline.chunks.clear()
+                req.request_id = pipeline.add()
+            if (req.body_file is not None) and self.chunked:
+                # streamed from the file a chunk at a time, never read into memory
+                size, sha256 = file_digest(req.body_file)
+                try:
+                    for frame in req.stream_frames(read_blocks(req.body_file), size, sha256,
+                                                   chunk_size=self.chunk_size, field=req.body_field):
+                        conn.send_data(frame)
+                finally:
+                    req.close_body_file()
+                return req
+            req.read_body_file()
+            if self.chunked:
+                for frame in req.frames(chunk_size=self.chunk_size):
+                    conn.send_data(frame)
+            else:
+                conn.send_data(req.pack())
+        return req
+
+    def send_and_receive(self, req: Request, conn: Union[PacketServerConnection,SimpleDirectoryConnection],
+                         timeout: int = 300) -> Optional[Response]:
+        self.send_request(req, conn)
+        resp = self.receive(req, conn, timeout=timeout)
+        self.request_log.append((req, resp))
+        return resp
+
+    def send_and_receive_many(self, reqs: list[Request],
+                              conn: Union[PacketServerConnection,SimpleDirectoryConnection],
+                              timeout: int = 300) -> list[Optional[Response]]:
+        """Pipelines reqs over one connection, sending them all before waiting, and returns their responses in
+        the same order as reqs."""
+        for req in reqs:
+            self.send_request(req, conn)
+        responses = []
+        for req in reqs:
             resp = self.receive(req, conn, timeout=timeout)
             self.request_log.append((req, resp))
-            return resp
+            responses.append(resp)
+        return responses
+
+    def send_batch(self, reqs: list[Request], conn: Union[PacketServerConnection,SimpleDirectoryConnection],
+                   timeout: int = 300) -> list[Response]:
+        """Sends reqs to the server's batch path in one request and returns their responses in order.
+        Raises RuntimeError if the batch itself fails or times out."""
+        batch = Request.blank()
+        batch.path = "batch"
+        batch.method = Request.Method.POST
+        batch.payload = [r.data for r in reqs]
+        resp = self.send_and_receive(batch, conn, timeout=timeout)
+        if resp is None:
+            raise RuntimeError("Batch request timed out.")
+        if resp.status_code != 200:
+            raise RuntimeError(f"Batch request failed: {resp.status_code}: {resp.payload}")
+        return [expand_compact(Response(Message(Message.MessageType.RESPONSE, Message.CompressionType.NONE, d)))
+                for d in resp.payload]
+
+    def send_batch_callsign(self, reqs: list[Request], callsign: str, timeout: int = 300) -> list[Response]:
+        return self.send_batch(reqs, self.connection_for(callsign), timeout=timeout)
 
     def send_receive_callsign(self, req: Request, callsign: str, timeout: int = 300) -> Optional[Response]:
         return self.send_and_receive(req, self.connection_for(callsign), timeout=timeout)
 
+    def send_receive_many_callsign(self, reqs: list[Request], callsign: str,
+                                   timeout: int = 300) -> list[Optional[Response]]:
+        return self.send_and_receive_many(reqs, self.connection_for(callsign), timeout=timeout)
+
+    def paginate(self, req: Request, callsign: str, page_size: Optional[int] = None,
+                 timeout: int = 300) -> Iterator:
+        """Yields every item of a listing, requesting one page at a time and following the server's next_cursor var
+        until it stops sending one. Raises RuntimeError if a page request fails."""
+        cursor = req.vars.get(cursor_var)
+        while True:
+            page_req = Request.blank()
+            page_req.path = req.path
+            page_req.method = req.method
+            for key, value in req.vars.items():
+                if key != 'rid':
+                    page_req.set_var(key, value)
+            if page_size is not None:
+                page_req.set_var('limit', page_size)
+            if cursor is not None:
+                page_req.set_var(cursor_var, cursor)
+            resp = self.send_receive_callsign(page_req, callsign, timeout=timeout)
+            if resp is None:
+                raise RuntimeError(f"Listing {req.path} timed out.")
+            if resp.status_code != 200:
+                raise RuntimeError(f"Listing {req.path} failed: {resp.status_code}: {resp.payload}")
+            yield from resp.payload
+            cursor = resp.vars.get(next_cursor_var)
+            if not cursor:
+                return
+
     def single_connect_send_receive(self, dest: str, req: Request, timeout: int = 300) -> Optional[Response]:
         conn = self.new_connection(dest)
         logging.debug("Waiting for connection to be ready.")
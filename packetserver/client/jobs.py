@@ -1,4 +1,4 @@
-from packetserver.client import Client
+from packetserver.client import Client, resume_download, save_response_body
 from packetserver.common import Request, Response, PacketServerConnection
 from typing import Union, Optional
 import datetime
@@ -160,6 +160,34 @@ def get_job_id(client: Client, bbs_callsign: str, job_id: int, get_data=True) ->
         raise RuntimeError(f"GET job {job_id} failed: {response.status_code}: {response.payload}")
     return JobWrapper(response.payload)
 
+def download_artifact(client: Client, bbs_callsign: str, job_id: int, artifact: Union[int, str], file_path: str,
+                      piece_size: int = 16384) -> str:
+    """Saves one job artifact, by index or name, to file_path a byte range at a time. An interrupted download is
+    kept as file_path + '.part' and resumed by calling this again."""
+    def fetch(offset: int, length: int) -> Optional[Response]:
+        req = Request.blank()
+        req.path = f"job/{job_id}"
+        req.set_var('artifact', artifact)
+        req.set_var('offset', offset)
+        req.set_var('length', length)
+        req.method = Request.Method.GET
+        return client.send_receive_callsign(req, bbs_callsign)
+
+    return resume_download(fetch, file_path, piece_size=piece_size)
+
+def save_artifact(client: Client, bbs_callsign: str, job_id: int, artifact: Union[int, str], file_path: str) -> str:
+    """Saves one job artifact, by index or name, to file_path with one GET. With a chunked client, a large
+    artifact is streamed to the file as it arrives rather than held in memory."""
+    req = Request.blank()
+    req.path = f"job/{job_id}"
+    req.set_var('artifact', artifact)
+    req.method = Request.Method.GET
+    response = client.send_receive_callsign(req, bbs_callsign)
+    if response.status_code != 200:
+        raise RuntimeError(f"GET artifact {artifact} of job {job_id} failed: {response.status_code}: "
+                           f"{response.payload}")
+    return save_response_body(response, file_path)
+
 def get_user_jobs(client: Client, bbs_callsign: str, get_data=True, id_only=False) -> list[Union[JobWrapper,int]]:
     req = Request.blank()
     req.path = f"job/user"
@@ -7,6 +7,9 @@ from typing import Union, Optional
 from uuid import UUID, uuid4
 import os.path
 import base64
+import hashlib
+from packetserver.common.chunked import file_digest
+from packetserver.common.constants import stored_payload_min_size
 
 
 class AttachmentWrapper:
@@ -104,15 +107,42 @@ class MessageWrapper:
         return d
 
 class MsgAttachment:
-    def __init__(self, name: str, data: Union[bytes,str]):
+    def __init__(self, name: str, data: Union[bytes,str,None] = None, path: Optional[str] = None):
+        """An attachment's data is given as bytes or str, or left in the file at path, which is only read when
+        the data is needed and can be streamed from instead."""
         self.binary = True
         self.name = name
-        if type(data) in [bytes, bytearray]:
+        self.path = path
+        self._data = None
+        self._file_sha256 = None
+        if data is not None:
             self.data = data
+
+    @property
+    def data(self) -> bytes:
+        if (self._data is None) and (self.path is not None):
+            with open(self.path, 'rb') as f:
+                return f.read()
+        return self._data or b''
+
+    @data.setter
+    def data(self, data: Union[bytes,str]):
+        if type(data) in [bytes, bytearray]:
+            self._data = data
         else:
-            self.data = str(data).encode()
+            self._data = str(data).encode()
             self.binary = False
 
+    @property
+    def in_file(self) -> bool:
+        return (self._data is None) and (self.path is not None)
+
+    @property
+    def size(self) -> int:
+        if self.in_file:
+            return os.path.getsize(self.path)
+        return len(self.data)
+
     def __repr__(self) -> str:
         return f"<MsgAttachment {self.name}>"
 
@@ -123,28 +153,86 @@ class MsgAttachment:
             "binary": self.binary
         }
 
+    @property
+    def sha256(self) -> bytes:
+        if self.in_file:
+            if self._file_sha256 is None:
+                self._file_sha256 = file_digest(self.path)[1]
+            return self._file_sha256
+        return hashlib.sha256(self.data).digest()
+
+    def reference_dict(self) -> dict:
+        """Names the data by sha256 and size instead of carrying it, for data the server may already have."""
+        return {
+            "name": self.name,
+            "sha256": self.sha256,
+            "size": self.size,
+            "binary": self.binary
+        }
+
+    def stream_dict(self) -> dict:
+        """Leaves the data out, for an attachment whose file is streamed as the request's body."""
+        return {
+            "name": self.name,
+            "data": None,
+            "binary": self.binary
+        }
+
 def attachment_from_file(filename: str, binary: bool = True) -> MsgAttachment:
-    a = MsgAttachment(os.path.basename(filename), open(filename, 'rb').read())
+    """The file isn't read until the attachment is sent, and a large one is streamed rather than read at all when
+    the client is chunked."""
+    a = MsgAttachment(os.path.basename(filename), path=filename)
     if not binary:
         a.binary = False
     return a
 
 def send_message(client: Client, bbs_callsign: str, text: str, to: list[str],
                  attachments: list[MsgAttachment] = None) -> dict:
-    payload = {
-        "text": text,
-        "to": to,
-        "attachments": []
-    }
-    if attachments is not None:
-        for a in attachments:
-            payload["attachments"].append(a.to_dict())
-
-    req = Request.blank()
-    req.path = "message"
-    req.method = Request.Method.POST
-    req.payload = payload
-    response = client.send_receive_callsign(req, bbs_callsign)
+    """Large attachments are offered by sha256 and size first. The server answers 412 with the hashes it doesn't
+    have, and only those attachments' data is sent on the retry. A chunked client streams the largest one kept in a
+    file from disk; the rest go in the message as usual."""
+    attachments = attachments or []
+    by_reference = [a.size >= stored_payload_min_size for a in attachments]
+
+    def post(referenced: list[bool]) -> Response:
+        req = Request.blank()
+        req.path = "message"
+        req.method = Request.Method.POST
+        streamed = None
+        if client.chunked:
+            sent = [(a.size, i) for i, (a, ref) in enumerate(zip(attachments, referenced))
+                    if (not ref) and a.in_file and (a.size >= stored_payload_min_size)]
+            if sent:
+                streamed = max(sent)[1]
+        dicts = []
+        for i, (a, ref) in enumerate(zip(attachments, referenced)):
+            if i == streamed:
+                dicts.append(a.stream_dict())
+            elif ref:
+                dicts.append(a.reference_dict())
+            else:
+                dicts.append(a.to_dict())
+        req.payload = {
+            "text": text,
+            "to": to,
+            "attachments": dicts
+        }
+        if streamed is not None:
+            req.body_file = open(attachments[streamed].path, 'rb')
+            req.body_field = ['attachments', streamed, 'data']
+        return client.send_receive_callsign(req, bbs_callsign)
+
+    response = post(by_reference)
+    if any(by_reference) and (response.status_code in (400, 412)):
+        # resend the data the server lacks; an older server (400) gets all of it
+        missing = None
+        if (response.status_code == 412) and (type(response.payload) is dict):
+            missing = set(response.payload.get('missing') or [])
+        if missing:
+            by_reference = [ref and (a.sha256 not in missing) for a, ref in zip(attachments, by_reference)]
+        else:
+            by_reference = [False] * len(attachments)
+        response = post(by_reference)
     if response.status_code != 201:
         raise RuntimeError(f"POST message failed: {response.status_code}: {response.payload}")
     return response.payload
@@ -160,6 +248,19 @@ def get_message_uuid(client: Client, bbs_callsign: str, msg_id: UUID, get_attach
         raise RuntimeError(f"GET message failed: {response.status_code}: {response.payload}")
     return MessageWrapper(response.payload)
 
+def delete_message_uuid(client: Client, bbs_callsign: str, msg_id: UUID) -> bool:
+    """Deletes a message from your own mailbox. Returns False if there was no such message."""
+    req = Request.blank()
+    req.path = "message"
+    req.method = Request.Method.DELETE
+    req.set_var('id', msg_id.bytes)
+    response = client.send_receive_callsign(req, bbs_callsign)
+    if response.status_code == 404:
+        return False
+    if response.status_code != 200:
+        raise RuntimeError(f"DELETE message failed: {response.status_code}: {response.payload}")
+    return True
+
 def get_messages_since(client: Client, bbs_callsign: str, since: datetime.datetime, get_text: bool = True, limit: int = None,
                  sort_by: str = 'date', reverse: bool = False, search: str = None, get_attachments: bool = True,
                  source: str = 'received') -> list[MessageWrapper]:
@@ -1,10 +1,15 @@
 import datetime
 
-from packetserver.client import Client
+from packetserver.client import Client, resume_download, save_response_body
 from packetserver.common import Request, Response, PacketServerConnection
 from typing import Union, Optional
 from uuid import UUID, uuid4
 import os.path
+import hashlib
+import logging
+from packetserver.common import delta
+from packetserver.common.chunked import file_digest
+from packetserver.common.constants import stored_payload_min_size
 
 
 
@@ -54,7 +59,26 @@ class ObjectWrapper:
             return dat.decode()
 
 
+def offer_object(client: Client, bbs_callsign: str, name: str, sha256: bytes, size: int, binary: bool,
+                 private: bool) -> Optional[UUID]:
+    """Asks the server to make an object from data it already has, by sha256 and size. Returns the new object's
+    UUID, or None if the server doesn't have the data and it has to be sent."""
+    req = Request.blank()
+    req.path = "object"
+    req.method = Request.Method.POST
+    req.payload = {'name': name, 'sha256': sha256, 'size': size, 'binary': binary, 'private': private}
+    response = client.send_receive_callsign(req, bbs_callsign)
+    if response.status_code == 201:
+        logging.debug(f"Server already had the data for object {name}; posted by reference")
+        return UUID(response.payload)
+    # 412 means the server doesn't have it; older servers answer 400
+    if response.status_code not in (400, 412):
+        raise RuntimeError(f"Posting object failed: {response.status_code}: {response.payload}")
+    return None
+
 def post_object(client: Client, bbs_callsign: str, name:str, data: Union[str, bytes, bytearray], private=True) -> UUID:
+    """Large data is offered by sha256 and size first. If the server already has it the object is made from its
+    copy and the data never goes over the air; otherwise it's sent as usual."""
     if type(data) in [bytes, bytearray]:
         data = bytes(data)
         binary = True
@@ -62,26 +86,44 @@ def post_object(client: Client, bbs_callsign: str, name:str, data: Union[str, by
         binary = False
         data = str(data).encode()
 
+    if len(data) >= stored_payload_min_size:
+        uid = offer_object(client, bbs_callsign, name, hashlib.sha256(data).digest(), len(data), binary, private)
+        if uid is not None:
+            return uid
     req = Request.blank()
     req.path = "object"
-    req.payload = {'name': name, 'data': data, 'binary': binary, 'private': private}
     req.method = Request.Method.POST
+    req.payload = {'name': name, 'data': data, 'binary': binary, 'private': private}
     response = client.send_receive_callsign(req, bbs_callsign)
     if response.status_code != 201:
         raise RuntimeError(f"Posting object failed: {response.status_code}: {response.payload}")
     return UUID(response.payload)
 
 def post_file(client: Client, bbs_callsign: str, file_path: str, private=True, name: str = None, binary=True) -> UUID:
+    """A large binary file going to a chunked client is offered by sha256 first, and if the server doesn't have it,
+    streamed from disk without being read into memory. Anything else is read and posted with post_object()."""
     if name is None:
         obj_name = os.path.basename(file_path)
     else:
         obj_name = os.path.basename(str(name))
-    if binary:
-        mode = 'rb'
-    else:
-        mode = 'r'
-    data = open(file_path, mode).read()
-    return post_object(client, bbs_callsign, obj_name, data, private=private)
+    if (not binary) or (not client.chunked) or (os.path.getsize(file_path) < stored_payload_min_size):
+        data = open(file_path, 'rb' if binary else 'r').read()
+        return post_object(client, bbs_callsign, obj_name, data, private=private)
+
+    size, sha256 = file_digest(file_path)
+    uid = offer_object(client, bbs_callsign, obj_name, sha256, size, True, private)
+    if uid is not None:
+        return uid
+    req = Request.blank()
+    req.path = "object"
+    req.method = Request.Method.POST
+    req.payload = {'name': obj_name, 'data': None, 'binary': True, 'private': private}
+    req.body_file = open(file_path, 'rb')
+    req.body_field = 'data'
+    response = client.send_receive_callsign(req, bbs_callsign)
+    if response.status_code != 201:
+        raise RuntimeError(f"Posting object failed: {response.status_code}: {response.payload}")
+    return UUID(response.payload)
 
 def get_object_by_uuid(client: Client, bbs_callsign: str, uuid: Union[str, bytes, UUID, int],
                        include_data=True)  -> ObjectWrapper:
@@ -105,8 +147,59 @@ def get_object_by_uuid(client: Client, bbs_callsign: str, uuid: Union[str, bytes
     response = client.send_receive_callsign(req, bbs_callsign)
     if response.status_code != 200:
         raise RuntimeError(f"GET object {uid} failed: {response.status_code}: {response.payload}")
+    response.read_body_file()
     return ObjectWrapper(response.payload)
 
+def save_object(client: Client, bbs_callsign: str, uuid: Union[str, bytes, UUID, int], file_path: str) -> str:
+    """Saves an object's data to file_path with one GET. With a chunked client, large data is streamed to the
+    file as it arrives rather than held in memory. Use download_object to be able to resume."""
+    if type(uuid) is str:
+        uid = UUID(uuid)
+    elif type(uuid) is bytes:
+        uid = UUID(bytes=uuid)
+    elif type(uuid) is UUID:
+        uid = uuid
+    elif type(uuid) is int:
+        uid = UUID(int=uuid)
+    else:
+        raise ValueError("uuid must represent a UUID object")
+
+    req = Request.blank()
+    req.set_var('fetch', 1)
+    req.path = "object"
+    req.set_var('uuid', uid.bytes)
+    req.method = Request.Method.GET
+    response = client.send_receive_callsign(req, bbs_callsign)
+    if response.status_code != 200:
+        raise RuntimeError(f"GET object {uid} failed: {response.status_code}: {response.payload}")
+    return save_response_body(response, file_path)
+
+def download_object(client: Client, bbs_callsign: str, uuid: Union[str, bytes, UUID, int], file_path: str,
+                    piece_size: int = 16384) -> str:
+    """Saves an object's data to file_path a byte range at a time. An interrupted download is kept as
+    file_path + '.part' and resumed by calling this again."""
+    if type(uuid) is str:
+        uid = UUID(uuid)
+    elif type(uuid) is bytes:
+        uid = UUID(bytes=uuid)
+    elif type(uuid) is UUID:
+        uid = uuid
+    elif type(uuid) is int:
+        uid = UUID(int=uuid)
+    else:
+        raise ValueError("uuid must represent a UUID object")
+
+    def fetch(offset: int, length: int) -> Optional[Response]:
+        req = Request.blank()
+        req.path = "object"
+        req.set_var('uuid', uid.bytes)
+        req.set_var('offset', offset)
+        req.set_var('length', length)
+        req.method = Request.Method.GET
+        return client.send_receive_callsign(req, bbs_callsign)
+
+    return resume_download(fetch, file_path, piece_size=piece_size)
+
 def get_user_objects(client: Client, bbs_callsign: str, limit: int = 10, include_data: bool = True, search: str = None,
                      reverse: bool = False, sort_date: bool = False, sort_name: bool = False, sort_size: bool = False)\
         -> list[ObjectWrapper]:
@@ -156,6 +249,87 @@ def delete_object_by_uuid(client: Client, bbs_callsign: str, uuid: Union[str, by
         raise RuntimeError(f"Deleting object {uid} failed: {response.status_code}: {response.payload}")
     return True
 
-def update_object_by_uuid():
-    # TODO update object by uuid client
-    pass
\ No newline at end of file
+def update_object_by_uuid(client: Client, bbs_callsign: str, uuid: Union[str, bytes, UUID, int],
+                          name: Optional[str] = None, data: Union[str, bytes, bytearray, None] = None) -> bool:
+    if type(uuid) is str:
+        uid = UUID(uuid)
+    elif type(uuid) is bytes:
+        uid = UUID(bytes=uuid)
+    elif type(uuid) is UUID:
+        uid = uuid
+    elif type(uuid) is int:
+        uid = UUID(int=uuid)
+    else:
+        raise ValueError("uuid must represent a UUID object")
+
+    payload = {}
+    if name is not None:
+        payload['name'] = name
+    if data is not None:
+        payload['data'] = bytes(data) if type(data) in [bytes, bytearray] else str(data)
+    req = Request.blank()
+    req.path = "object"
+    req.set_var('uuid', uid.bytes)
+    req.payload = payload
+    req.method = Request.Method.UPDATE
+    response = client.send_receive_callsign(req, bbs_callsign)
+    if response.status_code != 200:
+        raise RuntimeError(f"Updating object {uid} failed: {response.status_code}: {response.payload}")
+    return True
+
+def sync_object(client: Client, bbs_callsign: str, uuid: Union[str, bytes, UUID, int],
+                data: Union[str, bytes, bytearray], block_size: Optional[int] = None) -> int:
+    """Makes the server's copy of an object match data, sending only the blocks that changed.
+    Falls back to sending all of data when a delta wouldn't be smaller or the server's copy changed mid-sync.
+    Returns the number of data bytes sent."""
+    if type(uuid) is str:
+        uid = UUID(uuid)
+    elif type(uuid) is bytes:
+        uid = UUID(bytes=uuid)
+    elif type(uuid) is UUID:
+        uid = uuid
+    elif type(uuid) is int:
+        uid = UUID(int=uuid)
+    else:
+        raise ValueError("uuid must represent a UUID object")
+    if type(data) in [bytes, bytearray]:
+        new_bytes = bytes(data)
+    else:
+        data = str(data)
+        new_bytes = data.encode()
+
+    req = Request.blank()
+    req.path = "object"
+    req.set_var('uuid', uid.bytes)
+    req.set_var('signatures', block_size if block_size else True)
+    req.method = Request.Method.GET
+    response = client.send_receive_callsign(req, bbs_callsign)
+    if response.status_code != 200:
+        raise RuntimeError(f"GET signatures for object {uid} failed: {response.status_code}: {response.payload}")
+    if 'signatures' not in response.payload:
+        logging.debug("Server did not send signatures; sending the whole object")
+        update_object_by_uuid(client, bbs_callsign, uid, data=data)
+        return len(new_bytes)
+    sigs = response.payload['signatures']
+    if sigs['sha256'] == hashlib.sha256(new_bytes).digest():
+        return 0
+
+    ops = delta.compute_delta(sigs, new_bytes)
+    sent = delta.delta_literal_size(ops)
+    if sent >= len(new_bytes):
+        update_object_by_uuid(client, bbs_callsign, uid, data=data)
+        return len(new_bytes)
+    req = Request.blank()
+    req.path = "object"
+    req.set_var('uuid', uid.bytes)
+    req.payload = {'delta': ops, 'block_size': sigs['block_size'], 'base_sha256': sigs['sha256'],
+                   'sha256': hashlib.sha256(new_bytes).digest()}
+    req.method = Request.Method.UPDATE
+    response = client.send_receive_callsign(req, bbs_callsign)
+    if response.status_code == 409:
+        logging.info(f"Object {uid} changed on the server mid-sync; sending the whole object")
+        update_object_by_uuid(client, bbs_callsign, uid, data=data)
+        return len(new_bytes)
+    if response.status_code != 200:
+        raise RuntimeError(f"Delta update of object {uid} failed: {response.status_code}: {response.payload}")
+    return sent
\ No newline at end of file
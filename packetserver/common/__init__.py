@@ -3,8 +3,9 @@ from threading import Lock
 from msgpack import Unpacker
 from msgpack import packb, unpackb
 from enum import Enum
-import bz2
-from typing import Union, Self
+from packetserver.common import compression, dictionaries, chunked, util
+from packetserver.common.constants import yes_values
+from typing import Union, Self, Iterable, Iterator, Optional
 import datetime
 import logging
 import ax25
@@ -24,6 +25,7 @@ class PacketServerConnection(Connection):
         self.connection_created = datetime.datetime.now(datetime.UTC)
         self.connection_last_activity = datetime.datetime.now(datetime.UTC)
         self.closing = False
+        self.chunks = chunked.ChunkReceiver()
 
 
     @property
@@ -48,6 +50,7 @@ class PacketServerConnection(Connection):
 
     def disconnected(self):
         logging.debug(f"connection disconnected: {self.call_from} -> {self.call_to}")
+        self.chunks.clear()
 
     def data_received(self, pid, data):
         self.connection_last_activity = datetime.datetime.now(datetime.UTC)
@@ -78,6 +81,11 @@ class PacketServerConnection(Connection):
         else:
             super().send_data(data)
 
+    def send_frames(self, frames: Iterable[bytes]):
+        """Sends each packed frame in turn, pulling them from the iterable only as they are sent."""
+        for frame in frames:
+            self.send_data(frame)
+
     @classmethod
     def query_accept(cls, port, call_from, call_to):
         return True
@@ -91,15 +99,28 @@ class Message:
         BZIP2 = 1
         GZIP = 2
         DEFLATE = 3
+        LZMA = 4
+        DICT = 5
+        AUTO = 255  # never sent on the wire; pack() picks whichever codec gives the fewest bytes
 
     class MessageType(Enum):
         REQUEST = 0
         RESPONSE = 1
+        CHUNK_HEADER = chunked.CHUNK_HEADER
+        CHUNK = chunked.CHUNK
 
     def __init__(self, msg_type: MessageType, compression: CompressionType,  payload: dict):
         self.type = Message.MessageType(msg_type)
         self.compression = Message.CompressionType(compression)
         self.data = payload
+        # DICT dictionary versions the receiving peer says it holds; None means only version 1
+        self.peer_dictionaries = None
+        # what the compression policy learns under, normally the request path, plus the payload's type if known
+        self.compression_hint = None
+        self.content_type = None
+        # a payload that arrived as a streamed chunked transfer, left on disk for the receiver to read as a file
+        self.body_file = None
+        self.body_field = None
 
     @property
     def vars(self) -> dict:
@@ -120,30 +141,104 @@ class Message:
             self.data['v'] = {}
         self.data['v'][str(key).lower()] = value
 
+    @property
+    def request_id(self):
+        """Optional id a client puts on a request to match up the response when it has several in flight."""
+        return self.vars.get('rid')
+
+    @request_id.setter
+    def request_id(self, rid: Union[int, str, None]):
+        if rid is None:
+            self.vars.pop('rid', None)
+        else:
+            self.set_var('rid', rid)
+
     @property
     def data_bytes(self):
         return packb(self.data)
 
-    def pack(self) -> bytes:
-        output = {'t': self.type.value, 'c': self.compression.value}
+    def packed_body(self) -> tuple[int, bytes]:
+        """Returns (compression type, bytes) of what goes in the envelope's 'd'."""
         data_bytes = self.data_bytes
         logging.debug("Packing Message")
         if (self.compression is self.CompressionType.NONE) or (len(data_bytes) < 30):
-            output['d'] = data_bytes
-            output['c'] = self.CompressionType.NONE.value
-            return packb(output)
+            return self.CompressionType.NONE.value, data_bytes
+
+        if self.compression is self.CompressionType.AUTO:
+            candidates = compression.auto_candidates()
+        else:
+            candidates = [self.compression.value]
+        hint = self.compression_hint
+        if self.content_type:
+            hint = f"{hint}:{self.content_type}"
+        return compression.default_policy.compress(
+            data_bytes, candidates, hint=hint, content_type=self.content_type,
+            dictionary_version=compression.negotiate_dictionary(self.peer_dictionaries))
 
-        if self.compression is self.CompressionType.BZIP2:
-            compressed = bz2.compress(packb(self.data))
+    def pack(self) -> bytes:
+        comp, body = self.packed_body()
+        return packb({'t': self.type.value, 'c': comp, 'd': body})
+
+    def frames(self, chunk_size: Optional[int] = None) -> Iterator[bytes]:
+        """Yields the packed message as one frame, or as a chunked transfer when chunk_size is set and the
+        body is bigger than one chunk."""
+        comp, body = self.packed_body()
+        if (chunk_size is None) or (len(body) <= chunk_size):
+            yield packb({'t': self.type.value, 'c': comp, 'd': body})
+            return
+        yield from chunked.iter_frames(self.type.value, comp, body, chunk_size=chunk_size)
+
+    def stream_frames(self, body: Iterable[bytes], total_size: int, sha256: bytes,
+                      chunk_size: int = chunked.default_chunk_size,
+                      field: Union[str, list, None] = None) -> Iterator[bytes]:
+        """Yields a chunked transfer whose payload is streamed uncompressed from body instead of held in
+        memory. Everything else in the message travels in the header. With field, the payload is a dict and body
+        is the value of that field, or of the value at that path of keys and list indexes when field is a list
+        (['attachments', 0, 'data'])."""
+        if field is None:
+            meta = {k: v for k, v in self.data.items() if k != 'd'}
         else:
-            raise NotImplementedError(f"Compression type {self.compression.name} is not implemented yet.")
+            meta = dict(self.data)
+            meta['s'] = field
+        return chunked.iter_frames(self.type.value, self.CompressionType.NONE.value, body, total_size=total_size,
+                                   sha256=sha256, meta=meta, chunk_size=chunk_size)
 
-        if len(compressed) < len(data_bytes):
-            output['d'] = compressed
+    @classmethod
+    def from_assembler(cls, assembler: chunked.ChunkAssembler) -> Self:
+        """The message a finished chunked transfer carried. A streamed payload isn't read into memory: it's left
+        in body_file, and read_body_file() or the receiver itself takes it from there."""
+        if not assembler.streamed:
+            return Message.partial_unpack(assembler.envelope())
+        data = dict(assembler.meta)
+        field = data.pop('s', None)
+        if (field is not None) and (type(data.get('d')) is not dict):
+            raise ValueError("Streamed message names a payload field but has no dict payload.")
+        msg = Message(Message.MessageType(assembler.msg_type), Message.CompressionType.NONE, data)
+        msg.body_file = assembler.take_body()
+        msg.body_field = field
+        return msg
+
+    def fill_body(self, value):
+        """Puts value where the streamed body belongs: the payload itself, or its body_field."""
+        if self.body_field is None:
+            self.data['d'] = value
         else:
-            output['d'] = data_bytes
-            output['c'] = self.CompressionType.NONE.value
-        return packb(output)
+            chunked.put_field(self.data['d'], self.body_field, value)
+
+    def read_body_file(self):
+        """Puts a streamed payload into the message, for receivers that want it in memory like any other."""
+        if self.body_file is None:
+            return
+        with self.body_file as f:
+            body = f.read()
+        self.body_file = None
+        self.fill_body(body)
+        self.body_field = None
+
+    def close_body_file(self):
+        if self.body_file is not None:
+            self.body_file.close()
+            self.body_file = None
 
     @property
     def payload(self):
@@ -172,14 +267,16 @@ class Message:
         unpacked = msg
         comp = Message.CompressionType(unpacked['c'])
         msg_type = Message.MessageType(unpacked['t'])
+        if msg_type in (Message.MessageType.CHUNK_HEADER, Message.MessageType.CHUNK):
+            raise ValueError("Chunk frames must be assembled by a ChunkReceiver before unpacking.")
         raw_data = unpacked['d']
 
         if comp is Message.CompressionType.NONE:
             data = unpackb(raw_data)
-        elif comp is Message.CompressionType.BZIP2:
-            data = unpackb(bz2.decompress(raw_data))
+        elif comp is Message.CompressionType.AUTO:
+            raise ValueError("AUTO is not a valid compression type for a packed message.")
         else:
-            raise NotImplementedError(f"Compression type {comp.name} is not implemented yet.")
+            data = unpackb(compression.decompress(comp.value, raw_data))
 
         return Message(msg_type, comp, data)
 
@@ -208,6 +305,10 @@ class Request(Message):
             raise ValueError(f"Can't create a Request Object from a {msg.type} Message object.")
 
         super().__init__(msg.type, msg.compression, msg.data)
+        self.body_file = msg.body_file
+        self.body_field = msg.body_field
+        # called just before a response to this request is sent; the server commits the request's transaction here
+        self.before_send = None
 
         if ('p' in msg.data) and (type(msg.data['p']) is not str):
             raise ValueError("Path of Request must be a string.")
@@ -262,6 +363,8 @@ class Response(Message):
             raise ValueError(f"Can't create a Response Object from a {msg.type} Message object.")
 
         super().__init__(msg.type, msg.compression, msg.data)
+        self.body_file = msg.body_file
+        self.body_field = msg.body_field
         if 'c' in msg.data:
             status_bytes = self.data['c']
             if type(status_bytes) is not bytes:
@@ -302,6 +405,22 @@ class Response(Message):
     def __repr__(self):
         return f"<Response: {self.status_code}>"
 
+def requested_chunk_size(original_request: Request) -> Optional[int]:
+    """Chunk size the requester asked for with the 'chunked' var: True for the default size, or a number of bytes.
+    None when the requester didn't ask for chunked responses."""
+    val = original_request.vars.get('chunked')
+    if (val is None) or (val is False):
+        return None
+    if val is True:
+        return chunked.default_chunk_size
+    try:
+        size = int(val)
+    except (TypeError, ValueError):
+        return chunked.default_chunk_size
+    if size <= 0:
+        return None
+    return max(size, 64)
+
 def send_response(conn: PacketServerConnection, response: Response, original_request: Request,
                   compression: Message.CompressionType = Message.CompressionType.BZIP2):
     if conn.state.name == "CONNECTED" and not conn.closing:
@@ -311,9 +430,10 @@ def send_response(conn: PacketServerConnection, response: Response, original_req
         comp = compression
         logging.debug(f"Default comp: {comp}")
         logging.debug(f"Original vars: {original_request.vars}")
-        if 'C' in original_request.vars:
-            logging.debug(f"Detected compression header in original request: {original_request.vars['C']}")
-            val = original_request.vars['C']
+        # set_var lower-cases keys, so accept either case of the compression var
+        val = original_request.vars.get('C', original_request.vars.get('c'))
+        if val is not None:
+            logging.debug(f"Detected compression header in original request: {val}")
             for i in Message.CompressionType:
                 logging.debug(f"Checking type: {i}")
                 if str(val).strip().upper() == i.name:
@@ -324,20 +444,71 @@ def send_response(conn: PacketServerConnection, response: Response, original_req
                     if int(val) == i.value:
                         comp = i
                         logging.debug(f"matched compression with var to {comp}")
+                        break
                 except ValueError:
                     pass
         response.compression = comp
+        response.request_id = original_request.request_id
+        response.peer_dictionaries = original_request.vars.get('cd')
+        if response.compression_hint is None:
+            response.compression_hint = original_request.path.split("/")[0]
+        if (original_request.method is Request.Method.GET) and (200 <= response.status_code < 300):
+            shape_payload(response, original_request)
         logging.debug(f"Final compression: {response.compression}")
+        if original_request.before_send is not None:
+            original_request.before_send()
 
         logging.debug(f"sending response: {response}, {response.compression}, {response.payload}")
-        conn.send_data(response.pack())
+        conn.send_frames(response.frames(chunk_size=requested_chunk_size(original_request)))
         logging.debug("response sent successfully")
     else:
         logging.warning(f"Attempted to send data, but connection state is {conn.state.name}")
 
+def shape_payload(response: Response, original_request: Request):
+    """Applies the request's 'fields' projection, and for list payloads of dicts the 'compact' row encoding, which
+    is flagged with a 'compact' var on the response so clients know to expand it."""
+    fields = util.requested_fields(original_request.vars)
+    payload = response.payload
+    if fields is not None:
+        payload = util.project_fields(payload, fields)
+    if (original_request.vars.get('compact') in yes_values) and (type(payload) is list) \
+            and all(type(row) is dict for row in payload):
+        payload = util.compact_rows(payload, fields)
+        response.set_var('compact', 1)
+    if (fields is not None) or response.vars.get('compact'):
+        response.payload = payload
+
 def send_blank_response(conn: PacketServerConnection, original_request: Request, status_code: int = 200,
                   payload: Union[bytes, bytearray, str, dict, list] = ""):
     response = Response.blank()
     response.status_code = status_code
     response.payload = payload
-    send_response(conn, response, original_request)
\ No newline at end of file
+    send_response(conn, response, original_request)
+
+def wants_stream(original_request: Request, total_size: int) -> bool:
+    """Whether a body of total_size bytes should go to this requester with send_stream: it asked for chunked
+    responses smaller than the body, and didn't ask for only some fields."""
+    chunk_size = requested_chunk_size(original_request)
+    return (chunk_size is not None) and (total_size > chunk_size) \
+        and (util.requested_fields(original_request.vars) is None)
+
+def send_stream(conn: PacketServerConnection, response: Response, original_request: Request, body: Iterable[bytes],
+                total_size: int, sha256: bytes, field: Union[str, list, None] = None):
+    """Sends response with body as its payload, or with field a dict payload's value for that field. Requesters
+    that asked for chunked responses get the body streamed straight from the iterable, and everything else in the
+    response as is; everyone else gets it gathered into an ordinary response."""
+    chunk_size = requested_chunk_size(original_request)
+    if chunk_size is None:
+        response.body_field = field
+        response.fill_body(b''.join(body))
+        response.body_field = None
+        send_response(conn, response, original_request)
+        return
+    if conn.state.name == "CONNECTED" and not conn.closing:
+        response.request_id = original_request.request_id
+        if original_request.before_send is not None:
+            original_request.before_send()
+        logging.debug(f"streaming response: {response}, {total_size} bytes")
+        conn.send_frames(response.stream_frames(body, total_size, sha256, chunk_size=chunk_size, field=field))
+    else:
+        logging.warning(f"Attempted to send data, but connection state is {conn.state.name}")
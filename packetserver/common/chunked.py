@@ -0,0 +1,287 @@
+"""Chunked transfer framing for payloads too large to send comfortably as one message.
+
+A chunked transfer is a header frame followed by numbered chunk frames. Both are ordinary msgpack envelopes:
+
+    header: {'t': CHUNK_HEADER, 'c': compression, 'd': {'x': transfer id, 'y': message type, 'n': total size,
+                                                       'k': chunk count, 'h': sha256 of body, 'm': meta}}
+    chunk:  {'t': CHUNK, 'c': 0, 'd': {'x': transfer id, 'i': index, 'b': bytes}}
+
+Without 'm' the body is what would have been the 'd' of a normal envelope (the packed message data, compressed with
+'c'), and once assembled it becomes the message's 'd'. With 'm' the body is raw payload bytes streamed as is, and 'm'
+holds the rest of the message data. If 'm' has an 's' key, 'm'['d'] is a dict payload and the body is the value of
+its 's' field, or of the value at 's' when it's a list of keys and list indexes (['attachments', 0, 'data']);
+otherwise the body is the whole payload. Receivers can read a streamed body from the spool as a file (take_body)
+rather than loading it into memory."""
+import hashlib
+import logging
+import math
+import secrets
+import tempfile
+from msgpack import packb
+from typing import IO, Iterable, Iterator, Optional, Union, Tuple
+
+CHUNK_HEADER = 2
+CHUNK = 3
+
+default_chunk_size = 1024
+spool_memory_size = 1024 * 1024
+
+
+class ChunkError(Exception):
+    """Raised when chunk frames arrive out of order, overflow their header, or fail the hash check."""
+    pass
+
+
+def new_transfer_id() -> int:
+    return secrets.randbits(32)
+
+
+def is_chunk_frame(unpacked) -> bool:
+    return (type(unpacked) is dict) and (unpacked.get('t') in (CHUNK_HEADER, CHUNK))
+
+
+def blocks(body: Iterable[bytes], size: int) -> Iterator[bytes]:
+    """Re-slices an iterable of byte strings of any length into blocks of exactly size bytes (the last may be short)."""
+    buffer = bytearray()
+    for piece in body:
+        buffer.extend(piece)
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if len(buffer) > 0:
+        yield bytes(buffer)
+
+
+def read_blocks(f: IO[bytes], size: int = 65536) -> Iterator[bytes]:
+    while True:
+        block = f.read(size)
+        if not block:
+            break
+        yield block
+
+
+def file_blocks(path: str, size: int = 65536) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        yield from read_blocks(f, size)
+
+
+def file_digest(file: Union[str, IO[bytes]]) -> Tuple[int, bytes]:
+    """Returns (size, sha256 digest) of a file, by path or open and seekable, without reading it all into memory.
+    An open file is hashed from the start and rewound afterwards."""
+    h = hashlib.sha256()
+    size = 0
+    if type(file) is str:
+        blocks_in = file_blocks(file)
+    else:
+        file.seek(0)
+        blocks_in = read_blocks(file)
+    for block in blocks_in:
+        h.update(block)
+        size = size + len(block)
+    if type(file) is not str:
+        file.seek(0)
+    return size, h.digest()
+
+
+def iter_frames(msg_type: int, compression: int, body: Union[bytes, bytearray, Iterable[bytes]],
+                total_size: Optional[int] = None, sha256: Optional[bytes] = None, meta: Optional[dict] = None,
+                chunk_size: int = default_chunk_size, transfer_id: Optional[int] = None) -> Iterator[bytes]:
+    """Yields the packed header frame and then each chunk frame for body.
+
+    body may be bytes, or any iterable of bytes (a generator reading a file, for instance). An iterable is only
+    consumed as the frames are pulled, so total_size and sha256 must be supplied up front for it."""
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be a positive integer")
+    if type(body) in (bytes, bytearray):
+        total_size = len(body)
+        sha256 = hashlib.sha256(body).digest()
+        body = [bytes(body)]
+    elif (total_size is None) or (sha256 is None):
+        raise ValueError("total_size and sha256 are required to stream a body from an iterable")
+    if transfer_id is None:
+        transfer_id = new_transfer_id()
+
+    header = {'x': transfer_id, 'y': msg_type, 'n': total_size, 'k': math.ceil(total_size / chunk_size),
+              'h': sha256}
+    if meta is not None:
+        header['m'] = meta
+    logging.debug(f"Starting chunked transfer {transfer_id}: {total_size} bytes in {header['k']} chunks")
+    yield packb({'t': CHUNK_HEADER, 'c': compression, 'd': header})
+
+    index = 0
+    sent = 0
+    for block in blocks(body, chunk_size):
+        sent = sent + len(block)
+        if sent > total_size:
+            raise ValueError(f"Stream for transfer {transfer_id} is longer than its declared {total_size} bytes")
+        yield packb({'t': CHUNK, 'c': 0, 'd': {'x': transfer_id, 'i': index, 'b': block}})
+        index = index + 1
+    if sent != total_size:
+        raise ValueError(f"Stream for transfer {transfer_id} ended after {sent} of {total_size} bytes")
+
+
+def put_field(payload, field: Union[str, list], value):
+    """Sets the value a streamed body belongs at: payload[field], or the value at a path of keys and indexes."""
+    path = [field] if type(field) is str else list(field)
+    try:
+        container = payload
+        for key in path[:-1]:
+            container = container[key]
+        container[path[-1]] = value
+    except (KeyError, IndexError, TypeError):
+        raise ValueError(f"Streamed payload has no field {field}")
+
+
+class ChunkAssembler:
+    """Collects the chunks of one transfer into a spooled temporary file, checking order, size and hash."""
+
+    def __init__(self, header_frame: dict, max_size: Optional[int] = None):
+        header = header_frame.get('d')
+        if type(header) is not dict:
+            raise ChunkError("Chunk header frame has no header")
+        try:
+            self.transfer_id = int(header['x'])
+            self.msg_type = int(header['y'])
+            self.total_size = int(header['n'])
+            self.chunk_count = int(header['k'])
+            self.sha256 = bytes(header['h'])
+        except (KeyError, TypeError, ValueError):
+            raise ChunkError("Malformed chunk header")
+        if (max_size is not None) and (self.total_size > max_size):
+            raise ChunkError(f"Transfer of {self.total_size} bytes exceeds the {max_size} byte limit")
+        self.compression = int(header_frame.get('c', 0))
+        self.meta = header.get('m')
+        self.received = 0
+        self.next_index = 0
+        self._hash = hashlib.sha256()
+        self.spool = tempfile.SpooledTemporaryFile(max_size=spool_memory_size)
+
+    @property
+    def streamed(self) -> bool:
+        """Whether the body is a raw streamed payload, with the rest of the message in meta."""
+        return self.meta is not None
+
+    @property
+    def complete(self) -> bool:
+        return (self.next_index >= self.chunk_count) and (self.received == self.total_size)
+
+    @property
+    def progress(self) -> float:
+        if self.total_size == 0:
+            return 1.0
+        return self.received / self.total_size
+
+    def feed(self, frame: dict) -> bool:
+        """Adds one chunk frame. Returns True once the transfer is complete and verified."""
+        chunk = frame.get('d')
+        if type(chunk) is not dict:
+            raise ChunkError(f"Transfer {self.transfer_id} received a malformed chunk")
+        index = chunk.get('i')
+        block = chunk.get('b', b'')
+        if index != self.next_index:
+            raise ChunkError(f"Transfer {self.transfer_id} expected chunk {self.next_index}, got {index}")
+        if (self.received + len(block)) > self.total_size:
+            raise ChunkError(f"Transfer {self.transfer_id} received more than its declared {self.total_size} bytes")
+        self.spool.write(block)
+        self._hash.update(block)
+        self.received = self.received + len(block)
+        self.next_index = self.next_index + 1
+        if self.next_index >= self.chunk_count:
+            if self.received != self.total_size:
+                raise ChunkError(f"Transfer {self.transfer_id} ended after {self.received} of "
+                                 f"{self.total_size} bytes")
+            if self._hash.digest() != self.sha256:
+                raise ChunkError(f"Transfer {self.transfer_id} failed its sha256 check")
+            return True
+        return False
+
+    def iter_body(self, block_size: int = 65536) -> Iterator[bytes]:
+        self.spool.seek(0)
+        while True:
+            block = self.spool.read(block_size)
+            if not block:
+                break
+            yield block
+
+    def read_body(self) -> bytes:
+        self.spool.seek(0)
+        return self.spool.read()
+
+    def take_body(self) -> IO[bytes]:
+        """Hands over the spool holding the body, rewound, for the caller to read and close. close() leaves it
+        alone afterwards."""
+        spool = self.spool
+        self.spool = None
+        spool.seek(0)
+        return spool
+
+    def envelope(self) -> dict:
+        """The assembled transfer as an ordinary message envelope, ready for Message.partial_unpack. This reads
+        the whole body into memory."""
+        if self.meta is None:
+            return {'t': self.msg_type, 'c': self.compression, 'd': self.read_body()}
+        data = dict(self.meta)
+        field = data.pop('s', None)
+        if (field is not None) and (type(data.get('d')) is dict):
+            put_field(data['d'], field, self.read_body())
+        else:
+            data['d'] = self.read_body()
+        return {'t': self.msg_type, 'c': 0, 'd': packb(data)}
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+
+    def __repr__(self):
+        return f"<ChunkAssembler: {self.transfer_id} {self.received}/{self.total_size}>"
+
+
+class ChunkReceiver:
+    """Tracks the chunked transfers in progress on one connection."""
+
+    def __init__(self, max_transfers: int = 4, max_size: Optional[int] = 64 * 1024 * 1024):
+        self.max_transfers = max_transfers
+        self.max_size = max_size
+        self.transfers = {}
+
+    def accept(self, frame: dict) -> Optional[ChunkAssembler]:
+        """Takes a header or chunk frame. Returns the finished ChunkAssembler when a transfer completes."""
+        if frame['t'] == CHUNK_HEADER:
+            assembler = ChunkAssembler(frame, max_size=self.max_size)
+            if assembler.transfer_id in self.transfers:
+                self.discard(assembler.transfer_id)
+            while len(self.transfers) >= self.max_transfers:
+                oldest = next(iter(self.transfers))
+                logging.warning(f"Too many chunked transfers in progress; dropping {oldest}")
+                self.discard(oldest)
+            self.transfers[assembler.transfer_id] = assembler
+            if assembler.chunk_count == 0:
+                return self.finish(assembler)
+            return None
+
+        transfer_id = frame['d'].get('x') if type(frame.get('d')) is dict else None
+        if transfer_id not in self.transfers:
+            raise ChunkError(f"Chunk for unknown transfer {transfer_id}")
+        assembler = self.transfers[transfer_id]
+        try:
+            if assembler.feed(frame):
+                return self.finish(assembler)
+        except ChunkError:
+            self.discard(transfer_id)
+            raise
+        return None
+
+    def finish(self, assembler: ChunkAssembler) -> ChunkAssembler:
+        if assembler.chunk_count == 0 and assembler.total_size != 0:
+            self.discard(assembler.transfer_id)
+            raise ChunkError(f"Transfer {assembler.transfer_id} declared no chunks for {assembler.total_size} bytes")
+        del self.transfers[assembler.transfer_id]
+        return assembler
+
+    def discard(self, transfer_id: int):
+        if transfer_id in self.transfers:
+            self.transfers.pop(transfer_id).close()
+
+    def clear(self):
+        for transfer_id in list(self.transfers.keys()):
+            self.discard(transfer_id)
@@ -0,0 +1,417 @@
+"""Compression codecs used when packing packetserver messages for transmission."""
+import bz2
+import gzip
+import lzma
+import zlib
+import logging
+import math
+import mimetypes
+from collections import Counter
+from threading import Lock
+from typing import Iterable, Optional, Tuple
+
+# Wire values for the 'c' key of a packed message. These must match Message.CompressionType.
+NONE = 0
+BZIP2 = 1
+GZIP = 2
+DEFLATE = 3
+LZMA = 4
+DICT = 5
+
+# Not a wire value. Asks the packer to try every registered codec and keep the smallest result.
+AUTO = 255
+
+
+class Codec:
+    """Base class for a compression codec. The base class is the identity codec (no compression)."""
+    type_id = NONE
+    name = "NONE"
+
+    def compress(self, data: bytes) -> bytes:
+        return bytes(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return bytes(data)
+
+    def __repr__(self):
+        return f"<{type(self).__name__}: {self.name}>"
+
+
+class Bzip2Codec(Codec):
+    type_id = BZIP2
+    name = "BZIP2"
+
+    def compress(self, data: bytes) -> bytes:
+        return bz2.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return bz2.decompress(data)
+
+
+class GzipCodec(Codec):
+    type_id = GZIP
+    name = "GZIP"
+
+    def compress(self, data: bytes) -> bytes:
+        # mtime=0 keeps the output deterministic for identical input
+        return gzip.compress(data, compresslevel=9, mtime=0)
+
+    def decompress(self, data: bytes) -> bytes:
+        return gzip.decompress(data)
+
+
+class DeflateCodec(Codec):
+    """Raw DEFLATE stream with no zlib/gzip header or checksum. Smallest fixed overhead of the stock codecs."""
+    type_id = DEFLATE
+    name = "DEFLATE"
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data, -15)
+
+
+class LzmaCodec(Codec):
+    """Raw LZMA2 stream. The .xz container is skipped because its header alone is larger than most frames."""
+    type_id = LZMA
+    name = "LZMA"
+    filters = [{'id': lzma.FILTER_LZMA2, 'preset': 9}]
+
+    def compress(self, data: bytes) -> bytes:
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=self.filters)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=self.filters)
+
+
+class DictionaryCodec(Codec):
+    """Raw DEFLATE primed with a pre-shared dictionary, so small frames can reference keys and values they have
+    never sent. The first byte of the output is the dictionary version, the rest is the DEFLATE stream."""
+    type_id = DICT
+    name = "DICT"
+
+    def compress(self, data: bytes, version: Optional[int] = None) -> bytes:
+        if version is None:
+            version = latest_dictionary_version()
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=get_dictionary(version))
+        return bytes([version]) + compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        if len(data) < 1:
+            raise ValueError("Dictionary compressed data is missing its dictionary version.")
+        decompressor = zlib.decompressobj(-15, zdict=get_dictionary(data[0]))
+        return decompressor.decompress(data[1:]) + decompressor.flush()
+
+
+_dictionaries = {}
+
+
+def register_dictionary(version: int, dictionary: bytes):
+    """Makes a pre-shared dictionary available to DICT compression. Both ends of a connection must register the
+    same bytes under the same version number. Versions are carried in a single byte."""
+    version = int(version)
+    if (version < 1) or (version > 255):
+        raise ValueError("Dictionary versions must be between 1 and 255.")
+    if (version in _dictionaries) and (_dictionaries[version] != bytes(dictionary)):
+        raise ValueError(f"A different dictionary is already registered as version {version}.")
+    _dictionaries[version] = bytes(dictionary)
+
+
+def get_dictionary(version: int) -> bytes:
+    try:
+        return _dictionaries[int(version)]
+    except KeyError:
+        raise NotImplementedError(f"Compression dictionary version {version} is not available.")
+
+
+def dictionary_versions() -> list[int]:
+    return sorted(_dictionaries)
+
+
+def latest_dictionary_version() -> int:
+    if not _dictionaries:
+        raise NotImplementedError("No compression dictionaries are registered.")
+    return max(_dictionaries)
+
+
+def negotiate_dictionary(offered: Optional[Iterable]) -> Optional[int]:
+    """Returns the newest dictionary version found both in offered and locally, or None. A peer that offers
+    nothing is assumed to hold version 1, which ships with every build that understands DICT."""
+    if offered is None:
+        offered = [1]
+    elif type(offered) not in (list, tuple, set):
+        offered = [offered]
+    common = []
+    for i in offered:
+        try:
+            if int(i) in _dictionaries:
+                common.append(int(i))
+        except (TypeError, ValueError):
+            pass
+    if common:
+        return max(common)
+    return None
+
+
+def train_dictionary(samples: Iterable[bytes], size: int = 2048, segment_length: int = 32,
+                     dmer_length: int = 6) -> bytes:
+    """Builds a DEFLATE dictionary from sample frames by greedy segment cover. Every dmer_length-byte substring
+    is scored by how many samples contain it, then the segment_length-byte window covering the most valuable
+    substrings not already in the dictionary is picked, until the dictionary is full. Earlier picks are the most
+    valuable, so they go last, where DEFLATE reaches them with the shortest distances. Output is deterministic for
+    a given corpus."""
+    samples = [bytes(s) for s in samples]
+    doc_freq = Counter()
+    for sample in samples:
+        doc_freq.update({sample[i:i + dmer_length] for i in range(0, len(sample) - dmer_length + 1)})
+
+    segments = set()
+    for sample in samples:
+        for i in range(0, max(len(sample) - segment_length, 0) + 1):
+            segments.add(sample[i:i + segment_length])
+    segments = sorted(segments)
+
+    covered = set()
+    chosen = []
+    total = 0
+    while total < size:
+        best = None
+        best_score = 0
+        for seg in segments:
+            dmers = {seg[i:i + dmer_length] for i in range(0, len(seg) - dmer_length + 1)}
+            score = sum(doc_freq[m] for m in dmers if (m not in covered) and (doc_freq[m] > 1))
+            if score > best_score:
+                best = seg
+                best_score = score
+        if best is None:
+            break
+        best = best[:size - total]
+        covered.update(best[i:i + dmer_length] for i in range(0, len(best) - dmer_length + 1))
+        chosen.append(best)
+        total = total + len(best)
+    chosen.reverse()
+    return b''.join(chosen)
+
+
+_codecs = {}
+
+
+def register_codec(codec: Codec):
+    """Adds a codec to the registry, replacing any codec already registered with the same type_id."""
+    if codec.type_id == AUTO:
+        raise ValueError(f"type_id {AUTO} is reserved for automatic codec selection.")
+    _codecs[int(codec.type_id)] = codec
+    logging.debug(f"Registered compression codec {codec}")
+
+
+def get_codec(type_id: int) -> Codec:
+    try:
+        return _codecs[int(type_id)]
+    except KeyError:
+        raise NotImplementedError(f"Compression type {type_id} is not implemented.")
+
+
+def codec_registered(type_id: int) -> bool:
+    return int(type_id) in _codecs
+
+
+def registered_codecs() -> list[Codec]:
+    return [_codecs[x] for x in sorted(_codecs)]
+
+
+def auto_candidates() -> list[int]:
+    """Codecs tried by AUTO, which is every registered codec apart from NONE."""
+    return [x for x in sorted(_codecs) if x != NONE]
+
+
+def compress_one(type_id: int, data: bytes, dictionary_version: Optional[int] = None) -> Optional[bytes]:
+    """Compresses data with a single codec. Returns None when the codec can't be used for this frame."""
+    if type_id in (NONE, AUTO):
+        return None
+    try:
+        if type_id == DICT:
+            if dictionary_version is None:
+                return None
+            return get_codec(type_id).compress(data, version=dictionary_version)
+        return get_codec(type_id).compress(data)
+    except NotImplementedError:
+        logging.debug(f"Skipping unavailable compression type {type_id}")
+        return None
+
+
+def compress_smallest(data: bytes, candidates: Optional[Iterable[int]] = None,
+                      dictionary_version: Optional[int] = None) -> Tuple[int, bytes]:
+    """Compresses data with every candidate codec and returns (type_id, output) for the smallest output.
+    Returns (NONE, data) when no candidate beats the uncompressed bytes. DICT is skipped unless
+    dictionary_version names a dictionary the receiver holds."""
+    if candidates is None:
+        candidates = auto_candidates()
+    best_type = NONE
+    best = bytes(data)
+    for type_id in candidates:
+        output = compress_one(type_id, data, dictionary_version)
+        if output is None:
+            continue
+        logging.debug(f"Compression type {type_id} packed {len(data)} bytes into {len(output)}")
+        if len(output) < len(best):
+            best_type = type_id
+            best = output
+    return best_type, best
+
+
+# Content types that are already compressed. Hinting one of these skips compression outright.
+incompressible_types = ('image/', 'video/', 'audio/', 'application/zip', 'application/gzip', 'application/x-gzip',
+                        'application/x-bzip2', 'application/x-xz', 'application/zstd', 'application/x-7z-compressed',
+                        'application/x-rar-compressed', 'application/pdf')
+
+# svg is an image/ type in name only
+compressible_exceptions = ('image/svg+xml', 'image/bmp', 'image/x-ms-bmp', 'audio/x-wav', 'audio/wav')
+
+
+def content_type_incompressible(content_type: Optional[str]) -> bool:
+    if not content_type:
+        return False
+    content_type = content_type.lower()
+    if content_type.startswith(compressible_exceptions):
+        return False
+    return content_type.startswith(incompressible_types)
+
+
+def content_type_for_name(name: str) -> Optional[str]:
+    """Guesses a content type from a file name, reporting gzip/bzip2/xz encoded files as those types."""
+    content_type, encoding = mimetypes.guess_type(name, strict=False)
+    if encoding is not None:
+        return {'gzip': 'application/gzip', 'bzip2': 'application/x-bzip2', 'xz': 'application/x-xz',
+                'compress': 'application/x-compress', 'br': 'application/x-brotli'}.get(encoding, content_type)
+    return content_type
+
+
+def estimate_entropy(data: bytes, sample_size: int = 4096, slices: int = 8) -> float:
+    """Shannon entropy in bits per byte, estimated from evenly spaced slices totalling at most sample_size bytes."""
+    if len(data) == 0:
+        return 0.0
+    if len(data) <= sample_size:
+        sample = data
+    else:
+        step = len(data) // slices
+        width = sample_size // slices
+        sample = b''.join(data[i * step:(i * step) + width] for i in range(0, slices))
+    total = len(sample)
+    return -sum((n / total) * math.log2(n / total) for n in Counter(sample).values())
+
+
+class CodecStats:
+    """Exponentially weighted average of compressed size / raw size for one codec under one hint."""
+    def __init__(self):
+        self.ratio = 1.0
+        self.samples = 0
+
+    def update(self, ratio: float, weight: float):
+        if self.samples == 0:
+            self.ratio = ratio
+        else:
+            self.ratio = (weight * ratio) + ((1 - weight) * self.ratio)
+        self.samples = self.samples + 1
+
+    def __repr__(self):
+        return f"<CodecStats: {self.ratio:.3f} over {self.samples}>"
+
+
+class CompressionPolicy:
+    """Decides which codecs are worth running on a frame.
+
+    Frames whose content type is known to be compressed, or whose sampled entropy is near 8 bits per byte, are
+    sent uncompressed without trying anything. Otherwise the policy remembers, per hint (request path and content
+    type), how well each codec has done. Once it has seen enough frames it runs only the codec predicted to be
+    smallest, or none if every codec is predicted to lose. Every probe_interval frames per hint it tries all the
+    candidates again so the predictions follow the traffic."""
+
+    def __init__(self, entropy_threshold: float = 7.5, entropy_min_size: int = 512, min_samples: int = 3,
+                 probe_interval: int = 16, weight: float = 0.25, max_hints: int = 256):
+        self.entropy_threshold = entropy_threshold
+        self.entropy_min_size = entropy_min_size
+        self.min_samples = min_samples
+        self.probe_interval = probe_interval
+        self.weight = weight
+        self.max_hints = max_hints
+        self._stats = {}
+        self._counters = Counter()
+        self._lock = Lock()
+
+    def stats(self, hint: Optional[str] = None) -> dict:
+        with self._lock:
+            return dict(self._stats.get(hint, {}))
+
+    def predicted_incompressible(self, data: bytes, content_type: Optional[str] = None) -> bool:
+        if content_type_incompressible(content_type):
+            return True
+        if len(data) >= self.entropy_min_size:
+            return estimate_entropy(data) >= self.entropy_threshold
+        return False
+
+    def plan(self, candidates: Iterable[int], hint: Optional[str] = None) -> list[int]:
+        """Narrows candidates to the codecs worth trying for a frame with this hint."""
+        candidates = list(candidates)
+        with self._lock:
+            self._counters[hint] = self._counters[hint] + 1
+            if (self._counters[hint] % self.probe_interval) == 0:
+                return candidates
+            stats = self._stats.get(hint, {})
+            predicted = {}
+            for c in candidates:
+                if (c not in stats) or (stats[c].samples < self.min_samples):
+                    return candidates
+                predicted[c] = stats[c].ratio
+        if not predicted:
+            return candidates
+        best = min(predicted, key=lambda x: predicted[x])
+        if predicted[best] >= 1.0:
+            logging.debug(f"Compression predicted to lose for hint {hint}; skipping")
+            return []
+        return [best]
+
+    def record(self, hint: Optional[str], type_id: int, raw_size: int, compressed_size: int):
+        if raw_size <= 0:
+            return
+        with self._lock:
+            if (hint not in self._stats) and (len(self._stats) >= self.max_hints):
+                return
+            codec_stats = self._stats.setdefault(hint, {})
+            codec_stats.setdefault(type_id, CodecStats()).update(compressed_size / raw_size, self.weight)
+
+    def compress(self, data: bytes, candidates: Iterable[int], hint: Optional[str] = None,
+                 content_type: Optional[str] = None, dictionary_version: Optional[int] = None) -> Tuple[int, bytes]:
+        """Like compress_smallest, but skips codecs the policy predicts will lose and learns from what it runs."""
+        candidates = [c for c in candidates if c not in (NONE, AUTO)]
+        if (DICT in candidates) and (dictionary_version is None):
+            candidates.remove(DICT)
+        if not candidates:
+            return NONE, bytes(data)
+        if self.predicted_incompressible(data, content_type):
+            logging.debug(f"Frame for hint {hint} ({content_type}) looks incompressible; sending as is")
+            return NONE, bytes(data)
+
+        best_type = NONE
+        best = bytes(data)
+        for type_id in self.plan(candidates, hint):
+            output = compress_one(type_id, data, dictionary_version)
+            if output is None:
+                continue
+            self.record(hint, type_id, len(data), len(output))
+            if len(output) < len(best):
+                best_type = type_id
+                best = output
+        return best_type, best
+
+
+default_policy = CompressionPolicy()
+
+
+def decompress(type_id: int, data: bytes) -> bytes:
+    return get_codec(type_id).decompress(data)
+
+
+for _codec in (Codec(), Bzip2Codec(), GzipCodec(), DeflateCodec(), LzmaCodec(), DictionaryCodec()):
+    register_codec(_codec)
@@ -1,2 +1,15 @@
 no_values = [0, '0', 'n', 'N', 'f', 'F', 'no', 'NO', False]
 yes_values = [1, '1', 'y', 'Y', 't', 'T', 'yes', 'YES', True]
+
+# listing pagination: the request var carrying a cursor, and the response var carrying the next one
+cursor_var = 'cursor'
+next_cursor_var = 'next_cursor'
+
+# payloads at least this big are stored once per content on the server, so clients offer their sha256 first
+stored_payload_min_size = 16384
+
+# conditional GETs: the response vars carrying a collection's version and etag, and the request vars sending them back
+version_var = 'version'
+etag_var = 'etag'
+if_version_var = 'if_version'
+if_none_match_var = 'if_none_match'
@@ -0,0 +1,170 @@
+"""rsync style block signatures and deltas, so an edit to a large object only sends the blocks that changed.
+
+The receiver of an update publishes signatures of its copy: a weak rolling checksum and a short strong hash per
+block. The sender slides a window over its new version, looks each window up by weak checksum, confirms with the
+strong hash, and emits a delta. A delta is a list of ops. Each op is either bytes (literal data) or [first block,
+block count] (copy that many blocks from the old copy)."""
+import hashlib
+import math
+from typing import Union, Optional
+
+MOD = 1 << 16
+min_block_size = 256
+max_block_size = 65536
+
+
+class DeltaError(ValueError):
+    """Raised for a delta or block size that can't be applied to any copy: the request was malformed, rather than
+    made against data that has since changed."""
+    pass
+
+
+def default_block_size(size: int) -> int:
+    """Block size that roughly balances signature overhead against literal data for a one-spot edit."""
+    if size <= 0:
+        return min_block_size
+    target = 4 * math.sqrt(size)
+    return int(min(max_block_size, max(min_block_size, 2 ** math.ceil(math.log2(target)))))
+
+
+def weak_checksum(block: bytes) -> int:
+    a = 0
+    b = 0
+    n = len(block)
+    for i, byte in enumerate(block):
+        a = a + byte
+        b = b + ((n - i) * byte)
+    return ((b % MOD) << 16) | (a % MOD)
+
+
+def strong_hash(block: bytes) -> bytes:
+    return hashlib.blake2b(block, digest_size=8).digest()
+
+
+class RollingChecksum:
+    """The weak checksum of a fixed size window, updated in constant time as the window slides one byte."""
+
+    def __init__(self, window: bytes):
+        self.size = len(window)
+        self.a = sum(window) % MOD
+        self.b = sum((self.size - i) * byte for i, byte in enumerate(window)) % MOD
+
+    @property
+    def digest(self) -> int:
+        return (self.b << 16) | self.a
+
+    def roll(self, out_byte: int, in_byte: int):
+        self.a = (self.a - out_byte + in_byte) % MOD
+        self.b = (self.b - (self.size * out_byte) + self.a) % MOD
+
+
+def signatures(data: bytes, block_size: Optional[int] = None) -> dict:
+    """Signatures of data as sent over the wire: block size, total size, sha256 and [weak, strong] per block."""
+    if block_size is None:
+        block_size = default_block_size(len(data))
+    sigs = []
+    for offset in range(0, len(data), block_size):
+        block = data[offset:offset + block_size]
+        sigs.append([weak_checksum(block), strong_hash(block)])
+    return {'block_size': block_size, 'size': len(data), 'sha256': hashlib.sha256(data).digest(), 'blocks': sigs}
+
+
+def _add_copy(delta: list, index: int):
+    if delta and (type(delta[-1]) is list) and (delta[-1][0] + delta[-1][1] == index):
+        delta[-1][1] = delta[-1][1] + 1
+    else:
+        delta.append([index, 1])
+
+
+def _add_literal(delta: list, data: Union[bytes, bytearray]):
+    if not data:
+        return
+    if delta and (type(delta[-1]) is bytes):
+        delta[-1] = delta[-1] + bytes(data)
+    else:
+        delta.append(bytes(data))
+
+
+def compute_delta(sigs: dict, data: bytes) -> list:
+    """Builds the delta that turns the signed data into data."""
+    block_size = int(sigs['block_size'])
+    blocks = sigs['blocks']
+    if (len(blocks) == 0) or (len(data) == 0):
+        return [bytes(data)] if data else []
+
+    # the last block is usually short and can only match at the very end of data
+    tail_index = None
+    tail_size = int(sigs['size']) - ((len(blocks) - 1) * block_size)
+    if tail_size < block_size:
+        tail_index = len(blocks) - 1
+
+    table = {}
+    for index, (weak, strong) in enumerate(blocks):
+        if index == tail_index:
+            continue
+        table.setdefault(weak, []).append((strong, index))
+
+    delta = []
+    literal = bytearray()
+    pos = 0
+    rolling = None
+    while pos + block_size <= len(data):
+        if rolling is None:
+            rolling = RollingChecksum(data[pos:pos + block_size])
+        match = None
+        candidates = table.get(rolling.digest)
+        if candidates:
+            strong = strong_hash(data[pos:pos + block_size])
+            for candidate, index in candidates:
+                if candidate == strong:
+                    match = index
+                    break
+        if match is not None:
+            _add_literal(delta, literal)
+            literal = bytearray()
+            _add_copy(delta, match)
+            pos = pos + block_size
+            rolling = None
+            continue
+        literal.append(data[pos])
+        if pos + block_size < len(data):
+            rolling.roll(data[pos], data[pos + block_size])
+        pos = pos + 1
+
+    rest = data[pos:]
+    if (tail_index is not None) and (len(rest) >= tail_size) and (tail_size > 0):
+        tail = rest[len(rest) - tail_size:]
+        weak, strong = blocks[tail_index]
+        if (weak_checksum(tail) == weak) and (strong_hash(tail) == strong):
+            literal.extend(rest[:len(rest) - tail_size])
+            _add_literal(delta, literal)
+            _add_copy(delta, tail_index)
+            return delta
+    literal.extend(rest)
+    _add_literal(delta, literal)
+    return delta
+
+
+def apply_delta(old: bytes, delta: list, block_size: int) -> bytes:
+    """Rebuilds the new data from the old copy and a delta. Raises DeltaError for a block size that isn't a
+    positive integer and for ops that are malformed or don't fit old."""
+    if (type(block_size) is not int) or (block_size <= 0):
+        raise DeltaError(f"Delta block size must be a positive integer, not {block_size!r}")
+    block_count = math.ceil(len(old) / block_size)
+    out = bytearray()
+    for op in delta:
+        if type(op) in (bytes, bytearray):
+            out.extend(op)
+        elif (type(op) in (list, tuple)) and (len(op) == 2) and all(type(i) is int for i in op):
+            first, count = op
+            if (first < 0) or (count < 0) or (first + count > block_count):
+                raise DeltaError(f"Delta copies blocks {first}-{first + count - 1} of only {block_count}")
+            out.extend(old[first * block_size:(first + count) * block_size])
+        else:
+            raise DeltaError(f"Unknown delta op {op!r}")
+    return bytes(out)
+
+
+def delta_literal_size(delta: list) -> int:
+    """Literal bytes in a delta, the part that can't be copied from the receiver's old copy."""
+    return sum(len(op) for op in delta if type(op) in (bytes, bytearray))
@@ -0,0 +1,48 @@
+"""Pre-shared compression dictionaries for DICT compression.
+
+A dictionary version can never change once released, because peers decode with whatever bytes they hold for that
+version number. New dictionaries get a new version, are trained with compression.train_dictionary() from a corpus of
+frames captured from a real client session (examples/misc/capture-dictionary-corpus.py), and are registered on both
+clients and servers."""
+import base64
+import msgpack
+from typing import Iterable
+from packetserver.common import compression
+
+
+def corpus_from_log(request_log: Iterable) -> list[bytes]:
+    """The packed message bodies (Message.data_bytes) of each request and response in a Client.request_log, the
+    samples train_dictionary() takes."""
+    samples = []
+    for req, resp in request_log:
+        for msg in (req, resp):
+            if msg is not None:
+                samples.append(msg.data_bytes)
+    return samples
+
+
+def load_corpus(path: str) -> list[bytes]:
+    """Reads a corpus saved by capture-dictionary-corpus.py."""
+    with open(path, 'rb') as f:
+        return [bytes(s) for s in msgpack.unpackb(f.read())]
+
+
+# Output of compression.train_dictionary(load_corpus("examples/misc/dictionary-corpus-v1.msgpack"), size=1024).
+DICTIONARY_V1 = base64.b64decode(
+    "MyKjcjQ6MDY6NTMuMjgxMjg5KzAwOjAwq21vZGlmaWVkX2F0JDgwOTk3NGI5LWUzMWMtNDdlMy05MjgyLWJmYjI3N2FldGNoX2F0dGFj"
+    "aG1lbnRzw6Rzb3J0pGRhdGWjcmlkCpCmbXNnX2lk2SQ1MDFlYzhjYS1hNDZiLTQxNTEtYjYwMDA6MDCtaW5jbHVkZXNfZGF0YcOkZGF0"
+    "YaxIZWxsbyABpHV1aWTEEJEf/ytsa0CzjpHnWdy57v2jcmlkD6FwpoOhcKR1c2VyoXaCpWxpbWl0CqNyaWQEoW3EAQA3VDA0OjA3OjAy"
+    "LjI5OTQyNiswMDowMKp1cGRhdGVkX1E0UEVEpktRNFBFQ6Rmcm9tpktRNFBFQ6JpZNkkZWNmomlkAKZhdXRob3KmS1E0UEVDp3N1Ympl"
+    "Y3SrTmV0IHRsby13b3JsZC50eHSqdXVpZF9ieXRlc8QQGsLTsjcKR2Jpb71PcGVyYXRpbmcgcG9ydGFibGUgdGhpcyB3ZWVrLqdzb2Np"
+    "YWxzkKVlbWFpbKCobG9jYXRpb26kRU03M6mhY8QCAMmhZIOpc3VjY2Vzc2VzAaZmYWlsZWSQpm1zZ2SlbGltaXQKqmZldGNoX3RleHTD"
+    "p3JldmVyc2XDsWZliKh1c2VybmFtZaZLUTRQRUOmc3RhdHVzqVFSViBvbiAgbGFzdCBuaWdodCBhdHRhY2hlZC6idG+SpktRNFBFQ21l"
+    "bnRzkYSkbmFtZapuZXRsb2cudHh0pmJpbmFyecOqJGVjZmMzMmJhLTUzZDAtNDNlMS05MmYzLTE4YWE2NzUkNDk4MmZhYTEtNzc3My00"
+    "MGEwLTg2MWMtZjcyYTFkOIOhcKdtZXNzYWdloW3EAQChdoemc291cmNlqHJlY2VpdGV4dLtUZXN0aW5nIHRoZSBuZXcgbWFpbGJveC4g"
+    "NzNOZXQgdG9uaWdodKRib2R52StDaGVjayBpbiBhdCA4cDcrMDA6MDCkdGV4dNkiTG9nIGZpbGUgZnJvbSBsYXN0IDhwbSBsb2NhbCBv"
+    "biB0aGUgY2x1YiByZXBlYXRlci5zGqRkYXRhxBoyMDowMCBLUTRQRUQKMjA6MDIgS1E0UKpzaXplX2J5dGVzDKZiaW5hcnnCp3ByaXZh"
+    "dGXDqmNyhKFwpm9iamVjdKFtxAEBoWSEpG5hbWWvaGVsbG8td28wMzekZXRhZ9kjImJ1bGxldGlucy1jNjRhNjkxYS0xLoOhY8QCAMih"
+    "doOndmVyc2lvbq42LmUyZjQ0ZGQ2NjA4onRvkaZLUTRQRUOrYXR0YWNobWVudHOQoXaBo3JpZAguqmNyZWF0ZWRfYXTZIDIwMjYtMTAt"
+    "MTdUMDQ6MDY6NA=="
+)
+
+compression.register_dictionary(1, DICTIONARY_V1)
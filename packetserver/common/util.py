@@ -1,5 +1,6 @@
 import re
 import datetime
+import hashlib
 import tempfile
 import tarfile
 from typing import Union, Iterable, Tuple, Optional, IO
@@ -246,4 +247,89 @@ def is_valid_base_ax25_callsign(base_call: str) -> bool:
     if not base_call:
         return False
     base_call = base_call.strip().upper()
-    return bool(_BASE_CALLSIGN_REGEX.match(base_call))
\ No newline at end of file
+    return bool(_BASE_CALLSIGN_REGEX.match(base_call))
+
+
+def parse_byte_range(req_vars: dict) -> Optional[Tuple[int, Optional[int]]]:
+    """Reads a byte range from request vars as (offset, length), where a length of None means to the end.
+
+    Accepts 'offset' and/or 'length' vars, or a 'range' var holding either an HTTP style 'start-end' string
+    (end inclusive, 'start-' for the rest) or an [offset, length] list. Returns None when no range was asked for.
+    Raises ValueError for a malformed range."""
+    if 'range' in req_vars:
+        rng = req_vars['range']
+        if type(rng) in (list, tuple):
+            if len(rng) != 2:
+                raise ValueError("range list must be [offset, length]")
+            offset, length = rng
+        else:
+            rng = str(rng).strip()
+            if rng.lower().startswith("bytes="):
+                rng = rng[6:]
+            if "-" not in rng:
+                raise ValueError("range must look like 'start-end' or 'start-'")
+            start, end = rng.split("-", 1)
+            offset = int(start)
+            length = None if end.strip() == "" else (int(end) - offset + 1)
+    elif ('offset' in req_vars) or ('length' in req_vars):
+        offset = req_vars.get('offset', 0)
+        length = req_vars.get('length')
+    else:
+        return None
+    offset = int(offset)
+    if length is not None:
+        length = int(length)
+        if length < 0:
+            raise ValueError("range length can't be negative")
+    if offset < 0:
+        raise ValueError("range offset can't be negative")
+    return offset, length
+
+def byte_range_payload(data: bytes, byte_range: Tuple[int, Optional[int]], sha256: Optional[bytes] = None) -> dict:
+    """Slices data for a ranged GET. The sha256 is of the whole of data, so a resumed download can be checked
+    once it's put back together; pass it in when it's already known, rather than hashing data for every piece.
+    Raises IndexError if the range starts past the end of data."""
+    offset, length = byte_range
+    if (offset > len(data)) or ((offset == len(data)) and (len(data) > 0)):
+        raise IndexError(f"Range offset {offset} is beyond the {len(data)} bytes available")
+    if length is None:
+        piece = data[offset:]
+    else:
+        piece = data[offset:offset + length]
+    return {'offset': offset, 'length': len(piece), 'total_size': len(data),
+            'sha256': sha256 or hashlib.sha256(data).digest(), 'data': piece}
+
+def requested_fields(req_vars: dict) -> Optional[list]:
+    """The keys asked for with a 'fields' var, given as a list or a comma separated string. None means all."""
+    fields = req_vars.get('fields')
+    if fields is None:
+        return None
+    if type(fields) in (list, tuple):
+        fields = [str(f).strip() for f in fields]
+    else:
+        fields = [f.strip() for f in str(fields).split(",")]
+    fields = [f for f in fields if f]
+    return fields or None
+
+def project_fields(payload, fields: list):
+    """Keeps only fields in a dict payload, or in each dict of a list payload. Anything else passes through."""
+    if type(payload) is dict:
+        return {k: payload[k] for k in fields if k in payload}
+    if type(payload) is list:
+        return [project_fields(row, fields) if type(row) is dict else row for row in payload]
+    return payload
+
+def compact_rows(rows: list, fields: Optional[list] = None) -> dict:
+    """A list of dicts as {'k': keys, 'r': [[values in key order], ...]}, so each key is sent once instead of once
+    per row. Rows missing a key get None in its place."""
+    if fields is None:
+        fields = []
+        for row in rows:
+            for k in row:
+                if k not in fields:
+                    fields.append(k)
+    return {'k': list(fields), 'r': [[row.get(k) for k in fields] for row in rows]}
+
+def expand_rows(compact: dict) -> list:
+    keys = compact['k']
+    return [dict(zip(keys, row)) for row in compact['r']]
@@ -8,6 +8,7 @@ import time
 from persistent.mapping import PersistentMapping
 from persistent.list import PersistentList
 from packetserver.common.util import is_valid_ax25_callsign
+from packetserver.server.users import blacklist_add, blacklist_remove
 from .database import DbDependency
 from typing import Union
 from ZODB.Connection import Connection
@@ -78,20 +79,15 @@ class HttpUser(Persistent):
         with db.transaction() as conn:
             root = conn.root()
             config = root.setdefault('config', PersistentMapping())
-            blacklist = config.setdefault('blacklist', PersistentList())
 
             upper_name = self.username
 
             if allow:
                 if not is_valid_ax25_callsign(upper_name):
                     raise ValueError(f"{upper_name} is not a valid AX.25 callsign – cannot enable RF access")
-                if upper_name in blacklist:
-                    blacklist.remove(upper_name)
-                    blacklist._p_changed = True
+                blacklist_remove(upper_name, root)
             else:
-                if upper_name not in blacklist:
-                    blacklist.append(upper_name)
-                    blacklist._p_changed = True
+                blacklist_add(upper_name, root)
 
             config._p_changed = True
             root._p_changed = True
@@ -0,0 +1,47 @@
+# packetserver/http/conditional.py
+"""ETag headers and 304 answers for API GET routes, from the collection versions the RF handlers use."""
+from typing import Optional
+
+from fastapi import Request, Response
+from persistent.mapping import PersistentMapping
+
+from packetserver.server.versions import collection_version, etag_matches, request_scope
+
+# authenticated, per-user data: browsers may keep it, but must check the etag before reusing it
+cache_control = "private, no-cache"
+# the same URL answers differently for each signed in user
+vary = "Authorization, Cookie"
+
+
+def http_scope(request: Optional[Request], username: Optional[str] = None) -> str:
+    """The request's scope: its path and query parameters, and the signed in user for routes answering with a
+    user's own data, so a cached copy never matches a different query or another user's request."""
+    if request is None:
+        return request_scope(username, "")
+    return request_scope(username, request.url.path, dict(request.query_params))
+
+
+def not_modified(request: Optional[Request], root: PersistentMapping, name: str,
+                 username: Optional[str] = None) -> Optional[Response]:
+    """A bodiless 304 when the request's If-None-Match covers the named collection's current etag, else None."""
+    if request is None:
+        return None
+    etag = collection_version(root, name, http_scope(request, username))[1]
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=etag_headers(request, root, name, username))
+    return None
+
+
+def etag_headers(request: Optional[Request], root: PersistentMapping, name: str,
+                 username: Optional[str] = None) -> dict:
+    """Headers for a response the route builds itself."""
+    etag = collection_version(root, name, http_scope(request, username))[1]
+    return {"ETag": etag, "Cache-Control": cache_control, "Vary": vary}
+
+
+def set_etag(response: Optional[Response], request: Optional[Request], root: PersistentMapping, name: str,
+             username: Optional[str] = None):
+    """Puts the named collection's etag on the response FastAPI injected into a route."""
+    if response is None:
+        return
+    response.headers.update(etag_headers(request, root, name, username))
@@ -7,6 +7,8 @@ class Settings(BaseSettings):
     # Define your settings fields with type hints and optional default values
     name: str = "PacketServer"
     zeo_file: str
+    # the server's blob directory; defaults to 'blobs' beside zeo_file, which the server writes into its data dir
+    blob_dir: str | None = None
     operator: str | None = None
     debug_mode: bool = False
     log_level: str = "info"
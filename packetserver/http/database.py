@@ -2,7 +2,7 @@ from copy import deepcopy
 
 from fastapi import Depends
 from typing import Annotated, Generator
-from os.path import isfile
+from os.path import isfile, join, dirname, abspath
 
 import ZEO
 import ZODB
@@ -42,7 +42,8 @@ def init_db() -> ZODB.DB:
         return _db
 
     host, port = _get_zeo_address(settings.zeo_file)
-    _db = ZEO.DB((host, port))
+    blob_dir = settings.blob_dir or join(dirname(abspath(settings.zeo_file)), "blobs")
+    _db = ZEO.DB((host, port), blob_dir=blob_dir, shared_blob_dir=True)
     return _db
 
 def get_db() -> ZODB.DB:
@@ -1,19 +1,21 @@
 from fastapi import APIRouter, Path, Query, Depends, HTTPException, Request, status, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
-from typing import Optional, List
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
+from typing import Optional, List, Iterable
 from pydantic import BaseModel, Field, constr
 from datetime import datetime
 import transaction
-from persistent.list import PersistentList
 from ZODB.Connection import Connection
 import logging
 
 from packetserver.http.database import DbDependency
+from packetserver.http.conditional import not_modified, set_etag
 from ..dependencies import get_current_http_user
 from ..auth import HttpUser
 from ..server import templates
 
 from packetserver.server.bulletin import Bulletin
+from packetserver.server.bulletin_store import get_bulletin, query_bulletins
+from packetserver.server.listing import decode_cursor, check_key
 
 # API router (/api/v1)
 router = APIRouter(prefix="/api/v1", tags=["bulletins"])
@@ -23,15 +25,18 @@ html_router = APIRouter(tags=["bulletins-html"])
 
 # --- API Endpoints ---
 
-async def list_bulletins(connection: Connection, limit: int = 50, since: Optional[datetime] = None) -> dict:
+async def list_bulletins(connection: Connection, limit: int = 50, since: Optional[datetime] = None,
+                         search: Optional[str] = None, cursor: Optional[str] = None) -> dict:
     root = connection.root()
-    bulletins_list: List[Bulletin] = root.get("bulletins", [])
-
+    try:
+        after = decode_cursor("bulletin_created", cursor) if cursor else None
+        if after is not None:
+            check_key(after, int, int)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     # Newest first
-    bulletins_list = sorted(bulletins_list, key=lambda b: b.created_at, reverse=True)
-
-    if since:
-        bulletins_list = [b for b in bulletins_list if b.created_at > since]
+    bulletins_list, next_cursor = query_bulletins(root, order="created", after=after, limit=limit, search=search,
+                                                  since=since)
 
     bulletins = [
         {
@@ -42,42 +47,54 @@ async def list_bulletins(connection: Connection, limit: int = 50, since: Optiona
             "created_at": b.created_at.isoformat() + "Z",
             "updated_at": b.updated_at.isoformat() + "Z",
         }
-        for b in bulletins_list[:limit]
+        for b in bulletins_list
     ]
 
-    return {"bulletins": bulletins}
+    return {"bulletins": bulletins, "next_cursor": next_cursor}
 
 @router.get("/bulletins")
 async def api_list_bulletins(
     db: DbDependency,
     limit: Optional[int] = Query(50, le=100),
     since: Optional[datetime] = None,
+    search: Optional[str] = Query(None, description="Words to look for; each matches the start of a word"),
+    cursor: Optional[str] = None,
+    request: Request = None,
+    response: Response = None,
 ):
     with db.transaction() as conn:
-        return await list_bulletins(conn, limit=limit, since=since)
+        cached = not_modified(request, conn.root(), 'bulletins')
+        if cached is not None:
+            return cached
+        set_etag(response, request, conn.root(), 'bulletins')
+        return await list_bulletins(conn, limit=limit, since=since, search=search, cursor=cursor)
 
 async def get_one_bulletin(connection: Connection, bid: int) -> dict:
     root = connection.root()
-    bulletins_list: List[Bulletin] = root.get("bulletins", [])
-
-    for b in bulletins_list:
-        if b.id == bid:
-            return {
-                "id": b.id,
-                "author": b.author,
-                "subject": b.subject,
-                "body": b.body,
-                "created_at": b.created_at.isoformat() + "Z",
-                "updated_at": b.updated_at.isoformat() + "Z",
-            }
-    raise HTTPException(status_code=404, detail="Bulletin not found")
+    b = get_bulletin(bid, root)
+    if b is None:
+        raise HTTPException(status_code=404, detail="Bulletin not found")
+    return {
+        "id": b.id,
+        "author": b.author,
+        "subject": b.subject,
+        "body": b.body,
+        "created_at": b.created_at.isoformat() + "Z",
+        "updated_at": b.updated_at.isoformat() + "Z",
+    }
 
 @router.get("/bulletins/{bid}")
 async def api_get_bulletin(
     db: DbDependency,
     bid: int,
+    request: Request = None,
+    response: Response = None,
 ):
     with db.transaction() as conn:
+        cached = not_modified(request, conn.root(), 'bulletins')
+        if cached is not None:
+            return cached
+        set_etag(response, request, conn.root(), 'bulletins')
         return await get_one_bulletin(conn, bid)
 
 class CreateBulletinRequest(BaseModel):
@@ -93,9 +110,6 @@ async def create_bulletin(
     with db.transaction() as conn:
         root = conn.root()
 
-        if 'bulletins' not in root:
-            root['bulletins'] = PersistentList()
-
         new_bulletin = Bulletin(
             author=current_user.username,
             subject=payload.subject.strip(),
@@ -164,9 +178,6 @@ async def bulletin_new_submit(
     with db.transaction() as conn:
         root = conn.root()
 
-        if 'bulletins' not in root:
-            root['bulletins'] = PersistentList()
-
         new_bulletin = Bulletin(
             author=current_user.username,
             subject=subject.strip(),
@@ -203,14 +214,7 @@ async def delete_bulletin(
     try:
         with db.transaction() as conn:
             root = conn.root()
-            bulletins_list: PersistentList = root.get("bulletins", PersistentList())
-
-            # Find the bulletin
-            bulletin_to_delete = None
-            for b in bulletins_list:
-                if b.id == bid:
-                    bulletin_to_delete = b
-                    break
+            bulletin_to_delete = get_bulletin(bid, root)
 
             if not bulletin_to_delete:
                 raise HTTPException(status_code=404, detail="Bulletin not found")
@@ -219,7 +223,7 @@ async def delete_bulletin(
                 raise HTTPException(status_code=403, detail="Not authorized to delete this bulletin")
 
             # Remove it
-            bulletins_list.remove(bulletin_to_delete)
+            Bulletin.delete(bulletin_to_delete, root)
 
             logging.info(f"User {username} deleted bulletin {bid}")
 
@@ -25,7 +25,8 @@ async def dashboard(
         current_user=current_user,
         type="all",
         limit=100,
-        since=None  # prevents Query wrapper
+        since=None,  # prevents Query wrapper
+        search=None
     )
     with db.transaction() as conn:
         # Internal call – pass explicit defaults to avoid Query object injection
@@ -1,5 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, Form, UploadFile, File
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
 from typing import List, Optional, Union, Tuple, Dict, Any
 from pydantic import BaseModel
 from datetime import datetime
@@ -10,7 +10,9 @@ from traceback import format_exc
 from packetserver.http.dependencies import get_current_http_user
 from packetserver.http.auth import HttpUser
 from packetserver.http.database import DbDependency
+from packetserver.http.conditional import not_modified, set_etag
 from packetserver.server.jobs import Job, JobStatus
+from packetserver.server.listing import decode_cursor, check_key, page
 from packetserver.http.server import templates
 from packetserver.runner import RunnerFile
 
@@ -44,17 +46,34 @@ class JobCreate(BaseModel):
 @router.get("/jobs", response_model=List[JobSummary])
 async def list_user_jobs(
     db: DbDependency,
-    current_user: HttpUser = Depends(get_current_http_user)
+    current_user: HttpUser = Depends(get_current_http_user),
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    response: Response = None,
+    request: Request = None
 ):
+    """Newest first. With limit set, the cursor for the next page comes back in the X-Next-Cursor header."""
     username = current_user.username.upper().strip()
+    try:
+        after = decode_cursor("job", cursor) if cursor else None
+        if after is not None:
+            check_key(after, int)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     try:
         with db.transaction() as conn:
             root = conn.root()
-            user_jobs = Job.get_jobs_by_username(username, root)
-
-            # Sort newest first
-            user_jobs.sort(key=lambda j: j.created_at, reverse=True)
+            cached = not_modified(request, root, 'jobs', username)
+            if cached is not None:
+                return cached
+            set_etag(response, request, root, 'jobs', username)
+            # job ids only grow, so newest first is highest id first
+            jids = sorted(root['user_jobs'].get(username, ()), reverse=True)
+            jids, next_cursor = page(jids, lambda jid: (jid,), after=after, limit=limit, reverse=True, kind="job")
+            if (next_cursor is not None) and (response is not None):
+                response.headers["X-Next-Cursor"] = next_cursor
+            user_jobs = [Job.get_job_by_id(jid, root) for jid in jids]
 
             summaries = []
             for j in user_jobs:
@@ -80,7 +99,9 @@ async def list_user_jobs(
 async def get_job_detail(
     jid: int,
     db: DbDependency,
-    current_user: HttpUser = Depends(get_current_http_user)
+    current_user: HttpUser = Depends(get_current_http_user),
+    request: Request = None,
+    response: Response = None
 ):
     username = current_user.username.upper().strip()
 
@@ -94,6 +115,11 @@ async def get_job_detail(
             if job.owner != username:
                 raise HTTPException(status_code=403, detail="Not authorized to view this job")
 
+            cached = not_modified(request, root, 'jobs', username)
+            if cached is not None:
+                return cached
+            set_etag(response, request, root, 'jobs', username)
+
             job_dict = job.to_dict(include_data=True, binary_safe=True)
 
             return JobDetail(
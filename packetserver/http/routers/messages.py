@@ -1,8 +1,9 @@
 # packetserver/http/routers/messages.py
 from fastapi import APIRouter, Depends, Query, HTTPException, Path, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 from typing import Optional
 from datetime import datetime
+from uuid import UUID
 from persistent.mapping import PersistentMapping
 import persistent.list
 import transaction
@@ -11,6 +12,11 @@ from pydantic import BaseModel, Field, validator
 from packetserver.http.dependencies import get_current_http_user
 from packetserver.http.auth import HttpUser
 from packetserver.http.database import DbDependency
+from packetserver.http.conditional import not_modified, set_etag
+from packetserver.server.messages import open_mailbox, check_message_cursor, mark_retrieved as mark_retrieved_msg
+from packetserver.server.messages import delete_message as delete_mailbox_message
+from packetserver.server.listing import decode_cursor, micros, page, top_page
+from itertools import takewhile
 
 
 html_router = APIRouter(tags=["messages-html"])
@@ -26,6 +32,12 @@ class MarkRetrievedRequest(BaseModel):
             raise ValueError("retrieved must be true")
         return v
 
+def find_message(mailbox, msg_id: str):
+    try:
+        return mailbox.get(UUID(msg_id))
+    except ValueError:
+        return None
+
 
 @router.get("/messages")
 async def get_messages(
@@ -34,7 +46,10 @@ async def get_messages(
     type: str = Query("received", description="received, sent, or all"),
     limit: Optional[int] = Query(20, le=100, description="Max messages to return (default 20, max 100)"),
     since: Optional[str] = Query(None, description="ISO UTC timestamp filter (e.g. 2025-12-01T00:00:00Z)"),
-
+    search: Optional[str] = Query(None, description="Words to look for; each matches the start of a word"),
+    cursor: Optional[str] = None,
+    request: Request = None,
+    response: Response = None,
 ):
     if limit is None or limit < 1:
         limit = 20
@@ -42,13 +57,12 @@ async def get_messages(
     username = current_user.username
     with db.transaction() as conn:
         root = conn.root()
+        cached = not_modified(request, root, 'messages', username)
+        if cached is not None:
+            return cached
+        set_etag(response, request, root, 'messages', username)
 
-        if 'messages' not in root:
-            root['messages'] = PersistentMapping()
-        if username not in root['messages']:
-            root['messages'][username] = persistent.list.PersistentList()
-
-        mailbox = root['messages'][username]
+        mailbox = open_mailbox(username, root)
 
         since_dt = None
         if since:
@@ -57,15 +71,34 @@ async def get_messages(
             except ValueError:
                 raise HTTPException(status_code=400, detail="Invalid 'since' format")
 
-        messages = []
-        for msg in mailbox:
-            if type == "received" and msg.msg_from == username:
-                continue
-            if type == "sent" and msg.msg_from != username:
-                continue
-            if since_dt and msg.sent_at < since_dt:
-                continue
+        try:
+            after = decode_cursor("message", cursor) if cursor else None
+            if after is not None:
+                check_message_cursor(after, "date")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        # newest first, walking back from the cursor; search hits come in no order, so a heap picks the page
+        if search:
+            candidates = mailbox.search(search, root)
+            if since_dt:
+                since_micros = micros(since_dt)
+                candidates = (m for m in candidates if mailbox.key_for(m)[0] >= since_micros)
+        else:
+            candidates = mailbox.newest_first(before=after)
+            if since_dt:
+                since_micros = micros(since_dt)
+                candidates = takewhile(lambda m: mailbox.key_for(m)[0] >= since_micros, candidates)
+        if type == "received":
+            candidates = (m for m in candidates if m.msg_from != username)
+        elif type == "sent":
+            candidates = (m for m in candidates if m.msg_from == username)
+        select = top_page if search else page
+        page_msgs, next_cursor = select(candidates, mailbox.key_for, after=after, limit=limit, reverse=True,
+                                        kind="message")
 
+        messages = []
+        for msg in page_msgs:
             messages.append({
                 "id": str(msg.msg_id),
                 "from": msg.msg_from,
@@ -76,44 +109,41 @@ async def get_messages(
                 "retrieved": msg.retrieved,
             })
 
-        messages.sort(key=lambda m: m["sent_at"], reverse=True)
-
-        return {"messages": messages[:limit], "total_returned": len(messages[:limit])}
+        return {"messages": messages, "total_returned": len(messages), "next_cursor": next_cursor}
 
 @router.get("/messages/{msg_id}")
 async def get_message(
     db: DbDependency,
     msg_id: str = Path(..., description="UUID of the message (as string)"),
     mark_retrieved: bool = Query(False, description="If true, mark message as retrieved/read"),
-    current_user: HttpUser = Depends(get_current_http_user)
+    current_user: HttpUser = Depends(get_current_http_user),
+    request: Request = None,
+    response: Response = None,
 ):
     with db.transaction() as conn:
         root = conn.root()
 
         username = current_user.username
+        # marking it retrieved is a write, so that has to go through
+        if not mark_retrieved:
+            cached = not_modified(request, root, 'messages', username)
+            if cached is not None:
+                return cached
 
-        messages_root = root.get('messages', {})
-        mailbox = messages_root.get(username)
-        if not mailbox:
+        if username not in root.get('messages', {}):
             raise HTTPException(status_code=404, detail="Mailbox not found")
+        mailbox = open_mailbox(username, root)
 
-        # Find message by ID
-        target_msg = None
-        for msg in mailbox:
-            if str(msg.msg_id) == msg_id:
-                target_msg = msg
-                break
+        target_msg = find_message(mailbox, msg_id)
 
         if not target_msg:
             raise HTTPException(status_code=404, detail="Message not found")
 
         # Optionally mark as retrieved
-        if mark_retrieved and not target_msg.retrieved:
-            target_msg.retrieved = True
-            target_msg._p_changed = True
-            mailbox._p_changed = True
+        if mark_retrieved and mark_retrieved_msg(target_msg, root):
             # Explicit transaction for the write
             transaction.get().commit()
+        set_etag(response, request, root, 'messages', username)
 
         return {
             "id": str(target_msg.msg_id),
@@ -137,16 +167,11 @@ async def mark_message_retrieved(
         root = conn.root()
 
         username = current_user.username
-        mailbox = root.get('messages', {}).get(username)
-
-        if not mailbox:
+        if username not in root.get('messages', {}):
             raise HTTPException(status_code=404, detail="Mailbox not found")
+        mailbox = open_mailbox(username, root)
 
-        target_msg = None
-        for msg in mailbox:
-            if str(msg.msg_id) == msg_id:
-                target_msg = msg
-                break
+        target_msg = find_message(mailbox, msg_id)
 
         if not target_msg:
             raise HTTPException(status_code=404, detail="Message not found")
@@ -155,13 +180,31 @@ async def mark_message_retrieved(
             # Already marked – idempotent success
             return {"status": "already_retrieved", "id": msg_id}
 
-        target_msg.retrieved = True
-        target_msg._p_changed = True
-        mailbox._p_changed = True
+        mark_retrieved_msg(target_msg, root)
         transaction.get().commit()
 
         return {"status": "marked_retrieved", "id": msg_id}
 
+@router.delete("/messages/{msg_id}", status_code=204)
+async def delete_message(
+    db: DbDependency,
+    msg_id: str = Path(..., description="Message UUID as string"),
+    current_user: HttpUser = Depends(get_current_http_user)
+):
+    try:
+        target_id = UUID(msg_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid message ID")
+
+    with db.transaction() as conn:
+        root = conn.root()
+
+        # the message body, and any attachment data, goes once the last mailbox holding it lets go
+        if not delete_mailbox_message(current_user.username, target_id, root):
+            raise HTTPException(status_code=404, detail="Message not found")
+
+    return None
+
 @html_router.get("/messages", response_class=HTMLResponse)
 async def message_list_page(
     db: DbDependency,
@@ -172,7 +215,8 @@ async def message_list_page(
 ):
     from packetserver.http.server import templates
     # Directly call the existing API endpoint function
-    api_resp = await get_messages(db, current_user=current_user, type=type, limit=limit, since=None)
+    api_resp = await get_messages(db, current_user=current_user, type=type, limit=limit, since=None,
+                                  search=None)
     messages = api_resp["messages"]
 
     return templates.TemplateResponse(
@@ -14,8 +14,10 @@ import re
 from packetserver.http.dependencies import get_current_http_user
 from packetserver.http.auth import HttpUser
 from packetserver.http.database import DbDependency
-from packetserver.server.objects import Object
+from packetserver.http.conditional import not_modified, set_etag, etag_headers
+from packetserver.server.objects import Object, object_index
 from packetserver.server.users import User
+from packetserver.server.listing import decode_cursor, check_key, micros, top_page
 
 
 router = APIRouter(prefix="/api/v1", tags=["objects"])
@@ -31,12 +33,34 @@ class ObjectSummary(BaseModel):
     modified_at: datetime
 
 @router.get("/objects", response_model=List[ObjectSummary])
-async def list_my_objects(db: DbDependency, current_user: HttpUser = Depends(get_current_http_user)):
+async def list_my_objects(db: DbDependency, current_user: HttpUser = Depends(get_current_http_user),
+                          limit: Optional[int] = None, cursor: Optional[str] = None, response: Response = None,
+                          request: Request = None):
+    """Newest first. With limit set, the cursor for the next page comes back in the X-Next-Cursor header."""
     username = current_user.username.upper().strip()  # ensure uppercase consistency
     logging.debug(f"Listing objects for user {username}")
+    try:
+        after = decode_cursor("http_object", cursor) if cursor else None
+        if after is not None:
+            check_key(after, int, bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     user_objects = []
     with db.transaction() as conn:
-        for obj in Object.get_objects_by_username(username, conn):
+        user = User.get_user_by_username(username, conn.root())
+        if not user:
+            return user_objects
+        cached = not_modified(request, conn.root(), 'objects', username)
+        if cached is not None:
+            return cached
+        set_etag(response, request, conn.root(), 'objects', username)
+        # newest first, from the metadata index so no object data is loaded
+        objs = object_index(conn.root()).owned_by(user.uuid)
+        objs, next_cursor = top_page(objs, lambda o: (micros(o.created_at), o.uuid.bytes), after=after, limit=limit,
+                                     reverse=True, kind="http_object")
+        if (next_cursor is not None) and (response is not None):
+            response.headers["X-Next-Cursor"] = next_cursor
+        for obj in objs:
             logging.debug(f"Found object {obj.uuid} for {username}")
             if obj:  # should always exist, but guard anyway
                 content_type, _ = mimetypes.guess_type(obj.name)
@@ -54,9 +78,6 @@ async def list_my_objects(db: DbDependency, current_user: HttpUser = Depends(get
                     modified_at=obj.modified_at
                 ))
 
-        # Sort newest first
-        user_objects.sort(key=lambda x: x.created_at, reverse=True)
-
         return user_objects
 
 @router.post("/objects", response_model=ObjectSummary)
@@ -408,6 +429,8 @@ async def delete_object(
 
             # Remove references
             user.remove_obj_uuid(uuid)               # from user's object_uuids set
+            obj.unindex(root)                        # from the listing metadata index
+            obj.drop_data(root)                      # its share of the stored data
             del conn.root.objects[uuid]                  # from global objects mapping
 
             logging.info(f"User {username} deleted object {uuid}")
@@ -424,7 +447,8 @@ async def delete_object(
 async def get_object_text(
     uuid: UUID,
     db: DbDependency,
-    current_user: HttpUser = Depends(get_current_http_user)
+    current_user: HttpUser = Depends(get_current_http_user),
+    request: Request = None
 ):
     username = current_user.username
 
@@ -449,6 +473,11 @@ async def get_object_text(
                     detail="This endpoint is for text objects only. Use /download or /binary for binary content."
                 )
 
+            cached = not_modified(request, root, 'objects', username)
+            if cached is not None:
+                return cached
+            headers = etag_headers(request, root, 'objects', username)
+
             # Safe to return as str since binary=False guarantees valid UTF-8
             content = obj.data  # will be str
 
@@ -460,7 +489,7 @@ async def get_object_text(
         logging.error(f"Text download failed for {username} on {uuid}: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail="Failed to retrieve text object")
 
-    return PlainTextResponse(content=content, media_type="text/plain; charset=utf-8")
+    return PlainTextResponse(content=content, media_type="text/plain; charset=utf-8", headers=headers)
 
 class ObjectBinaryResponse(BaseModel):
     uuid: UUID
@@ -477,7 +506,9 @@ class ObjectBinaryResponse(BaseModel):
 async def get_object_binary(
     uuid: UUID,
     db: DbDependency,
-    current_user: HttpUser = Depends(get_current_http_user)
+    current_user: HttpUser = Depends(get_current_http_user),
+    request: Request = None,
+    response: Response = None
 ):
     username = current_user.username
 
@@ -495,6 +526,11 @@ async def get_object_binary(
                 if not user or user.uuid != obj.owner:
                     raise HTTPException(status_code=403, detail="Not authorized to access this private object")
 
+            cached = not_modified(request, root, 'objects', username)
+            if cached is not None:
+                return cached
+            set_etag(response, request, root, 'objects', username)
+
             # Get content as bytes (works for both text and binary)
             content_bytes = obj.data_bytes  # uses the property that always returns bytes
 
@@ -537,7 +573,8 @@ async def download_object(
     uuid: UUID,
     db: DbDependency,
     current_user: HttpUser = Depends(get_current_http_user),
-    accept: str = Header(None)  # Optional: for future content negotiation if needed
+    accept: str = Header(None),  # Optional: for future content negotiation if needed
+    request: Request = None
 ):
     username = current_user.username
 
@@ -555,8 +592,12 @@ async def download_object(
                 if not user or user.uuid != obj.owner:
                     raise HTTPException(status_code=403, detail="Not authorized to access this private object")
 
-            # Get content as bytes
-            content_bytes = obj.data_bytes
+            cached = not_modified(request, root, 'objects', username)
+            if cached is not None:
+                return cached
+
+            # opened now, read after the transaction: straight from the blob file for large objects
+            content_chunks = obj.data_chunks()
 
             # Guess content type
             content_type, _ = mimetypes.guess_type(obj.name)
@@ -570,6 +611,7 @@ async def download_object(
             headers = {
                 "Content-Disposition": f'attachment; filename="{safe_filename}"',
                 "Content-Length": str(obj.size),
+                **etag_headers(request, root, 'objects', username),
             }
 
             logging.info(f"User {username} downloaded object {uuid} ({obj.name}) via streaming")
@@ -580,9 +622,8 @@ async def download_object(
         logging.error(f"Download failed for {username} on {uuid}: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail="Failed to stream object")
 
-    # Stream the bytes directly (efficient, no full load in memory beyond ZODB)
     return StreamingResponse(
-        iter([content_bytes]),  # single chunk since ZODB objects are usually small-ish
+        content_chunks,
         media_type=content_type,
         headers=headers
     )
@@ -591,7 +632,9 @@ async def download_object(
 async def get_object_metadata(
     uuid: UUID,
     db: DbDependency,
-    current_user: HttpUser = Depends(get_current_http_user)
+    current_user: HttpUser = Depends(get_current_http_user),
+    request: Request = None,
+    response: Response = None
 ):
     username = current_user.username
 
@@ -609,6 +652,11 @@ async def get_object_metadata(
                 if not user or user.uuid != obj.owner:
                     raise HTTPException(status_code=403, detail="Not authorized to view this private object")
 
+            cached = not_modified(request, root, 'objects', username)
+            if cached is not None:
+                return cached
+            set_etag(response, request, root, 'objects', username)
+
             # Guess content_type for summary
             content_type, _ = mimetypes.guess_type(obj.name)
             if content_type is None:
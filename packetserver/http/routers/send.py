@@ -9,7 +9,8 @@ import transaction
 
 from packetserver.http.dependencies import get_current_http_user
 from packetserver.http.auth import HttpUser
-from packetserver.server.messages import Message
+from packetserver.server.messages import (Message, MessageBody, open_mailbox, store_message_body,
+                                          deliver_message)
 from packetserver.common.util import is_valid_ax25_callsign
 from packetserver.http.database import DbDependency
 
@@ -95,15 +96,14 @@ async def send_message(
         messages_root = root.setdefault('messages', PersistentMapping())
         delivered_to = set()
         # Always give sender a copy in their mailbox (acts as Sent folder)
-        sender_mailbox = messages_root.setdefault(username, PersistentList())
-        sender_mailbox.append(new_msg)
-        sender_mailbox._p_changed = True
+        # Store the text once; every mailbox gets a small reference to it
+        body = store_message_body(MessageBody(new_msg.msg_id, new_msg.text, username, new_msg.msg_to,
+                                              sent_at=new_msg.sent_at), root)
+        deliver_message(body, open_mailbox(username, root))
         delivered_to.add(username)  # now accurate
 
         for recip in valid_recipients:
-            mailbox = messages_root.setdefault(recip, PersistentList())
-            mailbox.append(new_msg)
-            mailbox._p_changed = True
+            deliver_message(body, open_mailbox(recip, root))
             delivered_to.add(recip)
 
         messages_root._p_changed = True
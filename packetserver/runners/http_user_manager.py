@@ -21,6 +21,7 @@ import ZODB.FileStorage
 import ZODB.DB
 import transaction
 from persistent.mapping import PersistentMapping
+from BTrees.OOBTree import OOBTree
 
 os.environ['PS_APP_ZEO_FILE'] = "N/A"
 
@@ -151,7 +152,7 @@ def main():
                 # Sync: create corresponding regular BBS user using proper write_new for UUID/uniqueness
                 from packetserver.server.users import User
 
-                main_users = root.setdefault('users', PersistentMapping())
+                main_users = root.setdefault('users', OOBTree())
                 if callsign not in main_users:
                     new_user = User(args.callsign)
                     new_user.write_new(conn.root())
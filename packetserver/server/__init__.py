@@ -3,16 +3,24 @@ import tempfile
 
 import pe.app
 from packetserver.common import Response, Message, Request, PacketServerConnection, send_response, send_blank_response
+from packetserver.common import chunked
+from packetserver.common.chunked import ChunkError
 from packetserver.server.constants import default_server_config, default_server_name
-from packetserver.server.users import User
+from packetserver.server.users import User, auth_cache, get_blacklist, migrate_users, last_seen_tracker
 from copy import deepcopy
 import ax25
 from pathlib import Path
 import ZODB, ZODB.FileStorage
-from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOBTree, OOTreeSet
 from persistent.mapping import PersistentMapping
 from persistent.list import PersistentList
 from packetserver.server.requests import standard_handlers
+from packetserver.server.batch import batch_root_handler
+from packetserver.server.bulletin_store import bulletin_store
+from packetserver.server.versions import versions, bump_version
+from packetserver.server.dispatch import Dispatcher
+from packetserver.server.context import TransactionMetrics, run_handler
+from functools import partial
 import logging
 import signal
 import time
@@ -22,14 +30,16 @@ from traceback import  format_exc
 from os import linesep
 from shutil import rmtree
 from threading import Thread
-from packetserver.server.jobs import get_orchestrator_from_config, Job, JobStatus
+from packetserver.server.jobs import get_orchestrator_from_config, Job, JobStatus, migrate_jobs
 from packetserver.runner import RunnerStatus, RunnerFile, Orchestrator, Runner
 
 VERSION="0.4.1"
 
+# requests whose handlers store a payload streamed as a chunked transfer straight from its spool (store_streamed_body)
+streamed_body_requests = {('object', Request.Method.POST), ('message', Request.Method.POST)}
+
 def init_bulletins(root: PersistentMapping):
-    if 'bulletins' not in root:
-        root['bulletins'] = PersistentList()
+    bulletin_store(root)
     if 'bulletin_counter' not in root:
         root['bulletin_counter'] = 0
 
@@ -41,6 +51,8 @@ class Server:
         self.pe_server = pe_server
         self.pe_port = port
         self.handlers = deepcopy(standard_handlers)
+        # batches dispatch through this server's handlers, including any registered later
+        self.handlers['batch'] = partial(batch_root_handler, handlers=self.handlers)
         self.zeo_addr = None
         self.zeo_stop = None
         self.zeo = zeo
@@ -51,6 +63,10 @@ class Server:
         self.last_check_job_queue = datetime.datetime.now(datetime.UTC)
         self.job_check_interval = 60
         self.quick_job = False
+        self.dispatcher = Dispatcher(self.dispatch_request)
+        self.transaction_metrics = TransactionMetrics()
+        self.last_metrics_log = datetime.datetime.now(datetime.UTC)
+        self.metrics_log_interval = 900
         if data_dir:
             data_path = Path(data_dir)
         else:
@@ -66,14 +82,14 @@ class Server:
             else:
                 data_path.mkdir()
                 self.home_dir = data_path
-        self.storage = ZODB.FileStorage.FileStorage(self.data_file)
+        self.storage = ZODB.FileStorage.FileStorage(self.data_file, blob_dir=self.blob_dir)
         self.db = ZODB.DB(self.storage)
         with self.db.transaction() as conn:
             logging.debug(f"checking for datastructures: conn.root.keys(): {list(conn.root().keys())}")
             if 'config' not in conn.root():
                 logging.debug("no config, writing blank default config")
                 conn.root.config = PersistentMapping(deepcopy(default_server_config))
-                conn.root.config['blacklist'] = PersistentList()
+                conn.root.config['blacklist'] = OOTreeSet()
             logging.debug(f"Setting server callsign in db to: {self.callsign}")
             conn.root.server_callsign = self.callsign
             for key in ['motd', 'operator']:
@@ -81,12 +97,20 @@ class Server:
                     conn.root.config[key] = ""
             if 'server_name' not in conn.root.config:
                 conn.root.config['server_name'] = default_server_name
+            if type(conn.root.config.get('blacklist')) is not OOTreeSet:
+                logging.debug("Converting blacklist to an OOTreeSet")
+                get_blacklist(conn.root.config)
             if 'SYSTEM' not in conn.root.config['blacklist']:
                 logging.debug("Adding 'SYSTEM' to blacklist in case someone feels like violating FCC rules.")
-                conn.root.config['blacklist'].append('SYSTEM')
+                conn.root.config['blacklist'].add('SYSTEM')
+            if 'auth_cache_ttl' in conn.root.config:
+                auth_cache.ttl = float(conn.root.config['auth_cache_ttl'])
+            if 'last_seen_flush_interval' in conn.root.config:
+                last_seen_tracker.flush_interval = float(conn.root.config['last_seen_flush_interval'])
             if 'users' not in conn.root():
                 logging.debug("users missing, creating bucket")
-                conn.root.users = PersistentMapping()
+                conn.root.users = OOBTree()
+            migrate_users(conn.root())
             if 'messages' not in conn.root():
                 logging.debug("messages container missing, creating bucket")
                 conn.root.messages = PersistentMapping()
@@ -103,7 +127,9 @@ class Server:
                 conn.root.job_queue = PersistentList()
             if 'user_jobs' not in conn.root():
                 conn.root.user_jobs = PersistentMapping()
+            migrate_jobs(conn.root())
             init_bulletins(conn.root())
+            versions(conn.root())
             if ('jobs_enabled' in conn.root.config) and conn.root.config['jobs_enabled']:
                 logging.debug(conn.root.config['jobs_enabled'])
                 logging.debug(conn.root.config['jobs_config'])
@@ -125,6 +151,11 @@ class Server:
     def data_file(self) -> str:
         return str(Path(self.home_dir).joinpath('data.zopedb'))
 
+    @property
+    def blob_dir(self) -> str:
+        """Where large object and attachment payloads are kept, next to data.zopedb."""
+        return str(Path(self.home_dir).joinpath('blobs'))
+
     def ping_job_queue(self):
         self.check_job_queue = True
         self.last_check_job_queue = datetime.datetime.now(datetime.UTC)
@@ -152,7 +183,6 @@ class Server:
 
             # user object check
             logging.debug(f"checking user existence for {base}")
-            logging.debug(f"users in db right now: {list(storage.root.users.keys())}")
             if base in storage.root.users:
                 logging.debug(f"User {base} exists in db.")
                 u = storage.root.users[base]
@@ -162,6 +192,8 @@ class Server:
                 logging.info(f"Creating new user {base}")
                 u = User(base.upper().strip())
                 u.write_new(storage.root())
+            # the bouncer has just read everything user_authorized needs, so refresh its cache entry
+            auth_cache.set(base, u.enabled and not blacklisted)
         if blacklisted:
             count = 0
             while count < 10:
@@ -181,36 +213,70 @@ class Server:
             logging.debug("Setting quick job timer for a quick job.")
             self.job_check_interval = 8
             self.quick_job = True
-        if req_root_path in self.handlers:
-            logging.debug(f"found handler for req {req}")
-            self.handlers[req_root_path](req, conn, self.db)
-            return
-        logging.warning(f"unhandled request found: {req}")
-        send_blank_response(conn, req, status_code=404)
+        try:
+            if (req.body_file is not None) and ((req_root_path, req.method) not in streamed_body_requests):
+                # a handler that doesn't take streamed uploads gets the body in the payload as usual
+                req.read_body_file()
+            if req_root_path in self.handlers:
+                logging.debug(f"found handler for req {req}")
+                run_handler(self.handlers[req_root_path], req, conn, self.db, metrics=self.transaction_metrics,
+                            path=req_root_path)
+                return
+            logging.warning(f"unhandled request found: {req}")
+            send_blank_response(conn, req, status_code=404)
+        finally:
+            req.close_body_file()
+
+    def dispatch_request(self, req: Request, conn: PacketServerConnection):
+        """Runs on a dispatcher worker thread."""
+        logging.debug(f"attempting to handle request {req}")
+        self.handle_request(req, conn)
+        self.ping_job_queue()
+        logging.debug("request handled")
 
     def process_incoming_data(self, connection: PacketServerConnection):
-        """Handles incoming data."""
+        """Parses whatever complete requests have arrived and queues them for the dispatcher. Handlers never run
+        here, so a slow request can't hold up the receive path."""
         logging.debug("Running process_incoming_data on connection")
         with connection.data_lock:
             logging.debug("Data lock acquired")
             while True:
                 try:
-                    msg = Message.partial_unpack(connection.data.unpack())
-                    logging.debug(f"parsed a Message from data received")
+                    unpacked = connection.data.unpack()
                 except OutOfData:
                     logging.debug("no complete message yet, done until more data arrives")
                     break
+                if chunked.is_chunk_frame(unpacked):
+                    try:
+                        assembler = connection.chunks.accept(unpacked)
+                    except ChunkError as e:
+                        logging.warning(f"Dropping chunked transfer from {connection.remote_callsign}: {e}")
+                        connection.send_data(b"BAD REQUEST. CHUNKED TRANSFER FAILED: " + str(e).encode())
+                        continue
+                    if assembler is None:
+                        continue
+                try:
+                    if chunked.is_chunk_frame(unpacked):
+                        # a streamed payload stays spooled, as the request's body_file
+                        try:
+                            msg = Message.from_assembler(assembler)
+                        finally:
+                            assembler.close()
+                    else:
+                        msg = Message.partial_unpack(unpacked)
+                    logging.debug(f"parsed a Message from data received")
                 except ValueError:
                     connection.send_data(b"BAD REQUEST. COULD NOT PARSE INCOMING DATA AS PACKETSERVER MESSAGE")
+                    continue
                 try:
                     request = Request(msg)
                     logging.debug(f"parsed Message into request {request}")
                 except ValueError:
+                    msg.close_body_file()
                     connection.send_data(b"BAD REQUEST. DID NOT RECEIVE A REQUEST MESSAGE.")
-                logging.debug(f"attempting to handle request {request}")
-                self.handle_request(request, connection)
-                self.ping_job_queue()
-                logging.debug("request handled")
+                    continue
+                # queued while still holding the lock so requests keep their arrival order
+                self.dispatcher.submit(connection, request)
 
     def server_receiver(self, conn: PacketServerConnection):
         logging.debug("running server receiver")
@@ -227,9 +293,16 @@ class Server:
         if not self.started:
             return
         # Add things to do here:
+        if last_seen_tracker.due:
+            last_seen_tracker.flush(self.db)
         now = datetime.datetime.now(datetime.UTC)
         if (now - self.last_check_job_queue).total_seconds() > self.job_check_interval:
             self.ping_job_queue()
+        if (now - self.last_metrics_log).total_seconds() > self.metrics_log_interval:
+            self.last_metrics_log = now
+            metrics = self.transaction_metrics.snapshot()
+            if metrics['requests'] > 0:
+                logging.info(f"Request transaction metrics: {metrics}")
         if (self.orchestrator is not None) and self.orchestrator.started and self.check_job_queue:
             with self.db.transaction() as storage:
                 # queue as many jobs as possible
@@ -242,11 +315,12 @@ class Server:
                         except:
                             logging.error(f"Error retrieving job {jid}")
                             break
-                        runner = self.orchestrator.new_runner(job.owner, job.cmd, jid, environment=job.env, files=job.files)
+                        runner = self.orchestrator.new_runner(job.owner, job.cmd, jid, environment=job.env, files=job.runner_files())
                         if runner is not None:
                             storage.root.job_queue.remove(jid)
                             job.status = JobStatus.RUNNING
                             job.started_at = datetime.datetime.now(datetime.UTC)
+                            bump_version(storage.root(), 'jobs')
                             logging.info(f"Started job {job}")
                     else:
                         break
@@ -286,14 +360,14 @@ class Server:
 
     def start_db(self):
         if not self.zeo:
-            self.storage = ZODB.FileStorage.FileStorage(self.data_file)
+            self.storage = ZODB.FileStorage.FileStorage(self.data_file, blob_dir=self.blob_dir)
             self.db = ZODB.DB(self.storage)
         else:
             import ZEO
-            address, stop = ZEO.server(path=self.data_file)
+            address, stop = ZEO.server(path=self.data_file, blob_dir=self.blob_dir)
             self.zeo_addr = address
             self.zeo_stop = stop
-            self.db = ZEO.DB(self.zeo_addr)
+            self.db = ZEO.DB(self.zeo_addr, blob_dir=self.blob_dir, shared_blob_dir=True)
             logging.info(f"Starting ZEO server with address {self.zeo_addr}")
             try:
                 zeo_address_file = str(self.home_dir.joinpath("zeo-address.txt"))
@@ -317,6 +391,9 @@ class Server:
         self.stop()
 
     def stop_db(self):
+        # let requests already dispatched finish before the database goes away
+        self.dispatcher.shutdown()
+        last_seen_tracker.flush(self.db)
         self.storage.close()
         self.db.close()
         if self.zeo:
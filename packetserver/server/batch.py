@@ -0,0 +1,133 @@
+"""Batch requests: many sub-requests in one RF round trip, answered with one combined response."""
+import logging
+from contextlib import contextmanager
+from traceback import format_exc
+from typing import Optional
+
+import ZODB
+from msgpack import Unpacker
+from msgpack.exceptions import OutOfData
+
+from packetserver.common import Message, Request, Response, PacketServerConnection, send_response, send_blank_response
+from packetserver.server.context import RequestContext, run_handler
+
+max_batch_size = 32
+
+# vars that only make sense on the outer request; sub-responses go out inside the batch response
+outer_only_vars = ('c', 'cd', 'chunked', 'rid')
+
+
+class CaptureConnection:
+    """Stands in for the real connection while a sub-request runs, keeping what the handler sends."""
+    def __init__(self, conn: PacketServerConnection):
+        self.conn = conn
+        self.sent = Unpacker()
+
+    def __getattr__(self, item):
+        return getattr(self.conn, item)
+
+    def send_data(self, data: bytes):
+        self.sent.feed(data)
+
+    def send_frames(self, frames):
+        for frame in frames:
+            self.send_data(frame)
+
+    def responses(self) -> list[Response]:
+        out = []
+        while True:
+            try:
+                unpacked = self.sent.unpack()
+            except OutOfData:
+                break
+            try:
+                out.append(Response(Message.partial_unpack(unpacked)))
+            except (ValueError, KeyError, TypeError):
+                logging.warning(f"Batch sub-request sent something that isn't a response: {unpacked}")
+        return out
+
+
+def parse_sub_request(sub) -> Request:
+    if type(sub) is not dict:
+        raise ValueError("Batch entries must be request dicts.")
+    req = Request(Message(Message.MessageType.REQUEST, Message.CompressionType.NONE, dict(sub)))
+    if req.path.split("/")[0] == "batch":
+        raise ValueError("Batches can't be nested.")
+    for key in outer_only_vars:
+        req.vars.pop(key, None)
+    # responses are compressed once, together, on the way out
+    req.set_var('c', 'NONE')
+    return req
+
+
+def run_sub_request(req: Request, conn: PacketServerConnection, db, handlers: dict,
+                    own_transaction: bool = False) -> dict:
+    """Runs one sub-request and returns its response dict. With own_transaction it gets a transaction of its
+    own, committed before its response is captured, as if it had been sent separately."""
+    root = req.path.split("/")[0]
+    if root not in handlers:
+        return {'c': (404).to_bytes(2), 'd': ''}
+    capture = CaptureConnection(conn)
+    try:
+        if own_transaction:
+            run_handler(handlers[root], req, capture, db)
+        else:
+            handlers[root](req, capture, db)
+    except Exception:
+        logging.error(f"Batch sub-request {req} failed:\n{format_exc()}")
+        return {'c': (500).to_bytes(2), 'd': "unknown server error"}
+    responses = capture.responses()
+    if len(responses) == 0:
+        return {'c': (500).to_bytes(2), 'd': "handler sent no response"}
+    data = responses[0].data
+    if 'v' in data:
+        data['v'].pop('rid', None)
+        if not data['v']:
+            del data['v']
+    return data
+
+
+def batch_root_handler(req: Request, conn: PacketServerConnection, db: ZODB.DB, handlers: Optional[dict] = None):
+    """Runs each request dict in the payload through the handler table and answers with a list of the response
+    dicts, in order. Batches of nothing but GETs share the batch's transaction so they see a consistent snapshot;
+    batches with writes run each sub-request in a transaction of its own, as if sent separately."""
+    logging.debug(f"{req} being processed by batch_root_handler")
+    if handlers is None:
+        from packetserver.server.requests import standard_handlers
+        handlers = standard_handlers
+    if type(req.payload) is not list:
+        send_blank_response(conn, req, status_code=400, payload="batch payload must be a list of requests")
+        return
+    if len(req.payload) > max_batch_size:
+        send_blank_response(conn, req, status_code=400, payload=f"batches are limited to {max_batch_size} requests")
+        return
+    subs = []
+    for sub in req.payload:
+        try:
+            subs.append(parse_sub_request(sub))
+        except ValueError as e:
+            send_blank_response(conn, req, status_code=400, payload=f"bad batch entry {len(subs)}: {e}")
+            return
+
+    results = []
+    if all(s.method is Request.Method.GET for s in subs):
+        # reads share the batch's own transaction, and so one snapshot
+        shared = db if isinstance(db, RequestContext) else RequestContext(db)
+        try:
+            for sub in subs:
+                logging.debug(f"Running batch sub-request {sub}")
+                results.append(run_sub_request(sub, conn, shared, handlers))
+        except Exception:
+            shared.abort()
+            raise
+        if shared is not db:
+            shared.finish()
+    else:
+        for sub in subs:
+            logging.debug(f"Running batch sub-request {sub}")
+            results.append(run_sub_request(sub, conn, db, handlers, own_transaction=True))
+
+    response = Response.blank()
+    response.status_code = 200
+    response.payload = results
+    send_response(conn, response, req)
@@ -0,0 +1,266 @@
+"""Large payloads kept in ZODB blobs, stored once per distinct content, so the records that own them stay small.
+
+Objects, attachments, job files and job artifacts hold their data as a payload: the bytes themselves when they're
+small, or a StoredData when they're at least blob_threshold bytes. A StoredData keeps the size and sha256 in the
+record and the bytes in a blob file, so loading, listing or renaming the owner never reads them, and reads can
+stream from disk.
+
+StoredData lives in root.payload_store under its sha256 and counts its holders, so the same file uploaded as an
+object, attached to messages and passed to a job is stored once. A holder takes its reference with store_payload,
+keep_payload or payload_for_hash and gives it back with release_payload. Until a holder is written to the database
+a large payload stays as plain bytes. The storage needs a blob directory (FileStorage or ZEO with blob_dir) for
+large payloads to commit."""
+import hashlib
+from io import BytesIO
+from typing import BinaryIO, Iterator, Optional, Tuple, Union
+
+import persistent
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from persistent.mapping import PersistentMapping
+from ZODB.blob import Blob
+
+from packetserver.common import Request
+from packetserver.common.constants import stored_payload_min_size
+from packetserver.common.util import byte_range_payload
+
+blob_threshold = stored_payload_min_size
+chunk_size = 65536
+
+Payload = Union[bytes, 'StoredData']
+
+
+class UnknownPayloadError(Exception):
+    """Raised when a payload is referred to by a sha256 the payload store doesn't have."""
+    pass
+
+
+class StoredData(persistent.Persistent):
+    """Bytes in a ZODB blob, with their size and sha256, and a count of the records holding them."""
+    refs = None
+
+    def __init__(self, data: bytes, sha256: Optional[bytes] = None):
+        self.size = len(data)
+        self.sha256 = sha256 or hashlib.sha256(data).digest()
+        self.refs = Length()
+        self.blob = Blob()
+        with self.blob.open('w') as f:
+            f.write(data)
+
+    @classmethod
+    def from_file(cls, f: BinaryIO) -> 'StoredData':
+        """StoredData holding the rest of f, copied into the blob a block at a time instead of read into memory."""
+        stored = cls(b'')
+        h = hashlib.sha256()
+        size = 0
+        with stored.blob.open('w') as out:
+            for piece in iter(lambda: f.read(chunk_size), b''):
+                out.write(piece)
+                h.update(piece)
+                size = size + len(piece)
+        stored.size = size
+        stored.sha256 = h.digest()
+        return stored
+
+    def open(self):
+        """The blob as a read-only binary file."""
+        return self.blob.open('r')
+
+    def read(self, offset: int = 0, length: Optional[int] = None) -> bytes:
+        with self.open() as f:
+            if offset:
+                f.seek(offset)
+            return f.read() if length is None else f.read(length)
+
+    def chunks(self, size: int = chunk_size) -> Iterator[bytes]:
+        """The data in pieces of at most size bytes. The file is opened now and stays open until the iterator is
+        exhausted or closed, so the iterator can outlive the transaction it was made in."""
+        return file_chunks(self.open(), size)
+
+    def __repr__(self):
+        return f"<StoredData: {self.size}b, {self.sha256.hex()[:16]}>"
+
+
+def file_chunks(f: BinaryIO, size: int = chunk_size) -> Iterator[bytes]:
+    with f:
+        while True:
+            piece = f.read(size)
+            if not piece:
+                return
+            yield piece
+
+
+class PayloadStore(persistent.Persistent):
+    """StoredData by sha256, one per distinct content, dropped when the last holder releases it."""
+
+    def __init__(self):
+        self.blobs = OOBTree()
+
+    def __contains__(self, sha256: bytes) -> bool:
+        return sha256 in self.blobs
+
+    def __len__(self) -> int:
+        return len(self.blobs)
+
+    def get(self, sha256: bytes) -> Optional[StoredData]:
+        return self.blobs.get(sha256)
+
+    def put(self, data: bytes) -> StoredData:
+        """The StoredData holding data, created if this content is new, with one more reference."""
+        sha256 = hashlib.sha256(data).digest()
+        stored = self.blobs.get(sha256)
+        if stored is None:
+            stored = StoredData(data, sha256=sha256)
+            self.blobs[sha256] = stored
+        stored.refs.change(1)
+        return stored
+
+    def put_file(self, f: BinaryIO) -> StoredData:
+        """put() for the rest of a file. The file is copied into a new blob as it's hashed; if the content turns
+        out to be stored already, the copy is dropped and the stored one gets the reference."""
+        new = StoredData.from_file(f)
+        stored = self.blobs.get(new.sha256)
+        if stored is None:
+            stored = new
+            self.blobs[stored.sha256] = stored
+        stored.refs.change(1)
+        return stored
+
+    def acquire(self, sha256: bytes) -> Optional[StoredData]:
+        """One more reference to already stored content, or None if there is none with that sha256."""
+        stored = self.blobs.get(sha256)
+        if stored is not None:
+            stored.refs.change(1)
+        return stored
+
+    def release(self, stored: StoredData):
+        # StoredData made before the store existed isn't counted here
+        if self.blobs.get(stored.sha256) is not stored:
+            return
+        stored.refs.change(-1)
+        if stored.refs() <= 0:
+            del self.blobs[stored.sha256]
+
+
+def payload_store(db_root: PersistentMapping) -> PayloadStore:
+    if 'payload_store' not in db_root:
+        db_root['payload_store'] = PayloadStore()
+    return db_root['payload_store']
+
+
+def store_payload(data: bytes, db_root: Optional[PersistentMapping] = None) -> Payload:
+    """data as a holder should keep it: itself when small or when there's no database yet, otherwise a reference
+    to the shared StoredData with those bytes."""
+    data = bytes(data)
+    if (len(data) < blob_threshold) or (db_root is None):
+        return data
+    return payload_store(db_root).put(data)
+
+
+def store_payload_file(f: BinaryIO, db_root: Optional[PersistentMapping] = None) -> Payload:
+    """store_payload() for the whole of a seekable file, without reading a large one into memory."""
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(0)
+    if (size < blob_threshold) or (db_root is None):
+        return f.read()
+    return payload_store(db_root).put_file(f)
+
+
+def store_streamed_body(req: Request, db_root: PersistentMapping):
+    """For handlers taking uploads that may arrive as a streamed chunked transfer: stores the spooled body with
+    store_payload_file() and puts the result where the client streamed it from in the payload, so from_dict() on
+    the object or attachment there takes it as the holder's reference. The spool is left open for a rerun of the
+    handler after a conflict; the server closes it once the request is done."""
+    if req.body_file is None:
+        return
+    req.fill_body(store_payload_file(req.body_file, db_root))
+
+
+def keep_payload(payload: Payload, db_root: PersistentMapping) -> Payload:
+    """For a holder being written to the database: moves large plain bytes into the store. A StoredData already
+    carries the holder's reference."""
+    if isinstance(payload, StoredData):
+        return payload
+    return store_payload(payload, db_root)
+
+
+def release_payload(payload: Payload, db_root: PersistentMapping):
+    """Gives back a holder's reference to payload, for when the holder is deleted or its data replaced."""
+    if isinstance(payload, StoredData):
+        payload_store(db_root).release(payload)
+
+
+def have_payload(sha256: bytes, db_root: PersistentMapping, size: Optional[int] = None) -> bool:
+    """Whether the store holds content with this sha256, and this size when one is given."""
+    if type(sha256) is not bytes:
+        return False
+    stored = payload_store(db_root).get(sha256)
+    return (stored is not None) and ((size is None) or (stored.size == size))
+
+
+def missing_payloads(refs: list[dict], db_root: PersistentMapping) -> list[bytes]:
+    """The sha256 of each dict in refs that names its data by hash (sha256, optional size, no data) when the store
+    doesn't have it."""
+    return [ref['sha256'] for ref in refs
+            if (type(ref) is dict) and (ref.get('data') is None) and ('sha256' in ref)
+            and not have_payload(ref['sha256'], db_root, size=ref.get('size'))]
+
+
+def payload_for_hash(sha256: bytes, db_root: PersistentMapping, size: Optional[int] = None) -> StoredData:
+    """A new reference to stored content by its sha256, so a client can send the hash instead of bytes the
+    server already has. Raises UnknownPayloadError when there's no such content, or it isn't size bytes long."""
+    if not have_payload(sha256, db_root, size=size):
+        raise UnknownPayloadError(f"No stored data with sha256 {sha256.hex() if type(sha256) is bytes else sha256}")
+    return payload_store(db_root).acquire(sha256)
+
+
+def payload_bytes(payload: Payload) -> bytes:
+    if isinstance(payload, StoredData):
+        return payload.read()
+    return payload
+
+
+def payload_size(payload: Payload) -> int:
+    if isinstance(payload, StoredData):
+        return payload.size
+    return len(payload)
+
+
+def payload_sha256(payload: Payload) -> bytes:
+    if isinstance(payload, StoredData):
+        return payload.sha256
+    return hashlib.sha256(payload).digest()
+
+
+def payload_equals(payload: Payload, data: bytes) -> bool:
+    """Whether payload holds data, compared by size and hash when the payload is in a blob."""
+    if isinstance(payload, StoredData):
+        return (payload.size == len(data)) and (payload.sha256 == hashlib.sha256(data).digest())
+    return payload == data
+
+
+def payload_file(payload: Payload) -> BinaryIO:
+    """The payload as a read-only binary file, straight from the blob when it's stored in one."""
+    if isinstance(payload, StoredData):
+        return payload.open()
+    return BytesIO(payload)
+
+
+def payload_chunks(payload: Payload, size: int = chunk_size) -> Iterator[bytes]:
+    if isinstance(payload, StoredData):
+        return payload.chunks(size)
+    return iter([payload]) if payload else iter([])
+
+
+def payload_range(payload: Payload, byte_range: Tuple[int, Optional[int]], sha256: Optional[bytes] = None) -> dict:
+    """byte_range_payload() for a payload, reading only the requested piece of a blob. A blob's sha256 is already
+    stored; for plain bytes, pass it in if known."""
+    if not isinstance(payload, StoredData):
+        return byte_range_payload(payload, byte_range, sha256=sha256)
+    offset, length = byte_range
+    if (offset > payload.size) or ((offset == payload.size) and (payload.size > 0)):
+        raise IndexError(f"Range offset {offset} is beyond the {payload.size} bytes available")
+    piece = payload.read(offset, length)
+    return {'offset': offset, 'length': len(piece), 'total_size': payload.size, 'sha256': payload.sha256,
+            'data': piece}
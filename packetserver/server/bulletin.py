@@ -8,6 +8,11 @@ from packetserver.common import PacketServerConnection, Request, Response, Messa
 import ZODB
 import logging
 from packetserver.server.users import user_authorized
+from packetserver.server.search import SearchIndex
+from packetserver.server.listing import check_key, request_cursor, set_next_cursor
+from packetserver.server.versions import bump_version, not_modified, set_collection_version
+from packetserver.server.bulletin_store import (bulletin_store, bulletin_index, get_bulletin, delete_bulletin,
+                                                recent_bulletins, query_bulletins)
 
 def get_new_bulletin_id(root: PersistentMapping) -> int:
     if 'bulletin_counter' not in root:
@@ -19,23 +24,17 @@ def get_new_bulletin_id(root: PersistentMapping) -> int:
         return current
 
 class Bulletin(persistent.Persistent):
+    @classmethod
+    def delete(cls, bull: Self, db_root: PersistentMapping):
+        delete_bulletin(bull.id, db_root)
+
     @classmethod
     def get_bulletin_by_id(cls, bid: int, db_root: PersistentMapping) -> Optional[Self]:
-        for bull in db_root['bulletins']:
-            if bull.id == bid:
-                return bull
-        return None
+        return get_bulletin(bid, db_root)
 
     @classmethod
     def get_recent_bulletins(cls, db_root: PersistentMapping, limit: int = None) -> list:
-        all_bulletins = sorted(db_root['bulletins'], key=lambda bulletin: bulletin.updated_at, reverse=True)
-        if not limit:
-            return all_bulletins
-        else:
-            if len(all_bulletins) < limit:
-                return all_bulletins
-            else:
-                return all_bulletins[:limit]
+        return recent_bulletins(db_root, limit)
 
     def __init__(self, author: str, subject: str, text: str):
         self.author = author
@@ -54,16 +53,30 @@ class Bulletin(persistent.Persistent):
             self.id = get_new_bulletin_id(db_root)
             self.created_at = datetime.datetime.now(datetime.UTC)
             self.updated_at = datetime.datetime.now(datetime.UTC)
-            db_root['bulletins'].append(self)
+            bulletin_store(db_root).add(self)
+            self.index(bulletin_index(db_root))
+            bump_version(db_root, 'bulletins')
         return self.id
 
+    def index(self, index: SearchIndex):
+        index.index(self.id, self.author, self.subject, self.body)
+
+    def reindex(self):
+        """Updates the search and time indexes after an edit, if the bulletin has been stored."""
+        if (self._p_jar is not None) and (self.id is not None):
+            bulletin_store(self._p_jar.root()).touched(self)
+            self.index(bulletin_index(self._p_jar.root()))
+            bump_version(self._p_jar.root(), 'bulletins')
+
     def update_subject(self, new_text: str):
         self.subject = new_text
         self.updated_at = datetime.datetime.now(datetime.UTC)
+        self.reindex()
 
     def update_body(self, new_text: str):
         self.body = new_text
         self.updated_at = datetime.datetime.now(datetime.UTC)
+        self.reindex()
 
     def to_dict(self):
         return {
@@ -83,6 +96,7 @@ def handle_bulletin_get(req: Request, conn: PacketServerConnection, db: ZODB.DB)
     bid = None
     limit = None
     only_subject = False
+    search = req.vars.get('search')
     if 'no_body' in req.vars:
         if type(req.vars['no_body']) is bool:
             only_subject = req.vars['no_body']
@@ -106,6 +120,9 @@ def handle_bulletin_get(req: Request, conn: PacketServerConnection, db: ZODB.DB)
     logging.debug(f"bid is {bid}")
 
     with db.transaction() as db:
+        if not_modified(req, conn, db.root(), 'bulletins'):
+            return
+        set_collection_version(response, req, conn, db.root(), 'bulletins')
         if bid is not None:
             logging.debug(f"retrieving bulletin: {bid}")
             bull = Bulletin.get_bulletin_by_id(bid, db.root())
@@ -117,8 +134,17 @@ def handle_bulletin_get(req: Request, conn: PacketServerConnection, db: ZODB.DB)
             else:
                 response.status_code = 404
         else:
-            logging.debug(f"retrieving all bulletins")
-            bulls = Bulletin.get_recent_bulletins(db.root(), limit=limit)
+            try:
+                after = request_cursor(req, "bulletin")
+                if after is not None:
+                    check_key(after, int, int)
+            except ValueError as e:
+                send_blank_response(conn, req, 400, payload=str(e))
+                return
+            logging.debug(f"retrieving bulletins, search: {search}")
+            bulls, next_cursor = query_bulletins(db.root(), after=after, limit=limit,
+                                                 search=str(search) if search else None)
+            set_next_cursor(response, next_cursor)
             response.payload = [bulletin.to_dict() for bulletin in bulls]
             if only_subject:
                 for b in response.payload:
@@ -174,7 +200,7 @@ def handle_bulletin_delete(req: Request, conn: PacketServerConnection, db: ZODB.
             if username != bull.author:
                 send_blank_response(conn, req, 401)
                 return
-            db.root.bulletins.remove(bull)
+            Bulletin.delete(bull, db.root())
             send_blank_response(conn, req, 200)
             return
         else:
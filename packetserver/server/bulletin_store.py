@@ -0,0 +1,160 @@
+"""Bulletin storage, and the bulletin queries the RF handler and the HTTP API share."""
+from itertools import islice, takewhile
+import datetime
+from typing import Iterator, Optional, Tuple
+
+import persistent
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOTreeSet
+from persistent.mapping import PersistentMapping
+
+from packetserver.server.search import SearchIndex
+from packetserver.server.listing import micros, no_limit, page, top_page
+from packetserver.server.versions import bump_version
+
+# larger than any bulletin id, for stepping back past the first id at a timestamp
+max_id = 2 ** 62
+
+
+def updated_key(bulletin) -> tuple:
+    return micros(bulletin.updated_at), bulletin.id
+
+
+def created_key(bulletin) -> tuple:
+    return micros(bulletin.created_at), bulletin.id
+
+
+def key_before(key: tuple) -> tuple:
+    """The largest possible time index key smaller than key."""
+    stamp, bid = int(key[0]), int(key[1])
+    if bid > 0:
+        return stamp, bid - 1
+    return stamp - 1, max_id
+
+
+class BulletinStore(persistent.Persistent):
+    """Bulletins in an IOBTree by id, with (microseconds, id) keys in OOTreeSets ordering them by creation and by
+    last update. Lookups and deletes don't scan, and the newest bulletins come off the end of an index."""
+
+    def __init__(self, bulletins=()):
+        self.by_id = IOBTree()
+        self.created = OOTreeSet()
+        self.updated = OOTreeSet()
+        # where each bulletin sits in updated, so an edit can move it
+        self.updated_keys = IOBTree()
+        for bull in bulletins:
+            self.add(bull)
+
+    def add(self, bull):
+        if bull.id in self.by_id:
+            self.remove(bull.id)
+        self.by_id[bull.id] = bull
+        self.created.add(created_key(bull))
+        key = updated_key(bull)
+        self.updated.add(key)
+        self.updated_keys[bull.id] = key
+
+    def touched(self, bull):
+        """Moves an edited bulletin to its new place in the update order."""
+        old_key = self.updated_keys.get(bull.id)
+        new_key = updated_key(bull)
+        if old_key == new_key:
+            return
+        if old_key is not None:
+            self.updated.discard(old_key)
+        self.updated.add(new_key)
+        self.updated_keys[bull.id] = new_key
+
+    def remove(self, bid: int):
+        bull = self.by_id.pop(bid, None)
+        if bull is None:
+            return
+        self.created.discard(created_key(bull))
+        key = self.updated_keys.pop(bid, None)
+        if key is not None:
+            self.updated.discard(key)
+
+    def get(self, bid: int):
+        return self.by_id.get(bid)
+
+    def __contains__(self, bid: int) -> bool:
+        return bid in self.by_id
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def newest(self, order: str = "updated", before: Optional[tuple] = None) -> Iterator:
+        """Bulletins newest first by order ("updated" or "created"), starting just before the key before. Steps
+        back one maxKey lookup at a time, since BTrees only iterate forwards."""
+        index = self.created if order == "created" else self.updated
+        key = before
+        while True:
+            try:
+                if key is None:
+                    key = index.maxKey()
+                else:
+                    key = index.maxKey(key_before(key))
+            except ValueError:
+                return
+            yield self.by_id[key[1]]
+
+
+def bulletin_store(db_root: PersistentMapping) -> BulletinStore:
+    """root.bulletins, converted from the PersistentList older databases used the first time it's opened."""
+    bulletins = db_root.get('bulletins')
+    if not isinstance(bulletins, BulletinStore):
+        bulletins = BulletinStore(bulletins or ())
+        db_root['bulletins'] = bulletins
+    return bulletins
+
+
+def bulletin_index(db_root: PersistentMapping) -> SearchIndex:
+    """The bulletin search index, built from the existing bulletins the first time it's asked for."""
+    if 'bulletin_index' not in db_root:
+        index = SearchIndex()
+        for bull in bulletin_store(db_root):
+            bull.index(index)
+        db_root['bulletin_index'] = index
+    return db_root['bulletin_index']
+
+
+def get_bulletin(bid: int, db_root: PersistentMapping):
+    return bulletin_store(db_root).get(bid)
+
+
+def delete_bulletin(bid: int, db_root: PersistentMapping):
+    bulletin_store(db_root).remove(bid)
+    bulletin_index(db_root).remove(bid)
+    bump_version(db_root, 'bulletins')
+
+
+def recent_bulletins(db_root: PersistentMapping, limit: Optional[int] = None) -> list:
+    """Most recently updated first."""
+    return list(islice(bulletin_store(db_root).newest(), no_limit(limit)))
+
+
+def query_bulletins(db_root: PersistentMapping, order: str = "updated", after: Optional[tuple] = None,
+                    limit: Optional[int] = None, search: Optional[str] = None,
+                    since: Optional[datetime.datetime] = None) -> Tuple[list, Optional[str]]:
+    """One page of bulletins, newest first by order ("updated" or "created"), and the cursor for the next page.
+    Without a search this walks the time index back from the cursor; search hits are paged with a heap. since
+    keeps only bulletins created after it."""
+    key = created_key if order == "created" else updated_key
+    kind = "bulletin_created" if order == "created" else "bulletin"
+    store = bulletin_store(db_root)
+    if search:
+        ids = bulletin_index(db_root).search(search)
+        candidates = (b for b in (store.get(bid) for bid in ids) if b is not None)
+        if since is not None:
+            candidates = (b for b in candidates if b.created_at > since)
+        return top_page(candidates, key, after=after, limit=limit, reverse=True, kind=kind)
+    candidates = store.newest(order, before=after)
+    if since is not None:
+        if order == "created":
+            candidates = takewhile(lambda b: b.created_at > since, candidates)
+        else:
+            candidates = (b for b in candidates if b.created_at > since)
+    return page(candidates, key, after=after, limit=limit, reverse=True, kind=kind)
@@ -0,0 +1,230 @@
+"""Request-scoped database access: one ZODB connection and transaction for everything a request does."""
+import logging
+from contextlib import contextmanager
+from threading import Lock
+from traceback import format_exc
+from typing import Callable, Optional, Self, Union
+
+import transaction
+import ZODB
+from ZODB.POSException import ConflictError
+
+from packetserver.common import PacketServerConnection, Request, send_blank_response
+
+# times a request is rerun after its commit conflicts with another request's, before answering 409
+conflict_retries = 3
+
+
+class RequestContext:
+    """Passed to handlers where they used to get the ZODB.DB.
+
+    It duck-types DB.transaction(), but every block in the request gets the same connection and the same
+    transaction. Each block runs under a savepoint, so an exception escaping a block still undoes just that block,
+    as it did when every block was its own transaction. The transaction commits just before the response goes out
+    (see run_handler), or when the request finishes if it sends none, and also whenever a handler calls commit()
+    to publish work early (a queued job the worker thread must see, say)."""
+
+    def __init__(self, db: Union[ZODB.DB, Self]):
+        self.parent = None
+        if isinstance(db, RequestContext):
+            self.parent = db
+            db = db.db
+        self.db = db
+        self.transaction_manager = transaction.TransactionManager()
+        self.connection = None
+        self.depth = 0
+        self.blocks = 0
+        self.transactions = 0
+        self.connections = 0
+        self.conflicts = 0
+        # whether any commit has gone through, after which rerunning the handler could repeat its work
+        self.committed = False
+        # bumped when the transaction ends, so blocks left open across a commit don't roll back into the next one
+        self.generation = 0
+        # set when the commit before a response conflicted, so nothing more is sent for this attempt
+        self.send_conflict = False
+
+    def _open(self):
+        if self.connection is None:
+            self.connection = self.db.open(self.transaction_manager)
+            self.connections = self.connections + 1
+            self.transaction_manager.begin()
+
+    @contextmanager
+    def transaction(self, *args, **kwargs):
+        self.blocks = self.blocks + 1
+        self._open()
+        savepoint = self.transaction_manager.savepoint(optimistic=True)
+        generation = self.generation
+        self.depth = self.depth + 1
+        try:
+            yield self.connection
+        except BaseException:
+            if generation == self.generation:
+                savepoint.rollback()
+            raise
+        finally:
+            self.depth = self.depth - 1
+
+    def commit(self):
+        """Commits what the request has done so far and starts a fresh transaction, which also picks up changes
+        other connections committed in the meantime."""
+        if self.connection is None:
+            return
+        self.transactions = self.transactions + 1
+        self.generation = self.generation + 1
+        try:
+            self.transaction_manager.commit()
+            self.committed = True
+        except ConflictError:
+            self.conflicts = self.conflicts + 1
+            self.transaction_manager.abort()
+            raise
+        finally:
+            self.transaction_manager.begin()
+
+    def commit_before_send(self):
+        """Request.before_send for the handler's responses. Once it has conflicted, any later response the handler
+        tries (a 500 from a catch-all except, say) is refused the same way, so that run_handler still retries."""
+        if self.send_conflict:
+            raise ConflictError("request transaction already conflicted")
+        try:
+            self.commit()
+        except ConflictError:
+            self.send_conflict = True
+            raise
+
+    def abort(self):
+        if self.connection is None:
+            return
+        self.transactions = self.transactions + 1
+        self.generation = self.generation + 1
+        self.transaction_manager.abort()
+        self.close()
+
+    def changed(self) -> bool:
+        """Whether the open transaction has writes to commit. A ZODB connection joins the transaction on its first
+        write, so a transaction nothing joined has nothing in it."""
+        if self.connection is None:
+            return False
+        return bool(self.transaction_manager.get()._resources)
+
+    def finish(self):
+        """Commits whatever the handler did after its response and closes. Conflicts here are logged rather than
+        raised, since the response has already gone out. When the response's commit went through and nothing
+        changed after it, there is nothing left to commit, and no second transaction is counted."""
+        if self.connection is None:
+            return
+        try:
+            if self.committed and not self.changed():
+                return
+            self.commit()
+        except ConflictError:
+            logging.error(f"Conflict committing request transaction:\n{format_exc()}")
+        finally:
+            self.close()
+
+    def close(self):
+        if self.connection is not None:
+            self.transaction_manager.abort()
+            self.connection.close()
+            self.connection = None
+        if self.parent is not None:
+            self.parent.blocks = self.parent.blocks + self.blocks
+            self.parent.transactions = self.parent.transactions + self.transactions
+            self.parent.connections = self.parent.connections + self.connections
+            self.parent.conflicts = self.parent.conflicts + self.conflicts
+            self.blocks = self.transactions = self.connections = self.conflicts = 0
+
+    def __repr__(self):
+        return f"<RequestContext: {self.blocks} blocks, {self.transactions} transactions>"
+
+
+def run_handler(handler: Callable, req: Request, conn: PacketServerConnection, db: Union[ZODB.DB, RequestContext],
+                metrics: Optional['TransactionMetrics'] = None, path: str = "") -> Optional[RequestContext]:
+    """Runs handler for req in a RequestContext of its own, committing just before the response is sent, so a
+    client is never told a write succeeded that then fails to commit.
+
+    A conflict at that commit means nothing went out; the handler is run again in a fresh transaction, up to
+    conflict_retries times, and the client gets a 409 if it keeps conflicting. A handler that already committed
+    some of its work (with checkpoint()) isn't rerun, since that could repeat it. Handlers re-raise ConflictError
+    past their catch-all excepts; one that swallows it anyway is still retried, since the context remembers the
+    conflict. Each attempt is recorded in metrics under path."""
+    for attempt in range(conflict_retries + 1):
+        ctx = RequestContext(db)
+        req.before_send = ctx.commit_before_send
+        try:
+            handler(req, conn, ctx)
+            if ctx.send_conflict:
+                raise ConflictError("response commit conflicted")
+        except ConflictError:
+            ctx.abort()
+            req.before_send = None
+            if ctx.committed or (attempt >= conflict_retries):
+                logging.error(f"Giving up on {req} after a write conflict:\n{format_exc()}")
+                send_blank_response(conn, req, status_code=409,
+                                    payload="conflicting update from another request; try again")
+                return ctx
+            logging.info(f"Write conflict handling {req}; retrying")
+            continue
+        except:
+            ctx.abort()
+            raise
+        else:
+            ctx.finish()
+        finally:
+            req.before_send = None
+            if metrics is not None:
+                metrics.record(ctx, path)
+            logging.debug(f"{req} used {ctx}")
+        return ctx
+    return None
+
+
+def checkpoint(db: Union[ZODB.DB, RequestContext]):
+    """Makes a handler's writes so far visible to other connections. Each transaction block already commits on its
+    own when handlers are given a plain ZODB.DB, so there's nothing to do then."""
+    if isinstance(db, RequestContext):
+        db.commit()
+
+
+class TransactionMetrics:
+    """Running totals of database work per request, overall and by request root path."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.requests = 0
+        self.blocks = 0
+        self.transactions = 0
+        self.connections = 0
+        self.conflicts = 0
+        self.max_blocks = 0
+        self.by_path = {}
+
+    def record(self, ctx: RequestContext, path: str = ""):
+        with self._lock:
+            self.requests = self.requests + 1
+            self.blocks = self.blocks + ctx.blocks
+            self.transactions = self.transactions + ctx.transactions
+            self.connections = self.connections + ctx.connections
+            self.conflicts = self.conflicts + ctx.conflicts
+            self.max_blocks = max(self.max_blocks, ctx.blocks)
+            totals = self.by_path.setdefault(path, [0, 0, 0])
+            totals[0] = totals[0] + 1
+            totals[1] = totals[1] + ctx.blocks
+            totals[2] = totals[2] + ctx.transactions
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            per = lambda total, count: round(total / count, 2) if count else 0.0
+            return {
+                'requests': self.requests,
+                'transaction_blocks_per_request': per(self.blocks, self.requests),
+                'transactions_per_request': per(self.transactions, self.requests),
+                'connections_per_request': per(self.connections, self.requests),
+                'max_transaction_blocks': self.max_blocks,
+                'conflicts': self.conflicts,
+                'paths': {path: {'requests': t[0], 'transaction_blocks_per_request': per(t[1], t[0]),
+                                 'transactions_per_request': per(t[2], t[0])}
+                          for path, t in self.by_path.items()}
+            }
@@ -36,12 +36,14 @@ def get_user_db(username: str, db: ZODB.DB) -> dict:
 
         if user in db_conn.root.messages:
             for m in db_conn.root.messages[username]:
-                for a in m.attachments:
-                    if type(a.data) is bytes:
-                        a.data = base64.b64encode(a.data).decode()
+                # encode a copy; attachment bodies may be shared with other mailboxes
+                d = m.to_dict()
+                for a in d['attachments']:
+                    if type(a['data']) is bytes:
+                        a['data'] = base64.b64encode(a['data']).decode()
                     else:
-                        a.data = base64.b64encode(a.data.encode()).decode()
-                udb['messages'].append(m.to_dict())
+                        a['data'] = base64.b64encode(a['data'].encode()).decode()
+                udb['messages'].append(d)
         for b in db_conn.root.bulletins:
             udb['bulletins'].append(b.to_dict())
 
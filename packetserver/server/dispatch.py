@@ -0,0 +1,91 @@
+"""Runs request handlers on a bounded pool of worker threads instead of on the connection's receive callback."""
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from traceback import format_exc
+from typing import Callable, Optional
+
+from packetserver.common import Request, PacketServerConnection, send_blank_response
+
+default_workers = 4
+default_max_queued = 64
+
+
+class Dispatcher:
+    """Queues requests per connection and hands them to worker threads.
+
+    Requests from one connection run one at a time, in the order they arrived, so responses on a connection keep
+    their order. Different connections run in parallel, up to the number of workers. A worker runs one request and
+    then puts the connection back in line behind the others, so a busy connection can't starve quiet ones."""
+
+    def __init__(self, handle: Callable[[Request, PacketServerConnection], None], workers: int = default_workers,
+                 max_queued: int = default_max_queued):
+        self.handle = handle
+        self.workers = workers
+        self.max_queued = max_queued
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._lock = Lock()
+        self._queues = {}
+        self._scheduled = set()
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="packetserver-dispatch")
+        return self._pool
+
+    def queued(self, conn: PacketServerConnection) -> int:
+        with self._lock:
+            q = self._queues.get(id(conn))
+            return 0 if q is None else len(q)
+
+    def submit(self, conn: PacketServerConnection, req: Request) -> bool:
+        """Queues req to run after anything already queued for conn. Returns False, after answering 503, when the
+        connection already has max_queued requests waiting."""
+        key = id(conn)
+        with self._lock:
+            q = self._queues.setdefault(key, deque())
+            if len(q) >= self.max_queued:
+                full = True
+            else:
+                full = False
+                q.append((conn, req))
+                if key not in self._scheduled:
+                    self._scheduled.add(key)
+                    self._get_pool().submit(self._run_next, key)
+        if full:
+            logging.warning(f"Too many requests queued for {conn.remote_callsign}; refusing {req}")
+            send_blank_response(conn, req, status_code=503, payload="too many requests in flight")
+            return False
+        return True
+
+    def _run_next(self, key: int):
+        while True:
+            with self._lock:
+                q = self._queues.get(key)
+                if not q:
+                    self._scheduled.discard(key)
+                    self._queues.pop(key, None)
+                    return
+                conn, req = q.popleft()
+            try:
+                self.handle(req, conn)
+            except Exception:
+                logging.error(f"Unhandled exception while handling {req}:\n{format_exc()}")
+            with self._lock:
+                if not self._queues.get(key):
+                    self._scheduled.discard(key)
+                    self._queues.pop(key, None)
+                    return
+                if self._pool is not None:
+                    self._pool.submit(self._run_next, key)
+                    return
+            # shutting down: finish this connection's queue on this thread
+
+    def shutdown(self, wait: bool = True):
+        """Stops the workers, letting queued requests finish when wait is True. A later submit starts a new pool."""
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.shutdown(wait=wait)
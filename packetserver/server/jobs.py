@@ -5,21 +5,31 @@ import persistent
 import persistent.list
 from persistent.mapping import PersistentMapping
 import datetime
-from typing import Self,Union,Optional,Tuple
+from typing import Self,Union,Optional,Tuple,Iterable,BinaryIO
 from traceback import format_exc
 from packetserver.common import PacketServerConnection, Request, Response, Message, send_response, send_blank_response
+from packetserver.common import send_stream, wants_stream
 from packetserver.common.constants import no_values, yes_values
 from packetserver.server.db import get_user_db_json
 import ZODB
+from ZODB.POSException import ConflictError
 from persistent.list import PersistentList
 import logging
 from packetserver.server.users import user_authorized
+from packetserver.server.context import checkpoint
+from packetserver.server.listing import check_key, page, request_cursor, set_next_cursor
+from packetserver.server.versions import bump_version, not_modified, set_collection_version
+from bisect import bisect_right
 import gzip
+import hashlib
 import tarfile
 import time
 import json
-from packetserver.common.util import TarFileExtractor
+from packetserver.common.util import TarFileExtractor, parse_byte_range
 from packetserver.runner import Orchestrator, Runner, RunnerStatus, RunnerFile
+from packetserver.server.blobs import (store_payload, keep_payload, release_payload, payload_for_hash, payload_bytes,
+                                       payload_size, payload_range, payload_chunks, payload_file,
+                                       UnknownPayloadError, StoredData)
 from enum import Enum
 from io import BytesIO
 import base64
@@ -49,6 +59,22 @@ def get_orchestrator_from_config(cfg: dict) -> Orchestrator:
     else:
         raise RuntimeError("Runners not configured in root.config.jobs_config")
 
+def archive_artifacts(archive: bytes) -> TarFileExtractor:
+    """The files in a runner's gzipped tar of artifacts."""
+    if len(archive) == 0:
+        return TarFileExtractor(BytesIO(b''))
+    return TarFileExtractor(gzip.GzipFile(fileobj=BytesIO(archive)))
+
+def migrate_jobs(db_root: PersistentMapping):
+    """Indexes the artifacts of finished jobs stored before jobs kept an artifact index, once per database."""
+    if db_root.get('job_artifacts_indexed'):
+        return
+    for job in db_root.get('jobs', {}).values():
+        if job.is_finished and (job._artifact_index is None):
+            logging.info(f"Indexing artifacts of job {job.id}")
+            job.index_artifacts(db_root)
+    db_root['job_artifacts_indexed'] = True
+
 def get_new_job_id(root: PersistentMapping) -> int:
     if 'job_counter' not in root:
         root['job_counter'] = 1
@@ -59,6 +85,10 @@ def get_new_job_id(root: PersistentMapping) -> int:
         return current
 
 class Job(persistent.Persistent):
+    # (name, payload, sha256) for each artifact, extracted once when the job finishes so GETs and ranged GETs never
+    # unpack the archive, which isn't kept after; None for jobs stored before this, until migrate_jobs() runs
+    _artifact_index = None
+
     @classmethod
     def update_job_from_runner(cls, runner: Runner, db_root: PersistentMapping) -> True:
         job = Job.get_job_by_id(runner.job_id, db_root)
@@ -71,11 +101,12 @@ class Job(persistent.Persistent):
         job.output = runner.output
         job.errors = runner.errors
         job.return_code = runner.return_code
-        job._artifact_archive = runner._artifact_archive
+        job.index_artifacts(db_root, archive=runner._artifact_archive)
         if runner.status == RunnerStatus.SUCCESSFUL:
             job.status = JobStatus.SUCCESSFUL
         else:
             job.status = JobStatus.FAILED
+        bump_version(db_root, 'jobs')
         return True
 
     @classmethod
@@ -149,14 +180,48 @@ class Job(persistent.Persistent):
         return self.errors.decode()
 
     @property
-    def artifacts(self) -> TarFileExtractor:
-        if self._artifact_archive == b'':
-            return TarFileExtractor(BytesIO(b''))
-        else:
-            return TarFileExtractor(gzip.GzipFile(fileobj=BytesIO(self._artifact_archive)))
+    def artifacts(self) -> Iterable[Tuple[str, BinaryIO]]:
+        """(name, file) for each artifact."""
+        if self._artifact_index is not None:
+            return [(name, payload_file(payload)) for name, payload, sha256 in self._artifact_index]
+        return archive_artifacts(payload_bytes(self._artifact_archive))
+
+    def index_artifacts(self, db_root: PersistentMapping, archive: Optional[bytes] = None):
+        """Extracts each artifact from archive, the job's stored archive by default, into its own payload with its
+        sha256, and keeps that list on the job in place of the archive. Replaces any earlier index."""
+        if archive is None:
+            archive = payload_bytes(self._artifact_archive)
+        for name, payload, sha256 in (self._artifact_index or []):
+            release_payload(payload, db_root)
+        index = PersistentList()
+        for name, fileobj in archive_artifacts(archive):
+            data = fileobj.read()
+            index.append((name, store_payload(data, db_root), hashlib.sha256(data).digest()))
+        self._artifact_index = index
+        release_payload(self._artifact_archive, db_root)
+        self._artifact_archive = b''
+
+    def artifact_payloads(self) -> list[Tuple[str, Union[bytes, StoredData], bytes]]:
+        """(name, payload, sha256) for each artifact. A job not yet indexed has its archive unpacked into memory
+        for the caller, without writing anything."""
+        if self._artifact_index is not None:
+            return list(self._artifact_index)
+        out = []
+        for name, fileobj in self.artifacts:
+            data = fileobj.read()
+            out.append((name, data, hashlib.sha256(data).digest()))
+        return out
+
+    def runner_files(self) -> list[RunnerFile]:
+        """The job's files with their data read out of the payload store, for a runner working outside any
+        transaction."""
+        return [RunnerFile(f.destination_path, data=payload_bytes(f.data), root_owned=f.root_owned)
+                for f in self.files]
 
     @property
     def num_artifacts(self) -> int:
+        if self._artifact_index is not None:
+            return len(self._artifact_index)
         return len(list(self.artifacts))
 
     def __repr__(self) -> str:
@@ -175,6 +240,8 @@ class Job(persistent.Persistent):
             raise ValueError("Job must have an owner to be queued.")
 
         if self.id is None:
+            self.files = [RunnerFile(f.destination_path, data=keep_payload(f.data, db_root), root_owned=f.root_owned)
+                          for f in self.files]
             self.id = get_new_job_id(db_root)
             owner = self.owner.upper().strip()
             if owner not in db_root['user_jobs']:
@@ -182,6 +249,7 @@ class Job(persistent.Persistent):
             db_root['user_jobs'][owner].append(self.id)
             db_root['jobs'][self.id] = self
             db_root['job_queue'].append(self.id)
+            bump_version(db_root, 'jobs')
         return self.id
 
     def to_dict(self, include_data: bool = True, binary_safe: bool = False):
@@ -213,21 +281,68 @@ class Job(persistent.Persistent):
                 output['output'] = self.output
                 output['errors'] = self.errors
 
-            for a in self.artifacts:
+            for name, fileobj in self.artifacts:
+                with fileobj:
+                    data = fileobj.read()
                 if binary_safe:
-                    output['artifacts'].append((a[0], base64.b64encode(a[1].read()).decode()))
+                    output['artifacts'].append((name, base64.b64encode(data).decode()))
                 else:
-                    output['artifacts'].append((a[0], a[1].read()))
+                    output['artifacts'].append((name, data))
         return output
 
     def json(self, include_data: bool = True) -> str:
         return json.dumps(self.to_dict(include_data=include_data, binary_safe=True))
 
+def handle_job_get_artifact(req: Request, conn: PacketServerConnection, job: Job, db_root: PersistentMapping):
+    """Sends one artifact, picked by index or name with the 'artifact' var, whole or as a byte range, with the
+    jobs version. Ranges read only their piece of the stored artifact, and a whole large artifact is streamed to
+    requesters that asked for chunked responses."""
+    wanted = req.vars['artifact']
+    artifacts = job.artifact_payloads()
+    found = None
+    for entry in artifacts:
+        if entry[0] == str(wanted):
+            found = entry
+            break
+    if (found is None) and str(wanted).isdigit() and (int(wanted) < len(artifacts)):
+        found = artifacts[int(wanted)]
+    if found is None:
+        send_blank_response(conn, req, 404, payload=f"no artifact {wanted} in job {job.id}")
+        return
+    name, data, sha256 = found
+    try:
+        byte_range = parse_byte_range(req.vars)
+    except ValueError as e:
+        send_blank_response(conn, req, 400, payload=str(e))
+        return
+    response = Response.blank()
+    set_collection_version(response, req, conn, db_root, 'jobs')
+    if (byte_range is None) and wants_stream(req, payload_size(data)):
+        size = payload_size(data)
+        response.status_code = 200
+        response.payload = {'offset': 0, 'length': size, 'total_size': size, 'sha256': sha256, 'name': name}
+        send_stream(conn, response, req, payload_chunks(data), size, sha256, field='data')
+        return
+    if byte_range is None:
+        byte_range = (0, None)
+        status_code = 200
+    else:
+        status_code = 206
+    try:
+        payload = payload_range(data, byte_range, sha256=sha256)
+    except IndexError as e:
+        send_blank_response(conn, req, 416, payload=str(e))
+        return
+    payload['name'] = name
+    response.status_code = status_code
+    response.payload = payload
+    send_response(conn, response, req)
+
 def handle_job_get_id(req: Request, conn: PacketServerConnection, db: ZODB.DB, jid: int):
     username = ax25.Address(conn.remote_callsign).call.upper().strip()
     value = "y"
     include_data = True
-    data_val = req.vars['data']
+    data_val = req.vars.get('data', True)
     if data_val in no_values:
         logging.debug(f"Not including job data per variable setting in request. 'data': {req.vars['data']} ")
         include_data = False
@@ -241,8 +356,19 @@ def handle_job_get_id(req: Request, conn: PacketServerConnection, db: ZODB.DB, j
             if job.owner != username:
                 send_blank_response(conn, req, 401)
                 return
-            send_blank_response(conn, req, 200, job.to_dict(include_data=include_data))
+            if not_modified(req, conn, storage.root(), 'jobs'):
+                return
+            if 'artifact' in req.vars:
+                handle_job_get_artifact(req, conn, job, db_root=storage.root())
+                return
+            response = Response.blank()
+            response.status_code = 200
+            response.payload = job.to_dict(include_data=include_data)
+            set_collection_version(response, req, conn, storage.root(), 'jobs')
+            send_response(conn, response, req)
             return
+        except ConflictError:
+            raise
         except:
             logging.error(f"Error looking up job {jid}:\n{format_exc()}")
             send_blank_response(conn, req, 500, payload="unknown server error")
@@ -263,14 +389,37 @@ def handle_job_get_user(req: Request, conn: PacketServerConnection, db: ZODB.DB)
     if 'id_only' in req.vars:
         if req.vars['id_only'] in yes_values:
             id_only = True
+    limit = None
+    if 'limit' in req.vars:
+        try:
+            limit = int(req.vars['limit'])
+        except (ValueError, TypeError):
+            pass
+    try:
+        after = request_cursor(req, "job")
+        if after is not None:
+            check_key(after, int)
+    except ValueError as e:
+        send_blank_response(conn, req, status_code=400, payload=str(e))
+        return
+    response = Response.blank()
     with db.transaction() as storage:
-        for jid in storage.root()['user_jobs'][username]:
-            jobs.append(Job.get_job_by_id(jid, storage.root()).to_dict(include_data=include_data))
-
-    if id_only:
-        send_blank_response(conn, req, status_code=200, payload=[x['id'] for x in jobs])
-    else:
-        send_blank_response(conn, req, status_code=200, payload=jobs)
+        if not_modified(req, conn, storage.root(), 'jobs'):
+            return
+        set_collection_version(response, req, conn, storage.root(), 'jobs')
+        # job ids only grow, and each user's list is in the order their jobs were made
+        jids = list(storage.root()['user_jobs'].get(username, ()))
+        if after is not None:
+            jids = jids[bisect_right(jids, after[0]):]
+        jids, next_cursor = page(jids, lambda jid: (jid,), after=after, limit=limit, kind="job")
+        if not id_only:
+            for jid in jids:
+                jobs.append(Job.get_job_by_id(jid, storage.root()).to_dict(include_data=include_data))
+
+    response.status_code = 200
+    response.payload = jids if id_only else jobs
+    set_next_cursor(response, next_cursor)
+    send_response(conn, response, req)
 
 def handle_job_get(req: Request, conn: PacketServerConnection, db: ZODB.DB):
     spl = [x for x in req.path.split("/") if x.strip() != ""]
@@ -302,17 +451,29 @@ def handle_new_job_post(req: Request, conn: PacketServerConnection, db: ZODB.DB)
         logging.debug(f"Fetching a user db as requested.")
         try:
             dbf = RunnerFile('user-db.json.gz', data=get_user_db_json(username.lower(), db))
+        except ConflictError:
+            raise
         except:
             logging.error(format_exc())
             send_blank_response(conn, req, 500)
             return
         files.append(dbf)
     if 'files' in req.payload:
-        if type(files) is dict:
+        if type(req.payload['files']) is dict:
             for key in req.payload['files']:
                 val = req.payload['files'][key]
                 if type(val) is bytes:
                     files.append(RunnerFile(key, data=val))
+                elif (type(val) is dict) and ('sha256' in val):
+                    # a file the server already has, named by its hash
+                    try:
+                        with db.transaction() as storage:
+                            files.append(RunnerFile(key, data=payload_for_hash(val['sha256'], storage.root(),
+                                                                               size=val.get('size'))))
+                    except UnknownPayloadError as e:
+                        logging.debug(str(e))
+                        send_blank_response(conn, req, 412, payload={'missing': [val['sha256']]})
+                        return
     env = {}
     if 'env' in req.payload:
         if type(req.payload['env']) is dict:
@@ -323,10 +484,14 @@ def handle_new_job_post(req: Request, conn: PacketServerConnection, db: ZODB.DB)
         try:
             new_jid = job.queue(storage.root())
             logging.info(f"New job created with id {new_jid}")
+        except ConflictError:
+            raise
         except:
             logging.error(f"Failed to queue new job {job}:\n{format_exc()}")
             send_blank_response(conn, req, 500, "unknown server error while queuing job")
             return
+    # the worker thread has to see the queued job, and each poll below has to see the worker's progress
+    checkpoint(db)
     if quick:
         start_time = datetime.datetime.now(datetime.UTC)
         now = datetime.datetime.now(datetime.UTC)
@@ -334,6 +499,7 @@ def handle_new_job_post(req: Request, conn: PacketServerConnection, db: ZODB.DB)
         quick_job = None
         logging.debug(f"{start_time}: Waiting for a quick job for 30 seconds")
         while (now - start_time).total_seconds() < 30:
+            checkpoint(db)
             with db.transaction() as storage:
                 try:
                     j = Job.get_job_by_id(new_jid, storage.root())
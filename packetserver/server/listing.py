@@ -0,0 +1,121 @@
+"""Opaque cursors for paging through listings.
+
+A cursor is the sort key of the last item on a page, packed and base64 encoded with the name of the listing it
+belongs to. Handlers resume from it by starting their ordered index just past that key, so a page costs about the
+same no matter how deep into the listing it is."""
+import base64
+import binascii
+import datetime
+import heapq
+from typing import Callable, Iterable, Optional, Sequence, Tuple
+
+import msgpack
+
+from packetserver.common import Request, Response
+from packetserver.common.constants import cursor_var, next_cursor_var
+
+default_page_size = 50
+epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.UTC)
+
+
+def micros(dt: datetime.datetime) -> int:
+    """Microseconds since the epoch, treating naive datetimes as UTC; datetimes don't fit in a cursor as is."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.UTC)
+    return (dt - epoch) // datetime.timedelta(microseconds=1)
+
+
+def encode_cursor(kind: str, key: Sequence) -> str:
+    packed = msgpack.packb([kind, list(key)])
+    return base64.urlsafe_b64encode(packed).decode().rstrip("=")
+
+
+def decode_cursor(kind: str, cursor: str) -> tuple:
+    """Returns the key in cursor. Raises ValueError if it isn't a cursor for this kind of listing."""
+    try:
+        cursor = str(cursor).strip()
+        packed = base64.urlsafe_b64decode(cursor + ("=" * (-len(cursor) % 4)))
+        cursor_kind, key = msgpack.unpackb(packed)
+    except (binascii.Error, ValueError, TypeError, msgpack.exceptions.ExtraData, msgpack.exceptions.FormatError,
+            msgpack.exceptions.StackError):
+        raise ValueError("malformed cursor")
+    if (cursor_kind != kind) or (type(key) is not list):
+        raise ValueError(f"not a cursor for {kind} listings")
+    return tuple(key)
+
+
+def request_cursor(req: Request, kind: str) -> Optional[tuple]:
+    """The key to resume after, from the request's 'cursor' (or 'after') var. Raises ValueError for a bad one."""
+    cursor = req.vars.get(cursor_var)
+    if cursor is None:
+        cursor = req.vars.get('after')
+    if (cursor is None) or (cursor == ""):
+        return None
+    return decode_cursor(kind, cursor)
+
+
+def check_key(after: tuple, *types: type):
+    """Raises ValueError unless the cursor key has one element of each of types, so comparing it against real keys
+    can't fail."""
+    if (len(after) != len(types)) or any(type(k) is not t for k, t in zip(after, types)):
+        raise ValueError("cursor doesn't fit this listing")
+
+
+def no_limit(limit: Optional[int]) -> Optional[int]:
+    """None for the limits that mean 'everything': None itself, and anything not above 0."""
+    if (limit is None) or (limit <= 0):
+        return None
+    return limit
+
+
+def page(items: Iterable, key: Callable, after: Optional[tuple] = None, limit: Optional[int] = None,
+         reverse: bool = False, kind: str = "") -> Tuple[list, Optional[str]]:
+    """Takes up to limit items that come after the cursor key. items must already be in key order, descending when
+    reverse is True. Returns the page and the cursor for the next one, or None if this was the last page.
+
+    A limit of 0 or less means no limit, as clients have always been able to ask for everything that way.
+
+    Items before the cursor are skipped one at a time, so handlers with an ordered index should start items at the
+    cursor; the check then costs nothing."""
+    limit = no_limit(limit)
+    out = []
+    more = False
+    for item in items:
+        k = tuple(key(item))
+        if after is not None:
+            if (not reverse) and (k <= after):
+                continue
+            if reverse and (k >= after):
+                continue
+        if (limit is not None) and (len(out) >= limit):
+            more = True
+            break
+        out.append((k, item))
+    if more and out:
+        return [i for k, i in out], encode_cursor(kind, out[-1][0])
+    return [i for k, i in out], None
+
+
+def top_page(items: Iterable, key: Callable, after: Optional[tuple] = None, limit: Optional[int] = None,
+             reverse: bool = False, kind: str = "") -> Tuple[list, Optional[str]]:
+    """page() for items in no particular order. Rather than sorting everything, keeps the limit + 1 best items past
+    the cursor in a heap, so a short page of a long listing costs O(n log limit) and holds only limit + 1 items."""
+    limit = no_limit(limit)
+    keyed = ((tuple(key(item)), n, item) for n, item in enumerate(items))
+    if after is not None:
+        if reverse:
+            keyed = (entry for entry in keyed if entry[0] < after)
+        else:
+            keyed = (entry for entry in keyed if entry[0] > after)
+    if limit is None:
+        chosen = sorted(keyed, reverse=reverse)
+    elif reverse:
+        chosen = heapq.nlargest(limit + 1, keyed)
+    else:
+        chosen = heapq.nsmallest(limit + 1, keyed)
+    return page((item for k, n, item in chosen), key, limit=limit, reverse=reverse, kind=kind)
+
+
+def set_next_cursor(response: Response, cursor: Optional[str]):
+    if cursor is not None:
+        response.set_var(next_cursor_var, cursor)
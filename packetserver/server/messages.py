@@ -4,46 +4,167 @@ import persistent
 import persistent.list
 from persistent.mapping import PersistentMapping
 import datetime
-from typing import Self,Union,Optional,Iterable,Sequence
+from typing import Self,Union,Optional,Iterable,Sequence,Callable
 from packetserver.common import PacketServerConnection, Request, Response, send_response, send_blank_response
 from packetserver.common import Message as PacketMessage
 from packetserver.common.constants import yes_values, no_values
 from packetserver.common.util import from_date_digits, to_date_digits
 import ZODB
+from ZODB.POSException import ConflictError
 import logging
 import uuid
 from uuid import UUID
 from packetserver.common.util import email_valid
 from packetserver.server.objects import Object
 from packetserver.server.users import User
-from BTrees.OOBTree import TreeSet
+from BTrees.OOBTree import TreeSet, OOBTree
+from BTrees.Length import Length
 from packetserver.server.users import User, user_authorized
+from packetserver.server.search import SearchIndex, get_index
+from packetserver.server.blobs import (keep_payload, release_payload, payload_for_hash, payload_bytes, payload_size,
+                                       payload_equals, missing_payloads, store_streamed_body, StoredData,
+                                       UnknownPayloadError)
+from packetserver.server.listing import micros as timestamp_micros, request_cursor, page, top_page, set_next_cursor
+from packetserver.server.versions import bump_version, not_modified, set_collection_version
 from traceback import format_exc
 from collections import namedtuple
 import re
+from itertools import takewhile
 
 since_regex = """^message\\/since\\/(\\d+)$"""
 
-def mailbox_create(username: str, db_root: PersistentMapping):
+class Mailbox(persistent.Persistent):
+    """One user's messages, in an OOBTree keyed by (sent_at in microseconds, msg_id bytes) so they stay in time
+    order, with an index from msg_id to that key. Appending touches a bucket or two instead of rewriting every
+    message reference, since queries can start from a point in time, and lookups by id don't scan."""
+
+    def __init__(self, messages: Iterable = ()):
+        self.messages = OOBTree()
+        self.ids = OOBTree()
+        for msg in messages:
+            self.append(msg)
+
+    @staticmethod
+    def key_for(msg) -> tuple:
+        return timestamp_micros(msg.sent_at), msg.msg_id.bytes
+
+    def append(self, msg):
+        key = self.key_for(msg)
+        old_key = self.ids.get(msg.msg_id)
+        if (old_key is not None) and (old_key != key):
+            del self.messages[old_key]
+        self.messages[key] = msg
+        self.ids[msg.msg_id] = key
+
+    def get(self, msg_id: UUID):
+        key = self.ids.get(msg_id)
+        if key is None:
+            return None
+        return self.messages.get(key)
+
+    def remove(self, msg_id: UUID):
+        key = self.ids.pop(msg_id)
+        del self.messages[key]
+
+    def since(self, since_date: datetime.datetime) -> Iterable:
+        """Messages sent at or after since_date, oldest first."""
+        return self.messages.values(min=(timestamp_micros(since_date), b''))
+
+    def oldest_first(self, after: Optional[tuple] = None) -> Iterable:
+        if after is None:
+            return self.messages.values()
+        return self.messages.values(min=after, excludemin=True)
+
+    def newest_first(self, before: Optional[tuple] = None) -> Iterable:
+        """Messages newest first, starting just before the key before. BTrees only iterate forwards, so this steps
+        back one maxKey lookup at a time."""
+        key = before
+        while True:
+            try:
+                if key is None:
+                    key = self.messages.maxKey()
+                else:
+                    key = self.messages.maxKey(key_before(key))
+            except ValueError:
+                return
+            yield self.messages[key]
+
+    def __iter__(self):
+        return iter(self.messages.values())
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, msg_id: UUID) -> bool:
+        return msg_id in self.ids
+
+    def search(self, query: str, db_root: PersistentMapping) -> list:
+        """Messages in this mailbox matching query according to root.message_index, in no particular order."""
+        return [self.get(msg_id) for msg_id in message_index(db_root).search(query, within=self.ids)]
+
+    def __repr__(self):
+        return f"<Mailbox: {len(self)} messages>"
+
+def key_before(key: tuple) -> tuple:
+    """The largest possible mailbox key smaller than key."""
+    sent, msg_id = int(key[0]), bytes(key[1])
+    if len(msg_id) != 16:
+        raise ValueError("malformed mailbox key")
+    n = int.from_bytes(msg_id)
+    if n > 0:
+        return sent, (n - 1).to_bytes(16)
+    return sent - 1, b'\xff' * 16
+
+def open_mailbox(username: str, db_root: PersistentMapping) -> Mailbox:
+    """Returns the user's mailbox, creating it if needed and converting it from the PersistentList older
+    databases used the first time it's opened."""
+    un = username.upper().strip()
+    if 'messages' not in db_root:
+        db_root['messages'] = PersistentMapping()
+    mb = db_root['messages'].get(un)
+    if type(mb) is not Mailbox:
+        if mb is not None:
+            logging.info(f"Migrating mailbox for {un} ({len(mb)} messages)")
+        mb = Mailbox(mb or ())
+        db_root['messages'][un] = mb
+        index = message_index(db_root)
+        for msg in mb:
+            if msg.msg_id not in index:
+                index_message(msg, index)
+    return mb
+
+def mailbox_create(username: str, db_root: PersistentMapping) -> Mailbox:
     un = username.upper().strip()
     u = User.get_user_by_username(un, db_root)
     if u is None:
         raise KeyError(f"Username {username} does not exist.")
     if not u.enabled:
         raise KeyError(f"Username {username} does not exist.")
-    if un not in db_root['messages']:
-        db_root['messages'][un] = persistent.list.PersistentList()
+    return open_mailbox(un, db_root)
 
 
 def global_unique_message_uuid(db_root: PersistentMapping) -> UUID:
     if "message_uuids" not in db_root:
         db_root['message_uuids'] = TreeSet()
         logging.debug("Created message_uuid set for global message ids.")
+    bodies = message_bodies(db_root)
     uid = uuid.uuid4()
-    while uid in db_root['message_uuids']:
+    while (uid in db_root['message_uuids']) or (uid in bodies):
         uid = uuid.uuid4()
     return uid
 
+def message_index(db_root: PersistentMapping) -> SearchIndex:
+    return get_index('message_index', db_root)
+
+def index_message(msg, index: SearchIndex):
+    to = [msg.msg_to] if type(msg.msg_to) is str else [x for x in msg.msg_to if x]
+    index.index(msg.msg_id, msg.text, msg.msg_from, *to)
+
+def message_bodies(db_root: PersistentMapping) -> OOBTree:
+    if 'message_bodies' not in db_root:
+        db_root['message_bodies'] = OOBTree()
+    return db_root['message_bodies']
+
 class Attachment:
     """Name and data that is sent with a message."""
     def __init__(self, name: str, data: Union[bytes,bytearray,str]):
@@ -71,33 +192,52 @@ class Attachment:
     @property
     def data(self) -> Union[str,bytes]:
         if self.binary:
-            return self._data
+            return payload_bytes(self._data)
         else:
-            return self._data.decode()
+            return payload_bytes(self._data).decode()
 
     @data.setter
     def data(self, data: Union[bytes,bytearray,str]):
         if type(data) in (bytes,bytearray):
-            if bytes(data) != self._data:
+            if not payload_equals(self._data, bytes(data)):
                 self._data = bytes(data)
                 self._binary = True
         else:
-            if str(data).encode() != self._data:
+            if not payload_equals(self._data, str(data).encode()):
                 self._data = str(data).encode()
                 self._binary = False
 
+    def keep(self, db_root: PersistentMapping):
+        """Moves large data into root.payload_store, for when the attachment is written with a message."""
+        self._data = keep_payload(self._data, db_root)
+
+    def release(self, db_root: PersistentMapping):
+        release_payload(self._data, db_root)
+
     @property
     def size(self) -> int:
-        return len(self.data)
+        """Size of the data in bytes, known without reading it."""
+        return payload_size(self._data)
 
     def copy(self):
         return Attachment(self.name, self.data)
 
     @classmethod
-    def from_dict(cls, attachment: dict):
+    def from_dict(cls, attachment: dict, db_root: Optional[PersistentMapping] = None):
+        """With db_root, the dict can name data the server already has by its sha256 instead of carrying it.
+        Raises UnknownPayloadError if it doesn't. Data already stored from a streamed upload is taken as is."""
         name = attachment.get("name")
         data = attachment.get("data")
-        return Attachment(name, data)
+        if isinstance(data, StoredData):
+            payload = data
+        elif (data is None) and ('sha256' in attachment) and (db_root is not None):
+            payload = payload_for_hash(attachment['sha256'], db_root, size=attachment.get('size'))
+        else:
+            return Attachment(name, data)
+        a = Attachment(name, b'')
+        a._data = payload
+        a._binary = bool(attachment.get('binary', True))
+        return a
 
     def to_dict(self, include_data: bool = True):
         d = {
@@ -197,8 +337,11 @@ class Message(persistent.Persistent):
         return d
 
     @classmethod
-    def from_dict(cls, data: dict) -> Self:
-        return Message(data['text'],msg_to=data.get('to'), attachments=data.get("attachments"))
+    def from_dict(cls, data: dict, db_root: Optional[PersistentMapping] = None) -> Self:
+        attachments = data.get("attachments")
+        if attachments and (db_root is not None):
+            attachments = [Attachment.from_dict(a, db_root) if type(a) is dict else a for a in attachments]
+        return Message(data['text'],msg_to=data.get('to'), attachments=attachments)
 
     def send(self, db: ZODB.DB) -> tuple:
         if self.msg_delivered:
@@ -232,27 +375,116 @@ class Message(persistent.Persistent):
             if self.msg_from.upper().strip() in recipients:
                 recipients.remove(self.msg_from.upper().strip())
                 send_counter = send_counter + 1
+            # one body for everyone; each mailbox just gets a small reference to it
+            self.sent_at = datetime.datetime.now(datetime.UTC)
+            body = store_message_body(MessageBody(self.msg_id, self.text, self.msg_from, self.msg_to,
+                                                  attachments=new_attachments, sent_at=self.sent_at), db.root())
             for recipient in recipients:
-                msg = Message(self.text, recipient, self.msg_from, attachments=[x.copy() for x in new_attachments])
-                msg.msg_id = self.msg_id
                 try:
-                    mailbox_create(recipient, db.root())
-                    msg.msg_delivered = True
-                    msg.sent_at = datetime.datetime.now(datetime.UTC)
-                    if to_all:
-                        msg.msg_to = 'ALL'
-                    db.root.messages[recipient].append(msg)
+                    mb = mailbox_create(recipient, db.root())
+                    deliver_message(body, mb, msg_to='ALL' if to_all else (recipient,))
                     send_counter = send_counter + 1
+                except ConflictError:
+                    raise
                 except:
                     logging.error(f"Error sending message to {recipient}:\n{format_exc()}")
                     failed.append(recipient)
             self.msg_delivered = True
-            msg = Message(self.text, recipient, self.msg_from, attachments=[x.copy() for x in new_attachments])
-            msg.msg_id = self.msg_id
-            msg.msg_to = self.msg_to
-            db.root.messages[self.msg_from.upper().strip()].append(msg)
+            deliver_message(body, open_mailbox(self.msg_from, db.root()))
         return send_counter, failed, self.msg_id
 
+class MessageBody(persistent.Persistent):
+    """The part of a sent message every recipient shares: text, sender, addressees and attachments. Stored once in
+    root.message_bodies under its msg_id, and counted by the MessageRefs pointing at it."""
+    def __init__(self, msg_id: UUID, text: str, msg_from: str, msg_to: tuple, attachments: Iterable[Attachment] = (),
+                 sent_at: Optional[datetime.datetime] = None):
+        self.msg_id = msg_id
+        self.text = text
+        self.msg_from = msg_from
+        self.msg_to = msg_to
+        self.attachments = tuple(attachments)
+        if sent_at is None:
+            sent_at = datetime.datetime.now(datetime.UTC)
+        self.sent_at = sent_at
+        self.refs = Length()
+
+    def __repr__(self):
+        return f"<MessageBody: ID: {self.msg_id}, refs: {self.refs()}>"
+
+class MessageRef(Message):
+    """A recipient's copy of a message: its own retrieved flag and addressing, with the text and attachments read
+    from the shared MessageBody."""
+    def __init__(self, body: MessageBody, msg_to: Union[tuple, str, None] = None,
+                 sent_at: Optional[datetime.datetime] = None):
+        self.body = body
+        self.msg_id = body.msg_id
+        self.retrieved = False
+        self.msg_delivered = True
+        self.sent_at = sent_at or body.sent_at
+        self.msg_to = body.msg_to if msg_to is None else msg_to
+
+    @property
+    def text(self) -> str:
+        return self.body.text
+
+    @property
+    def attachments(self) -> tuple:
+        return self.body.attachments
+
+    @property
+    def msg_from(self) -> str:
+        return self.body.msg_from
+
+    def __repr__(self):
+        return f"<MessageRef: ID: {self.msg_id}, Retrieved: {self.retrieved}>"
+
+def store_message_body(body: MessageBody, db_root: PersistentMapping) -> MessageBody:
+    """Stores a new message's body. Deliveries follow in the same transaction, so this is where the messages version
+    goes up for them."""
+    for attachment in body.attachments:
+        attachment.keep(db_root)
+    message_bodies(db_root)[body.msg_id] = body
+    index_message(body, message_index(db_root))
+    bump_version(db_root, 'messages')
+    return body
+
+def deliver_message(body: MessageBody, mailbox: Mailbox, msg_to: Union[tuple, str, None] = None) -> Message:
+    """Puts a reference to body in mailbox, unless the mailbox already has this message."""
+    existing = mailbox.get(body.msg_id)
+    if existing is not None:
+        return existing
+    ref = MessageRef(body, msg_to=msg_to)
+    mailbox.append(ref)
+    body.refs.change(1)
+    return ref
+
+def delete_message(username: str, msg_id: UUID, db_root: PersistentMapping) -> bool:
+    """Removes a message from a user's mailbox, dropping its shared body once no mailbox refers to it."""
+    mb = open_mailbox(username, db_root)
+    msg = mb.get(msg_id)
+    if msg is None:
+        return False
+    mb.remove(msg_id)
+    bump_version(db_root, 'messages')
+    if isinstance(msg, MessageRef):
+        msg.body.refs.change(-1)
+        if msg.body.refs() <= 0:
+            bodies = message_bodies(db_root)
+            if bodies.get(msg_id) is msg.body:
+                del bodies[msg_id]
+                message_index(db_root).remove(msg_id)
+                for attachment in msg.body.attachments:
+                    attachment.release(db_root)
+    return True
+
+def mark_retrieved(msg: Message, db_root: PersistentMapping) -> bool:
+    """Flags msg as retrieved. Returns False, and writes nothing, if it already was."""
+    if msg.retrieved:
+        return False
+    msg.retrieved = True
+    bump_version(db_root, 'messages')
+    return True
+
 DisplayOptions = namedtuple('DisplayOptions', ['get_text', 'limit', 'sort_by', 'reverse', 'search',
                                                'get_attachments', 'sent_received_all'])
 
@@ -318,6 +550,56 @@ def parse_display_options(req: Request) -> DisplayOptions:
 
     return DisplayOptions(get_text, limit, sort_by, reverse, search, get_attachments, sent_received_all)
 
+def message_sort_key(mb: Mailbox, sort_by: str) -> Callable:
+    if sort_by == "from":
+        return lambda msg: (msg.msg_from or "",) + mb.key_for(msg)
+    elif sort_by == "to":
+        return lambda msg: (msg.msg_to if type(msg.msg_to) is str else ",".join(x for x in msg.msg_to if x),) \
+                           + mb.key_for(msg)
+    return mb.key_for
+
+def check_message_cursor(after: tuple, sort_by: str):
+    """Raises ValueError unless after is a key of the shape message_sort_key gives for sort_by."""
+    head, tail = (after[:-2], after[-2:]) if len(after) >= 2 else ((), ())
+    prefix_ok = (len(head) == 0) if sort_by == "date" else ((len(head) == 1) and (type(head[0]) is str))
+    if (not prefix_ok) or (len(tail) != 2) or (type(tail[0]) is not int) or (type(tail[1]) is not bytes) \
+            or (len(tail[1]) != 16):
+        raise ValueError(f"cursor doesn't fit messages sorted by {sort_by}")
+
+def list_mailbox(mb: Mailbox, opts: DisplayOptions, db_root: PersistentMapping,
+                 since_date: Optional[datetime.datetime] = None, after: Optional[tuple] = None) -> tuple[list, Optional[str]]:
+    """One page of a mailbox as message dicts, plus the cursor for the next page. Date order, the default, walks the
+    mailbox tree from the cursor; other orders and searches pick the page out of the candidates with a heap. Only
+    the messages returned are serialized and marked retrieved."""
+    if after is not None:
+        check_message_cursor(after, opts.sort_by)
+    key = message_sort_key(mb, opts.sort_by)
+    since_key = None if since_date is None else (timestamp_micros(since_date), b'')
+    ordered = True
+    if opts.search:
+        ordered = False
+        candidates = mb.search(opts.search, db_root)
+        if since_key is not None:
+            candidates = (msg for msg in candidates if mb.key_for(msg) >= since_key)
+    elif opts.sort_by != "date":
+        ordered = False
+        candidates = mb.since(since_date) if since_date is not None else mb.oldest_first()
+    elif opts.reverse:
+        candidates = takewhile(lambda msg: (since_key is None) or (mb.key_for(msg) >= since_key),
+                               mb.newest_first(before=after))
+    elif (after is None) or ((since_key is not None) and (after < since_key)):
+        candidates = mb.since(since_date) if since_date is not None else mb.oldest_first()
+    else:
+        candidates = mb.oldest_first(after=after)
+    select = page if ordered else top_page
+    messages, next_cursor = select(candidates, key, after=after, limit=opts.limit, reverse=opts.reverse,
+                                   kind="message")
+    msg_return = []
+    for msg in messages:
+        mark_retrieved(msg, db_root)
+        msg_return.append(msg.to_dict(get_text=opts.get_text, get_attachments=opts.get_attachments))
+    return msg_return, next_cursor
+
 def handle_messages_since(req: Request, conn: PacketServerConnection, db: ZODB.DB):
     if req.method is not Request.Method.GET:
         send_blank_response(conn, req, 400, "method not implemented")
@@ -328,77 +610,72 @@ def handle_messages_since(req: Request, conn: PacketServerConnection, db: ZODB.D
     except ValueError as v:
         send_blank_response(conn, req, 400, "invalid date string")
         return
+    except ConflictError:
+        raise
     except:
         send_blank_response(conn, req, 500, "unknown error")
         logging.error(f"Unhandled exception: {format_exc()}")
         return
     opts = parse_display_options(req)
     username = ax25.Address(conn.remote_callsign).call.upper().strip()
-    msg_return = []
+    try:
+        after = request_cursor(req, "message")
+    except ValueError as e:
+        send_blank_response(conn, req, 400, str(e))
+        return
+    response = Response.blank()
     with db.transaction() as db:
-        mailbox_create(username, db.root())
-        mb = db.root.messages[username]
+        if not_modified(req, conn, db.root(), 'messages'):
+            return
+        mb = mailbox_create(username, db.root())
         logging.debug(f"Only grabbing messages since {since_date}")
-        new_mb = [msg for msg in mb if msg.sent_at >= since_date]
-        if len(new_mb) > 0:
-            logging.debug(f"First message in new list: {new_mb[0].sent_at}")
-            logging.debug(f"Last message in new list: {new_mb[-1].sent_at}")
-        if opts.search:
-            messages = [msg for msg in new_mb if (opts.search in msg.text.lower()) or (opts.search in msg.msg_to[0].lower())
-                        or (opts.search in msg.msg_from.lower())]
-        else:
-            messages = [msg for msg in new_mb]
-
-        if opts.sort_by == "from":
-            messages.sort(key=lambda x: x.msg_from, reverse=opts.reverse)
-        elif opts.sort_by == "to":
-            messages.sort(key=lambda x: x.msg_to, reverse=opts.reverse)
-        else:
-            messages.sort(key=lambda x: x.sent_at, reverse=opts.reverse)
+        try:
+            msg_return, next_cursor = list_mailbox(mb, opts, db.root(), since_date=since_date, after=after)
+        except ValueError as e:
+            send_blank_response(conn, req, 400, str(e))
+            return
+        set_collection_version(response, req, conn, db.root(), 'messages')
 
-        for i in range(0, len(messages)):
-            if opts.limit and (len(msg_return) >= opts.limit):
-                break
-
-            msg = messages[i]
-            msg.retrieved = True
-            msg_return.append(msg.to_dict(get_text=opts.get_text, get_attachments=opts.get_attachments))
-
-    response = Response.blank()
     response.status_code = 200
     response.payload = msg_return
+    set_next_cursor(response, next_cursor)
     send_response(conn, response, req)
 
-def handle_message_get_id(req: Request, conn: PacketServerConnection, db: ZODB.DB):
-    uuid_val = req.vars['id']
-    obj_uuid = None
+def request_message_id(req: Request) -> Optional[UUID]:
+    """The message id in the request's 'id' var, given as bytes, an int or a string; None if it isn't one."""
+    uuid_val = req.vars.get('id')
     try:
         if type(uuid_val) is bytes:
-            obj_uuid = UUID(bytes=uuid_val)
+            return UUID(bytes=uuid_val)
         elif type(uuid_val) is int:
-            obj_uuid = UUID(int=uuid_val)
+            return UUID(int=uuid_val)
         elif type(uuid_val) is str:
-            obj_uuid = UUID(uuid_val)
+            return UUID(uuid_val)
     except:
         pass
+    return None
+
+def handle_message_get_id(req: Request, conn: PacketServerConnection, db: ZODB.DB):
+    obj_uuid = request_message_id(req)
     if obj_uuid is None:
         send_blank_response(conn, req, 400)
         return
     opts = parse_display_options(req)
     username = ax25.Address(conn.remote_callsign).call.upper().strip()
     msg = None
+    response = Response.blank()
     with db.transaction() as db:
-        mailbox_create(username, db.root())
-        for m in db.root.messages[username]:
-            if m.msg_id == obj_uuid:
-                msg = m
-                break
+        if not_modified(req, conn, db.root(), 'messages'):
+            return
+        set_collection_version(response, req, conn, db.root(), 'messages')
+        msg = mailbox_create(username, db.root()).get(obj_uuid)
     if msg is None:
         send_blank_response(conn, req, status_code=404)
         return
     else:
-        send_blank_response(conn, req,
-                            payload=msg.to_dict(get_text=opts.get_text, get_attachments=opts.get_attachments))
+        response.status_code = 200
+        response.payload = msg.to_dict(get_text=opts.get_text, get_attachments=opts.get_attachments)
+        send_response(conn, response, req)
 
 def handle_message_get(req: Request, conn: PacketServerConnection, db: ZODB.DB):
     if 'id' in req.vars:
@@ -408,41 +685,46 @@ def handle_message_get(req: Request, conn: PacketServerConnection, db: ZODB.DB):
         return handle_messages_since(req, conn, db)
 
     opts = parse_display_options(req)
-    username = ax25.Address(conn.remote_callsign).call.upper().strip() 
-    msg_return = []
+    username = ax25.Address(conn.remote_callsign).call.upper().strip()
+    try:
+        after = request_cursor(req, "message")
+    except ValueError as e:
+        send_blank_response(conn, req, 400, str(e))
+        return
+    response = Response.blank()
     with db.transaction() as db:
-        mailbox_create(username, db.root())
-        mb = db.root.messages[username]
-        if opts.search:
-            messages = [msg for msg in mb if (opts.search in msg.text.lower()) or (opts.search in msg.msg_to[0].lower())
-                        or (opts.search in msg.msg_from.lower())]
-        else:
-            messages = [msg for msg in mb]
-
-        if opts.sort_by == "from":
-            messages.sort(key=lambda x: x.msg_from, reverse=opts.reverse)
-        elif opts.sort_by == "to":
-            messages.sort(key=lambda x: x.msg_to, reverse=opts.reverse)
-        else:
-            messages.sort(key=lambda x: x.sent_at, reverse=opts.reverse)
+        if not_modified(req, conn, db.root(), 'messages'):
+            return
+        mb = mailbox_create(username, db.root())
+        try:
+            msg_return, next_cursor = list_mailbox(mb, opts, db.root(), after=after)
+        except ValueError as e:
+            send_blank_response(conn, req, 400, str(e))
+            return
+        set_collection_version(response, req, conn, db.root(), 'messages')
 
-        for i in range(0, len(messages)):
-            if opts.limit and (len(msg_return) >= opts.limit):
-                break
-
-            msg = messages[i]
-            msg.retrieved = True
-            msg_return.append(msg.to_dict(get_text=opts.get_text, get_attachments=opts.get_attachments))
-
-    response = Response.blank()
     response.status_code = 200
     response.payload = msg_return
+    set_next_cursor(response, next_cursor)
     send_response(conn, response, req)
 
 def handle_message_post(req: Request, conn: PacketServerConnection, db: ZODB.DB):
     username = ax25.Address(conn.remote_callsign).call.upper().strip()
     try:
-        msg = Message.from_dict(req.payload)
+        with db.transaction() as storage:
+            attachments = req.payload.get('attachments') or []
+            missing = missing_payloads(attachments, storage.root()) if type(attachments) is list else []
+            if missing:
+                # the client offered hashes we don't have; it should resend with the data for these
+                send_blank_response(conn, req, status_code=412, payload={'missing': missing})
+                return
+            store_streamed_body(req, storage.root())
+            msg = Message.from_dict(req.payload, db_root=storage.root())
+    except UnknownPayloadError as e:
+        send_blank_response(conn, req, status_code=412, payload={'missing': [], 'error': str(e)})
+        return
+    except ConflictError:
+        raise
     except:
         send_blank_response(conn, req, status_code=400)
         logging.warning(f"User '{username}' attempted to post message with invalid payload: {req.payload}")
@@ -450,6 +732,8 @@ def handle_message_post(req: Request, conn: PacketServerConnection, db: ZODB.DB)
     msg.msg_from = username
     try:
         send_counter, failed, msg_id = msg.send(db)
+    except ConflictError:
+        raise
     except:
         send_blank_response(conn, req, status_code=500)
         logging.error(f"Error while attempting to send message:\n{format_exc()}")
@@ -460,6 +744,19 @@ def handle_message_post(req: Request, conn: PacketServerConnection, db: ZODB.DB)
         "failed": failed,
         'msg_id': str(msg_id)})
 
+def handle_message_delete(req: Request, conn: PacketServerConnection, db: ZODB.DB):
+    """Deletes the message named by the 'id' var from the requester's own mailbox."""
+    msg_id = request_message_id(req)
+    if msg_id is None:
+        send_blank_response(conn, req, status_code=400, payload="delete needs a message 'id'")
+        return
+    username = ax25.Address(conn.remote_callsign).call.upper().strip()
+    with db.transaction() as storage:
+        if not delete_message(username, msg_id, storage.root()):
+            send_blank_response(conn, req, status_code=404)
+            return
+    send_blank_response(conn, req, status_code=200)
+
 def message_root_handler(req: Request, conn: PacketServerConnection, db: ZODB.DB):
     logging.debug(f"{req} being processed by message_root_handler")
     if not user_authorized(conn, db):
@@ -471,6 +768,8 @@ def message_root_handler(req: Request, conn: PacketServerConnection, db: ZODB.DB
         handle_message_get(req, conn, db)
     elif req.method is Request.Method.POST:
         handle_message_post(req, conn, db)
+    elif req.method is Request.Method.DELETE:
+        handle_message_delete(req, conn, db)
     else:
         send_blank_response(conn, req, status_code=404)
 
@@ -1,16 +1,19 @@
 """Server object storage system."""
 import traceback
-from copy import deepcopy
 
 import persistent
 import ax25
 import persistent.list
 from persistent.mapping import PersistentMapping
 import datetime
-from typing import Self,Union,Optional
+from typing import Self,Union,Optional,Iterable,Iterator,Tuple
 from packetserver.common import PacketServerConnection, Request, Response, Message, send_response, send_blank_response
+from packetserver.common import send_stream, wants_stream
+from packetserver.common import compression
 import ZODB
+from ZODB.POSException import ConflictError
 from ZODB.Connection import Connection
+from BTrees.OOBTree import OOBTree
 import logging
 import uuid
 from uuid import UUID
@@ -18,10 +21,97 @@ from packetserver.server.users import User, user_authorized
 from collections import namedtuple
 from traceback import format_exc
 import base64
+from packetserver.common.util import parse_byte_range
+from packetserver.common import delta
+from packetserver.server.listing import micros, check_key, top_page, request_cursor, set_next_cursor
+from packetserver.server.versions import bump_version, not_modified, set_collection_version
+from packetserver.server.blobs import (store_payload, keep_payload, release_payload, payload_for_hash, payload_bytes,
+                                       payload_size, payload_sha256, payload_equals, payload_chunks, payload_range,
+                                       chunk_size, store_streamed_body, StoredData, UnknownPayloadError)
+import hashlib
+
+class ObjectMeta(namedtuple('ObjectMeta', ['uuid', 'name', 'size', 'binary', 'private', 'created_at',
+                                           'modified_at', 'owner'])):
+    """What a listing needs to know about an object, without its data."""
+    __slots__ = ()
+
+    @classmethod
+    def from_object(cls, obj: 'Object') -> Self:
+        return cls(obj.uuid, obj.name, obj.size, obj.binary, obj.private, obj.created_at, obj.modified_at,
+                   obj.owner)
+
+    def to_dict(self) -> dict:
+        """Same as Object.to_dict(include_data=False)."""
+        return {
+            "name": self.name,
+            "uuid_bytes": self.uuid.bytes,
+            "size_bytes": self.size,
+            "binary": self.binary,
+            "private": self.private,
+            "created_at": self.created_at.isoformat(),
+            "modified_at": self.modified_at.isoformat(),
+            "includes_data": False,
+            "data": b''
+        }
+
+class ObjectIndex(persistent.Persistent):
+    """ObjectMeta records for every owned object, grouped by owner UUID, so listing a user's objects reads a few
+    small buckets instead of loading each object and its data."""
+
+    def __init__(self):
+        self.owners = OOBTree()
+        self.owner_of = OOBTree()
+
+    def __contains__(self, obj_uuid: UUID) -> bool:
+        return obj_uuid in self.owner_of
+
+    def index(self, obj: 'Object'):
+        if obj.uuid is None:
+            return
+        old_owner = self.owner_of.get(obj.uuid)
+        if (old_owner is not None) and (old_owner != obj.owner):
+            self.remove(obj.uuid)
+        if obj.owner is None:
+            return
+        records = self.owners.get(obj.owner)
+        if records is None:
+            records = OOBTree()
+            self.owners[obj.owner] = records
+        meta = ObjectMeta.from_object(obj)
+        if records.get(obj.uuid) != meta:
+            records[obj.uuid] = meta
+        if old_owner != obj.owner:
+            self.owner_of[obj.uuid] = obj.owner
+
+    def remove(self, obj_uuid: UUID):
+        owner = self.owner_of.get(obj_uuid)
+        if owner is None:
+            return
+        del self.owner_of[obj_uuid]
+        records = self.owners.get(owner)
+        if records is not None:
+            if obj_uuid in records:
+                del records[obj_uuid]
+            if len(records) == 0:
+                del self.owners[owner]
+
+    def owned_by(self, owner_uuid: UUID) -> Iterable[ObjectMeta]:
+        records = self.owners.get(owner_uuid)
+        return () if records is None else records.values()
+
+def object_index(db_root: PersistentMapping) -> ObjectIndex:
+    """root.object_index, built from root.objects the first time it's needed."""
+    if 'object_index' not in db_root:
+        index = ObjectIndex()
+        for obj in db_root.get('objects', {}).values():
+            index.index(obj)
+        db_root['object_index'] = index
+    return db_root['object_index']
 
 class Object(persistent.Persistent):
     def __init__(self, name: str = "", data: Union[bytes,bytearray,str] = None):
-        self.private = False
+        self._uuid = None
+        self._private = False
         self._binary = False
         self._data = b''
         self._name = ""
@@ -30,10 +120,46 @@ class Object(persistent.Persistent):
             self.data = data
         if name:
             self._name = name
-        self._uuid = None
         self.created_at = datetime.datetime.now(datetime.UTC)
         self.modified_at = datetime.datetime.now(datetime.UTC)
 
+    def __setstate__(self, state):
+        # private used to be a plain attribute
+        if 'private' in state:
+            state['_private'] = state.pop('private')
+        super().__setstate__(state)
+
+    def _db_root(self) -> Optional[PersistentMapping]:
+        """Root of the database this object was loaded from, if any."""
+        if self._p_jar is None:
+            return None
+        return self._p_jar.root()
+
+    def reindex(self, db_root: PersistentMapping = None):
+        """Updates this object's record in root.object_index, and the objects version. Without db_root, uses the
+        database the object was loaded from, if any."""
+        if db_root is None:
+            db_root = self._db_root()
+            if db_root is None:
+                return
+        object_index(db_root).index(self)
+        bump_version(db_root, 'objects')
+
+    def unindex(self, db_root: PersistentMapping):
+        """Drops this object's record from root.object_index and bumps the objects version. Call when deleting it."""
+        object_index(db_root).remove(self.uuid)
+        bump_version(db_root, 'objects')
+
+    @property
+    def private(self) -> bool:
+        return self._private
+
+    @private.setter
+    def private(self, private: bool):
+        if bool(private) != self._private:
+            self._private = bool(private)
+            self.reindex()
+
 
     @property
     def name(self) -> str:
@@ -49,10 +175,16 @@ class Object(persistent.Persistent):
 
     def touch(self):
         self.modified_at = datetime.datetime.now(datetime.UTC)
+        self.reindex()
 
     @property
     def size(self) -> int:
-        return len(self.data)
+        """Size of the data in bytes, known without reading it."""
+        return payload_size(self._data)
+
+    @property
+    def sha256(self) -> bytes:
+        return payload_sha256(self._data)
 
     @property
     def binary(self):
@@ -61,26 +193,64 @@ class Object(persistent.Persistent):
     @property
     def data(self) -> Union[str,bytes]:
         if self.binary:
-            return self._data
+            return self.data_bytes
         else:
-            return self._data.decode()
+            return self.data_bytes.decode()
 
     @data.setter
     def data(self, data: Union[bytes,bytearray,str]):
         if type(data) in (bytes,bytearray):
-            if bytes(data) != self._data:
-                self._data = bytes(data)
+            if not payload_equals(self._data, bytes(data)):
+                self._replace_data(bytes(data))
                 self._binary = True
                 self.touch()
         else:
-            if str(data).encode() != self._data:
-                self._data = str(data).encode()
+            if not payload_equals(self._data, str(data).encode()):
+                self._replace_data(str(data).encode())
                 self._binary = False
                 self.touch()
 
+    def _replace_data(self, data: bytes):
+        db_root = self._db_root()
+        if db_root is not None:
+            release_payload(self._data, db_root)
+        self._data = store_payload(data, db_root)
+
+    def drop_data(self, db_root: PersistentMapping):
+        """Gives back this object's share of its stored data. Call when deleting the object."""
+        release_payload(self._data, db_root)
+        self._data = b''
+
     @property
-    def data_bytes(self):
-        return self._data
+    def data_bytes(self) -> bytes:
+        return payload_bytes(self._data)
+
+    def data_chunks(self, size: int = chunk_size) -> Iterator[bytes]:
+        """The data as bytes, a piece at a time, streamed from disk when it's in a blob."""
+        return payload_chunks(self._data, size)
+
+    def data_range(self, byte_range: Tuple[int, Optional[int]]) -> dict:
+        return payload_range(self._data, byte_range)
+
+    def signatures(self, block_size: Optional[int] = None) -> dict:
+        return delta.signatures(self.data_bytes, block_size=block_size)
+
+    def apply_delta(self, ops: list, block_size: int, base_sha256: bytes, sha256: bytes):
+        """Applies a delta computed against the data hashing to base_sha256. Raises ValueError if the stored data
+        has moved on since, or if the result doesn't hash to sha256, and delta.DeltaError for a malformed delta or
+        one that leaves a text object holding data that isn't UTF-8."""
+        if self.sha256 != base_sha256:
+            raise ValueError("Object data changed since the delta was computed.")
+        new_data = delta.apply_delta(self.data_bytes, ops, block_size)
+        if hashlib.sha256(new_data).digest() != sha256:
+            raise ValueError("Delta result failed its sha256 check.")
+        if self.binary:
+            self.data = new_data
+        else:
+            try:
+                self.data = new_data.decode()
+            except UnicodeDecodeError:
+                raise delta.DeltaError("Delta result is not valid UTF-8 for a text object.")
 
     @property
     def owner(self) -> Optional[UUID]:
@@ -109,13 +279,14 @@ class Object(persistent.Persistent):
                 logging.debug(f"new owner user exists: {user}")
                 conn.root.objects[self.uuid].owner = user.uuid
                 if old_owner_uuid:
-                    if old_owner:
+                    if old_owner and old_owner.user_has_obj(self.uuid):
                         logging.debug(f"The object has an old owner user: {old_owner}")
                         old_owner.remove_obj_uuid(self.uuid)
                 logging.debug(f"adding this object uuid to user objects set ({self.uuid})")
                 logging.debug(f"user {user} objects before: {user.object_uuids}")
                 user.add_obj_uuid(self.uuid)
                 logging.debug(f"user objects now: {user.object_uuids}")
+                conn.root.objects[self.uuid].reindex(conn.root())
             else:
                 raise KeyError(f"User '{un}' not found.")
 
@@ -166,7 +337,9 @@ class Object(persistent.Persistent):
             while self.uuid in conn.root.objects:
                 self._uuid = uuid.uuid4()
             conn.root.objects[self.uuid] = self
+            self._data = keep_payload(self._data, conn.root())
             self.touch()
+            self.reindex(conn.root())
         logging.debug(f"New object assigned uuid {self.uuid}")
         if username:
             logging.debug(f"Attempting to assign new object to user: {username}")
@@ -199,13 +372,21 @@ class Object(persistent.Persistent):
         }
 
     @classmethod
-    def from_dict(cls, obj: dict) -> Self:
+    def from_dict(cls, obj: dict, db_root: PersistentMapping = None) -> Self:
+        """With db_root, obj can name data the server already has by its sha256 instead of carrying it. Raises
+        UnknownPayloadError if it doesn't. Data already stored from a streamed upload (store_streamed_body) is
+        taken as is."""
         o = Object(name=obj['name'])
         if 'uuid_bytes' in obj:
             if obj['uuid_bytes']:
                 o._uuid = UUID(bytes=obj['uuid_bytes'])
         o.private = obj['private']
-        o.data = obj['data']
+        if isinstance(obj.get('data'), StoredData):
+            o._data = obj['data']
+        elif (obj.get('data') is None) and ('sha256' in obj) and (db_root is not None):
+            o._data = payload_for_hash(obj['sha256'], db_root, size=obj.get('size'))
+        else:
+            o.data = obj['data']
         o._binary = obj['binary']
         return o
 
@@ -277,25 +458,28 @@ def parse_display_options(req: Request) -> DisplayOptions:
 
     return DisplayOptions(get_data, limit, sort_by, reverse, search)
 
-def object_display_filter(source: list[Object], opts: DisplayOptions) -> list[dict]:
+def object_sort_key(sort_by: str):
+    if sort_by == "size":
+        return lambda x: (x.size, x.uuid.bytes)
+    elif sort_by == "date":
+        return lambda x: (micros(x.modified_at), x.uuid.bytes)
+    return lambda x: (x.name, x.uuid.bytes)
+
+def object_display_filter(source: Iterable[ObjectMeta], opts: DisplayOptions, db_root: PersistentMapping,
+                          after: Optional[tuple] = None) -> tuple[list[dict], Optional[str]]:
+    """One page of source as object dicts, plus the cursor for the next page. Sorting and filtering use only the
+    metadata records; objects are loaded just for the page, and only when their data was asked for."""
     if opts.search:
-        objs = [x for x in source if str(opts.search) in x.name.lower()]
-    else:
-        objs = deepcopy(source)
-
-    if opts.sort_by == "size":
-        objs.sort(key=lambda x: x.size, reverse=opts.reverse)
-
-    elif opts.sort_by == "date":
-        objs.sort(key=lambda x: x.modified_at, reverse=opts.reverse)
-    else:
-        objs.sort(key=lambda x: x.name, reverse=opts.reverse)
-
-    if opts.limit:
-        if len(objs) >= opts.limit:
-            objs = objs[:opts.limit]
+        source = (x for x in source if str(opts.search) in x.name.lower())
 
-    return [o.to_dict(include_data=opts.get_data) for o in objs]
+    if after is not None:
+        check_key(after, str if opts.sort_by == "name" else int, bytes)
+    key = object_sort_key(opts.sort_by)
+    metas, next_cursor = top_page(source, key, after=after, limit=opts.limit, reverse=opts.reverse, kind="object")
+    if not opts.get_data:
+        return [m.to_dict() for m in metas], next_cursor
+    objs = (Object.get_object_by_uuid(m.uuid, db_root) for m in metas)
+    return [o.to_dict() for o in objs if o is not None], next_cursor
 
 def handle_get_no_path(req: Request, conn: PacketServerConnection, db: ZODB.DB):
     opts = parse_display_options(req)
@@ -308,6 +492,9 @@ def handle_get_no_path(req: Request, conn: PacketServerConnection, db: ZODB.DB):
         if not user:
             send_blank_response(conn, req, status_code=500, payload="Unknown user account problem")
             return
+        if not_modified(req, conn, db.root(), 'objects'):
+            return
+        set_collection_version(response, req, conn, db.root(), 'objects')
         if 'uuid' in req.vars:
             logging.debug(f"uuid req.var: {req.vars['uuid']}")
             uid = req.vars['uuid']
@@ -318,28 +505,53 @@ def handle_get_no_path(req: Request, conn: PacketServerConnection, db: ZODB.DB):
                         if not obj.private:
                             send_blank_response(conn, req, status_code=401)
                             return
-                    if opts.get_data:
+                    try:
+                        byte_range = parse_byte_range(req.vars)
+                    except ValueError as e:
+                        send_blank_response(conn, req, status_code=400, payload=str(e))
+                        return
+                    if 'signatures' in req.vars:
+                        block_size = req.vars['signatures']
+                        if (type(block_size) is not int) or (block_size <= 0):
+                            block_size = None
+                        response.payload = obj.to_dict(include_data=False)
+                        response.payload['signatures'] = obj.signatures(block_size=block_size)
+                        response.status_code = 200
+                    elif byte_range is not None:
+                        try:
+                            ranged = obj.data_range(byte_range)
+                        except IndexError as e:
+                            send_blank_response(conn, req, status_code=416, payload=str(e))
+                            return
+                        response.payload = obj.to_dict(include_data=False)
+                        response.payload.update(ranged)
+                        response.content_type = compression.content_type_for_name(obj.name)
+                        response.status_code = 206
+                    elif opts.get_data and wants_stream(req, obj.size):
+                        # large data goes straight from storage to the connection, never all in memory
+                        response.payload = obj.to_dict(include_data=False)
+                        response.payload['includes_data'] = True
+                        del response.payload['data']
+                        response.status_code = 200
+                        send_stream(conn, response, req, obj.data_chunks(), obj.size, obj.sha256, field='data')
+                        return
+                    elif opts.get_data:
                         response.payload = obj.to_dict()
+                        response.content_type = compression.content_type_for_name(obj.name)
                         response.status_code = 200
                     else:
                         response.payload = obj.to_dict(include_data=False)
                         response.status_code = 200
         else:
-            uuids = user.object_uuids
-            objs = []
-            logging.debug(f"No uuid var, all user object_uuids: {uuids}")
-            for i in uuids:
-                obj = Object.get_object_by_uuid(i, db.root())
-                logging.debug(f"Checking {obj}")
-                if not obj.private:
-                    logging.debug("object not private")
-                    objs.append(obj)
-                else:
-                    logging.debug("object private")
-                    if obj.owner == user.uuid:
-                        logging.debug("user uuid matches object uuid")
-                        objs.append(obj)
-            response.payload = object_display_filter(objs, opts)
+            # a user's objects are the ones they own, so private ones included
+            metas = object_index(db.root()).owned_by(user.uuid)
+            try:
+                response.payload, next_cursor = object_display_filter(metas, opts, db.root(),
+                                                                      after=request_cursor(req, "object"))
+            except ValueError as e:
+                send_blank_response(conn, req, status_code=400, payload=str(e))
+                return
+            set_next_cursor(response, next_cursor)
             logging.debug(f"object payload: {response.payload}")
             response.status_code = 200
 
@@ -354,9 +566,19 @@ def handle_object_get(req: Request, conn: PacketServerConnection, db: ZODB.DB):
 def handle_object_post(req: Request, conn: PacketServerConnection, db: ZODB.DB):
     if type(req.payload) is not dict:
         send_blank_response(conn, req, 400, payload="object payload must be 'dict'")
+        return
 
     try:
-        obj = Object.from_dict(req.payload)
+        with db.transaction() as db_conn:
+            store_streamed_body(req, db_conn.root())
+            obj = Object.from_dict(req.payload, db_root=db_conn.root())
+    except UnknownPayloadError as e:
+        # the client offered a hash we don't have; it should send the data
+        logging.debug(str(e))
+        send_blank_response(conn, req, status_code=412, payload={'missing': [req.payload.get('sha256')]})
+        return
+    except ConflictError:
+        raise
     except:
         logging.debug(f"Error parsing new object:\n{format_exc()}")
         send_blank_response(conn, req, status_code=400)
@@ -386,21 +608,44 @@ def handle_object_update(req: Request, conn: PacketServerConnection, db: ZODB.DB
                 u_obj = UUID(str(uid))
             except ValueError:
                 send_blank_response(conn, req, status_code=400)
+                return
         new_name = req.payload.get("name")
         new_data = req.payload.get("data")
+        new_delta = req.payload.get("delta")
         if new_data:
             if type(new_data) not in (bytes, bytearray, str):
                 send_blank_response(conn, req, status_code=400)
                 return
+        if new_delta is not None:
+            if (type(new_delta) is not list) or (type(req.payload.get('block_size')) is not int) \
+                    or (type(req.payload.get('base_sha256')) is not bytes) \
+                    or (type(req.payload.get('sha256')) is not bytes):
+                send_blank_response(conn, req, status_code=400,
+                                    payload="delta updates need delta, block_size, base_sha256 and sha256")
+                return
+            if req.payload['block_size'] <= 0:
+                send_blank_response(conn, req, status_code=400, payload="block_size must be positive")
+                return
         with db.transaction() as db:
-            obj = Object.get_object_by_uuid(uid, db.root())
+            obj = Object.get_object_by_uuid(u_obj, db.root())
             user = User.get_user_by_username(username, db.root())
-            if user.uuid != obj.owner:
-                send_blank_response(conn, req, status_code=401)
-                return
             if obj is None:
                 send_blank_response(conn, req, status_code=404)
                 return
+            if user.uuid != obj.owner:
+                send_blank_response(conn, req, status_code=401)
+                return
+            if new_delta is not None:
+                try:
+                    obj.apply_delta(new_delta, req.payload['block_size'], req.payload['base_sha256'],
+                                    req.payload['sha256'])
+                except delta.DeltaError as e:
+                    send_blank_response(conn, req, status_code=400, payload=str(e))
+                    return
+                except ValueError as e:
+                    # the client should fetch fresh signatures or fall back to sending the whole object
+                    send_blank_response(conn, req, status_code=409, payload=str(e))
+                    return
             if new_name:
                 obj.name = new_name
             if new_data:
@@ -435,7 +680,11 @@ def handle_object_delete(req: Request, conn: PacketServerConnection, db: ZODB.DB
                 return
             try:
                 user.remove_obj_uuid(u_obj)
+                obj.unindex(db.root())
+                obj.drop_data(db.root())
                 del db.root.objects[u_obj]
+            except ConflictError:
+                raise
             except:
                 send_blank_response(conn, req, status_code=500)
                 logging.error(f"Error handling delete:\n{format_exc()}")
@@ -2,11 +2,13 @@
 import ax25
 from msgpack.exceptions import OutOfData
 from packetserver.common import Message, Request, Response, PacketServerConnection, send_response, send_blank_response
+from packetserver.common.compression import dictionary_versions
 from .bulletin import bulletin_root_handler
 from .users import user_root_handler, user_authorized
 from .objects import object_root_handler
 from .messages import message_root_handler
 from .jobs import job_root_handler
+from .batch import batch_root_handler
 import logging
 from typing import Union
 import ZODB
@@ -38,7 +40,8 @@ def handle_root_get(req: Request, conn: PacketServerConnection,
         'operator': operator,
         'motd': motd,
         'user': user_message,
-        'accepts_jobs': jobs_enabled
+        'accepts_jobs': jobs_enabled,
+        'compression_dictionaries': dictionary_versions()
     }
 
     logging.debug(f"Sending response {response}")
@@ -60,7 +63,8 @@ standard_handlers = {
     "user": user_root_handler,
     "object": object_root_handler,
     "message": message_root_handler,
-    "job": job_root_handler
+    "job": job_root_handler,
+    "batch": batch_root_handler
 }
 
 
@@ -0,0 +1,90 @@
+"""Inverted token indexes for searching message and bulletin text without reading every document."""
+import re
+from typing import Iterable, Optional
+
+import persistent
+from BTrees.OOBTree import OOBTree, OOTreeSet, intersection, union
+from persistent.mapping import PersistentMapping
+
+token_regex = re.compile(r"\w+")
+max_token_length = 40
+
+
+def tokenize(*texts: Optional[str]) -> set[str]:
+    """Lowercased word tokens in texts. Tokens longer than max_token_length are cut to that length."""
+    tokens = set()
+    for text in texts:
+        if not text:
+            continue
+        for token in token_regex.findall(str(text).lower()):
+            tokens.add(token[:max_token_length])
+    return tokens
+
+
+class SearchIndex(persistent.Persistent):
+    """Maps each token to the set of document keys containing it, and each key to its tokens so a document can be
+    re-indexed or removed. Keys can be anything orderable: message UUIDs, bulletin ids."""
+
+    def __init__(self):
+        self.tokens = OOBTree()
+        self.docs = OOBTree()
+
+    def __contains__(self, key) -> bool:
+        return key in self.docs
+
+    def index(self, key, *texts: Optional[str]):
+        new_tokens = tokenize(*texts)
+        old_tokens = set(self.docs.get(key, ()))
+        for token in old_tokens - new_tokens:
+            self._discard(token, key)
+        for token in new_tokens - old_tokens:
+            postings = self.tokens.get(token)
+            if postings is None:
+                postings = OOTreeSet()
+                self.tokens[token] = postings
+            postings.add(key)
+        if new_tokens != old_tokens:
+            self.docs[key] = tuple(sorted(new_tokens))
+
+    def remove(self, key):
+        for token in self.docs.get(key, ()):
+            self._discard(token, key)
+        if key in self.docs:
+            del self.docs[key]
+
+    def _discard(self, token: str, key):
+        postings = self.tokens.get(token)
+        if postings is None:
+            return
+        if key in postings:
+            postings.remove(key)
+        if len(postings) == 0:
+            del self.tokens[token]
+
+    def _matching(self, prefix: str):
+        result = None
+        for postings in self.tokens.values(min=prefix, max=prefix + "\uffff"):
+            result = union(result, postings)
+        return result
+
+    def search(self, query: str, within=None) -> Iterable:
+        """Keys of documents with a token starting with each word of query, in key order. within, a set or BTree
+        of keys, narrows the result. Work is proportional to the postings of the matching tokens."""
+        words = sorted(tokenize(query), key=len, reverse=True)
+        if not words:
+            return []
+        result = within
+        for word in words:
+            matches = self._matching(word)
+            if matches is None:
+                return []
+            result = matches if result is None else intersection(result, matches)
+            if not result:
+                return []
+        return result
+
+
+def get_index(name: str, db_root: PersistentMapping) -> SearchIndex:
+    if name not in db_root:
+        db_root[name] = SearchIndex()
+    return db_root[name]
@@ -9,18 +9,164 @@ import datetime
 from typing import Self,Union,Optional
 from packetserver.common import PacketServerConnection, Request, Response, Message, send_response, send_blank_response
 import ZODB
+from ZODB.POSException import ConflictError
 import logging
 import uuid
 from traceback import format_exc
 from uuid import UUID
 from packetserver.common.util import email_valid
-from BTrees.OOBTree import TreeSet
+from packetserver.server.listing import check_key, page, request_cursor, set_next_cursor
+from packetserver.server.versions import bump_version, not_modified, set_collection_version
+from BTrees.OOBTree import TreeSet, OOTreeSet, OOBTree
+from threading import Lock
+import time
+from itertools import islice
+
+class AuthCache:
+    """Remembers for ttl seconds whether a base callsign may use the server (enabled and not blacklisted), so
+    handlers can check authorization without touching the database. Changes made in this process invalidate
+    entries right away; changes made elsewhere (the HTTP server, say) show up within ttl, or on the callsign's next
+    connection, since the connection bouncer refreshes the entry."""
+
+    def __init__(self, ttl: float = 60):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, callsign: str) -> Optional[bool]:
+        key = callsign.upper().strip()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            return entry[0]
+
+    def set(self, callsign: str, authorized: bool):
+        with self._lock:
+            self._entries[callsign.upper().strip()] = (authorized, time.monotonic() + self.ttl)
+
+    def invalidate(self, callsign: str = None):
+        with self._lock:
+            if callsign is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(callsign.upper().strip(), None)
+
+auth_cache = AuthCache()
+
+def get_blacklist(config: PersistentMapping) -> OOTreeSet:
+    """The blacklist as an OOTreeSet, converting it from the PersistentList older databases kept."""
+    bl = config.get('blacklist')
+    if type(bl) is not OOTreeSet:
+        new_bl = OOTreeSet()
+        if bl is not None:
+            for callsign in bl:
+                new_bl.add(str(callsign).upper().strip())
+        config['blacklist'] = new_bl
+        bl = new_bl
+    return bl
+
+def is_blacklisted(callsign: str, db_root: PersistentMapping) -> bool:
+    if 'blacklist' not in db_root['config']:
+        return False
+    return callsign.upper().strip() in db_root['config']['blacklist']
+
+def blacklist_add(callsign: str, db_root: PersistentMapping):
+    get_blacklist(db_root['config']).add(callsign.upper().strip())
+    auth_cache.invalidate(callsign)
+
+def blacklist_remove(callsign: str, db_root: PersistentMapping):
+    bl = get_blacklist(db_root['config'])
+    if callsign.upper().strip() in bl:
+        bl.remove(callsign.upper().strip())
+    auth_cache.invalidate(callsign)
+
+class LastSeenTracker:
+    """Keeps last-seen times in memory and writes them out together, every flush_interval seconds, to the small
+    user_last_seen OOBTree (username -> datetime), so a connection doesn't rewrite the whole User record. A flush
+    leaves the users version alone: nearly every flush has a new time in it, and bumping on each would make every
+    cached user listing stale within flush_interval. A cached listing shows last-seen times as of its version."""
+
+    def __init__(self, flush_interval: float = 60):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = Lock()
+        self.last_flush = time.monotonic()
+
+    def seen(self, username: str, when: Optional[datetime.datetime] = None):
+        if when is None:
+            when = datetime.datetime.now(datetime.UTC)
+        with self._lock:
+            self._pending[username.upper().strip()] = when
+
+    def get(self, username: str) -> Optional[datetime.datetime]:
+        with self._lock:
+            return self._pending.get(username.upper().strip())
+
+    @property
+    def due(self) -> bool:
+        return (time.monotonic() - self.last_flush) >= self.flush_interval
+
+    def flush(self, db: ZODB.DB) -> int:
+        """Writes pending times in one transaction. Returns how many were written."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self.last_flush = time.monotonic()
+        if not pending:
+            return 0
+        try:
+            with db.transaction() as conn:
+                if 'user_last_seen' not in conn.root():
+                    conn.root.user_last_seen = OOBTree()
+                tree = conn.root.user_last_seen
+                for username, when in pending.items():
+                    old = tree.get(username)
+                    if (old is None) or (old < when):
+                        tree[username] = when
+        except Exception:
+            logging.error(f"Couldn't write last-seen times:\n{format_exc()}")
+            with self._lock:
+                for username, when in pending.items():
+                    self._pending.setdefault(username, when)
+            return 0
+        logging.debug(f"Wrote last-seen times for {len(pending)} users")
+        return len(pending)
+
+last_seen_tracker = LastSeenTracker()
+
+def migrate_users(db_root: PersistentMapping):
+    """Moves users out of the PersistentMapping older databases used, one pickle holding every user, into an
+    OOBTree, and builds the user_uuids index (UUID -> username) alongside it."""
+    users = db_root.get('users')
+    if type(users) is not OOBTree:
+        tree = OOBTree()
+        if users is not None:
+            logging.info(f"Migrating {len(users)} users to an OOBTree")
+            tree.update(users)
+        db_root['users'] = tree
+        if 'user_uuids' in db_root:
+            del db_root['user_uuids']
+    if 'user_uuids' not in db_root:
+        index = OOBTree()
+        for username, user in db_root['users'].items():
+            if user.uuid is not None:
+                index[user.uuid] = username
+        db_root['user_uuids'] = index
+
+def user_uuid_index(db_root: PersistentMapping) -> OOBTree:
+    if ('user_uuids' not in db_root) or (type(db_root.get('users')) is not OOBTree):
+        migrate_users(db_root)
+    return db_root['user_uuids']
 
 class User(persistent.Persistent):
     def __init__(self, username: str, enabled: bool = True, hidden: bool = False, bio: str = "", status: str = "",
                  email: str = None, location: str = "", socials: list[str] = None):
         self._username = username.upper().strip()
-        self.enabled = enabled
+        self._enabled = enabled
         self.hidden = hidden
         self.created_at = datetime.datetime.now(datetime.UTC)
         self.last_seen = self.created_at
@@ -38,14 +184,64 @@ class User(persistent.Persistent):
         self.status = status
         self._objects = TreeSet()
 
+    def __setstate__(self, state):
+        # enabled, hidden and last_seen used to be plain attributes
+        for key in ['enabled', 'hidden', 'last_seen']:
+            if key in state:
+                state['_' + key] = state.pop(key)
+        super().__setstate__(state)
+
+    @property
+    def last_seen(self) -> datetime.datetime:
+        """The newest of: an unflushed time from last_seen_tracker, the user_last_seen tree, the stored value."""
+        pending = last_seen_tracker.get(self.username)
+        if pending is not None:
+            return pending
+        if self._p_jar is not None:
+            tree = self._p_jar.root().get('user_last_seen')
+            if (tree is not None) and (self.username in tree):
+                return max(tree[self.username], self._last_seen)
+        return self._last_seen
+
+    @last_seen.setter
+    def last_seen(self, last_seen: datetime.datetime):
+        self._last_seen = last_seen
+        self._changed()
+
+    def _changed(self):
+        """Records a write to the users collection, once this user is in a database."""
+        if self._p_jar is not None:
+            bump_version(self._p_jar.root(), 'users')
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, enabled: bool):
+        self._enabled = bool(enabled)
+        auth_cache.invalidate(self.username)
+        self._changed()
+
+    @property
+    def hidden(self) -> bool:
+        return self._hidden
+
+    @hidden.setter
+    def hidden(self, hidden: bool):
+        self._hidden = bool(hidden)
+        self._changed()
+
     def write_new(self, db_root: PersistentMapping):
-        all_uuids = [db_root['users'][x].uuid for x in db_root['users']]
+        index = user_uuid_index(db_root)
         self._uuid = uuid.uuid4()
-        while self.uuid in all_uuids:
+        while self.uuid in index:
             self._uuid = uuid.uuid4()
         logging.debug(f"Creating new user account {self.username} - {self.uuid}")
         if self.username not in db_root['users']:
             db_root['users'][self.username] = self
+            index[self.uuid] = self.username
+            bump_version(db_root, 'users')
 
     @property
     def object_uuids(self) -> list[UUID]:
@@ -72,6 +268,7 @@ class User(persistent.Persistent):
             self._location = location[:1000]
         else:
             self._location = location
+        self._changed()
 
     @property
     def email(self) -> str:
@@ -81,6 +278,7 @@ class User(persistent.Persistent):
     def email(self, email: str):
         if email_valid(email.strip().lower()):
             self._email = email.strip().lower()
+            self._changed()
         else:
             raise ValueError(f"Invalid e-mail given: {email}")
 
@@ -94,11 +292,13 @@ class User(persistent.Persistent):
             if len(social) > 300:
                 social = social[:300]
             self._socials.append(social)
+        self._changed()
 
     def add_social(self, social: str):
         if len(social) > 300:
             social = social[:300]
         self._socials.append(social)
+        self._changed()
 
     def remove_social(self, social: str):
         self.socials.remove(social)
@@ -119,42 +319,42 @@ class User(persistent.Persistent):
     @classmethod
     def get_user_by_uuid(cls, user_uuid: Union[UUID, bytes, int, str], db_root: PersistentMapping) -> Self:
         try:
-            if type(uuid) is uuid.UUID:
+            if type(user_uuid) is uuid.UUID:
                 uid = user_uuid
-            elif type(uuid) is bytes:
+            elif type(user_uuid) is bytes:
                 uid = uuid.UUID(bytes=user_uuid)
-            elif type(uuid) is int:
+            elif type(user_uuid) is int:
                 uid = uuid.UUID(int=user_uuid)
             else:
                 uid = uuid.UUID(str(user_uuid))
-            for user in db_root['users']:
-                if uid == db_root['users'][user].uuid:
-                    return db_root['users'][user].uuid
+            username = user_uuid_index(db_root).get(uid)
+            if username is not None:
+                return db_root['users'].get(username)
         except Exception:
             return None
         return None
 
     @classmethod
     def get_all_users(cls, db_root: PersistentMapping, limit: int = None) -> list:
-        all_users = sorted(db_root['users'].values(), key=lambda user: user.username)
+        users = db_root['users']
+        if type(users) is not OOBTree:
+            all_users = sorted(users.values(), key=lambda user: user.username)
+            return all_users[:limit] if limit else all_users
+        # the tree is keyed by username, so its values are already in order
         if not limit:
-            return all_users
-        else:
-            if len(all_users) < limit:
-                return all_users
-            else:
-                return all_users[:limit]
+            return list(users.values())
+        return list(islice(users.values(), limit))
 
     @classmethod
     def is_authorized(cls, username: str, db_root: PersistentMapping) -> bool:
         user = User.get_user_by_username(username, db_root)
         if user:
-            if user.enabled:
+            if user.enabled and not is_blacklisted(username, db_root):
                 return True
         return False
 
     def seen(self):
-        self.last_seen = datetime.datetime.now(datetime.UTC)
+        last_seen_tracker.seen(self.username)
 
     @property
     def username(self) -> str:
@@ -170,6 +370,7 @@ class User(persistent.Persistent):
             self._bio = bio[:4000]
         else:
             self._bio = bio
+        self._changed()
 
     @property
     def status(self) -> str:
@@ -181,6 +382,7 @@ class User(persistent.Persistent):
             self._status = status[:300]
         else:
             self._status = status
+        self._changed()
 
     def to_safe_dict(self) -> dict:
         return {
@@ -200,10 +402,14 @@ class User(persistent.Persistent):
 def user_authorized(conn: PacketServerConnection, db: ZODB.DB) -> bool:
     username = ax25.Address(conn.remote_callsign).call
     logging.debug(f"Running authcheck for user {username}")
-    result = False
+    result = auth_cache.get(username)
+    if result is not None:
+        logging.debug(f"User is authorized (cached)? {result}")
+        return result
     with db.transaction() as db:
         result = User.is_authorized(username, db.root())
         logging.debug(f"User is authorized? {result}")
+    auth_cache.set(username, result)
     return result
 
 def handle_user_get(req: Request, conn: PacketServerConnection, db: ZODB.DB):
@@ -220,6 +426,9 @@ def handle_user_get(req: Request, conn: PacketServerConnection, db: ZODB.DB):
         except ValueError:
             pass
     with db.transaction() as db:
+        if not_modified(req, conn, db.root(), 'users'):
+            return
+        set_collection_version(response, req, conn, db.root(), 'users')
         if len(sp) > 1:
             logging.debug(f"trying to get the username from the path {sp[1].strip().upper()}")
             user = User.get_user_by_username(sp[1].strip().upper(), db.root())
@@ -240,8 +449,21 @@ def handle_user_get(req: Request, conn: PacketServerConnection, db: ZODB.DB):
                     response.status_code = 200
                     response.payload = user.to_safe_dict()
             else:
+                try:
+                    after = request_cursor(req, "user")
+                    if after is not None:
+                        check_key(after, str)
+                except ValueError as e:
+                    send_blank_response(conn, req, 400, payload=str(e))
+                    return
+                # users are keyed by username, so a page starts right at the cursor
+                users = db.root()['users']
+                candidates = users.values() if after is None else users.values(min=after[0], excludemin=True)
+                visible, next_cursor = page((x for x in candidates if not x.hidden), lambda x: (x.username,),
+                                            after=after, limit=limit, kind="user")
                 response.status_code = 200
-                response.payload = [x.to_safe_dict() for x in User.get_all_users(db.root(), limit=limit) if not x.hidden]
+                response.payload = [x.to_safe_dict() for x in visible]
+                set_next_cursor(response, next_cursor)
     send_response(conn, response, req)
 
 def handle_user_update(req: Request, conn: PacketServerConnection, db: ZODB.DB):
@@ -299,6 +521,8 @@ def handle_user_update(req: Request, conn: PacketServerConnection, db: ZODB.DB):
                 user.location = location
             if status is not None:
                 user.status = status
+    except ConflictError:
+        raise
     except:
         logging.error(f"Error while updating user {username}:\n{format_exc()}")
         send_blank_response(conn, req, status_code=500)
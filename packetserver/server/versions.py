@@ -0,0 +1,145 @@
+"""Per-collection version counters, so clients can skip re-downloading data that hasn't changed.
+
+root.versions keeps a counter for each collection (bulletins, users, objects, messages, jobs) that goes up with
+every write to it. GET responses carry the collection's counter in the 'version' var and an etag made from it in
+'etag'. A client sending either back, as 'if_version' or 'if_none_match', gets an empty 304 when the collection
+hasn't changed since, before the handler loads anything. The HTTP API sends the same etags as ETag headers.
+
+Versions are per collection, not per item: any write to a collection changes the etag of every response drawn
+from it, which costs a re-download but never serves stale data. Both the version and the etag are scoped to the
+request they answer, though: a digest of who asked, the path and the request vars goes in each, since what a
+collection returns depends on all three (a mailbox, a user's own objects, a search, the next page). A cache
+holding one response must never get a 304 for a different request to the same collection."""
+import hashlib
+import secrets
+from typing import Optional, Tuple
+
+import ax25
+import persistent
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from persistent.mapping import PersistentMapping
+
+from packetserver.common import Request, Response, PacketServerConnection, send_response
+from packetserver.common.constants import version_var, etag_var, if_version_var, if_none_match_var
+
+collections = ('bulletins', 'users', 'objects', 'messages', 'jobs')
+
+# request vars that don't change what a GET answers with, left out of its scope along with the if_* vars
+unscoped_vars = ('c', 'cd', 'chunked', 'rid')
+
+
+class Versions(persistent.Persistent):
+    """A counter per collection, each a BTrees.Length so concurrent writers bump it without conflicting. tag is
+    random per database, so an etag from a rebuilt database never matches one from before."""
+
+    def __init__(self):
+        self.tag = secrets.token_hex(4)
+        self.counters = OOBTree()
+        for name in collections:
+            self.counters[name] = Length()
+
+    def get(self, name: str) -> int:
+        counter = self.counters.get(name)
+        return 0 if counter is None else counter()
+
+    def bump(self, name: str):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = Length()
+            self.counters[name] = counter
+        counter.change(1)
+
+    def version(self, name: str, scope: Optional[str] = None) -> str:
+        """The collection's counter, joined to scope when given."""
+        if scope:
+            return f"{self.get(name)}.{scope}"
+        return str(self.get(name))
+
+    def etag(self, name: str, scope: Optional[str] = None) -> str:
+        return f'"{name}-{self.tag}-{self.version(name, scope)}"'
+
+
+def versions(db_root: PersistentMapping) -> Versions:
+    if 'versions' not in db_root:
+        db_root['versions'] = Versions()
+    return db_root['versions']
+
+
+def bump_version(db_root: PersistentMapping, name: str):
+    """Records a write to the named collection."""
+    versions(db_root).bump(name)
+
+
+def collection_version(db_root: PersistentMapping, name: str, scope: Optional[str] = None) -> Tuple[str, str]:
+    """The collection's version and etag, both for one request's view of it when scope is given."""
+    v = versions(db_root)
+    return v.version(name, scope), v.etag(name, scope)
+
+
+def request_scope(username: Optional[str], path: str, params: Optional[dict] = None) -> str:
+    """A short digest of what a GET answers for: who asked, the path, and its vars or query parameters, less the
+    if_* ones and those in unscoped_vars."""
+    params = params or {}
+    scoped = sorted((str(k).lower(), repr(v)) for k, v in params.items()
+                    if not str(k).lower().startswith('if_') and str(k).lower() not in unscoped_vars)
+    key = repr(((username or "").upper().strip(), str(path).strip().strip("/").lower(), scoped))
+    return hashlib.blake2b(key.encode(), digest_size=6).hexdigest()
+
+
+def requester(conn: PacketServerConnection) -> str:
+    return ax25.Address(conn.remote_callsign).call.upper().strip()
+
+
+def rf_scope(req: Request, conn: PacketServerConnection) -> str:
+    return request_scope(requester(conn), req.path, req.vars)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match value (one etag, a comma separated list, or *) covers etag. Weak etags compare
+    equal to strong ones, as If-None-Match specifies."""
+    if not if_none_match:
+        return False
+    for candidate in str(if_none_match).split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if (candidate == "*") or (candidate == etag):
+            return True
+    return False
+
+
+def version_current(req: Request, version: str, etag: str) -> bool:
+    """Whether the request's if_none_match or if_version var shows the client already has this version. Both are
+    compared whole, scope included, so a version sent back with a different request never matches."""
+    if etag_matches(req.vars.get(if_none_match_var), etag):
+        return True
+    if_version = req.vars.get(if_version_var)
+    if (if_version is None) or (type(if_version) is bool):
+        return False
+    return str(if_version).strip() == version
+
+
+def set_version(response: Response, version: str, etag: str):
+    response.set_var(version_var, version)
+    response.set_var(etag_var, etag)
+
+
+def not_modified(req: Request, conn: PacketServerConnection, db_root: PersistentMapping, name: str) -> bool:
+    """For GET handlers, before they load anything: if the client already has the current version of the named
+    collection, answers with an empty 304 carrying the version and etag, and returns True."""
+    version, etag = collection_version(db_root, name, rf_scope(req, conn))
+    if not version_current(req, version, etag):
+        return False
+    response = Response.blank()
+    response.status_code = 304
+    set_version(response, version, etag)
+    send_response(conn, response, req)
+    return True
+
+
+def set_collection_version(response: Response, req: Request, conn: PacketServerConnection,
+                           db_root: PersistentMapping, name: str):
+    """Puts the collection's version and etag, scoped to req, on a GET response. Call it after the handler's own
+    writes (marking messages retrieved, say), so the version sent is the one the client will see next time."""
+    set_version(response, *collection_version(db_root, name, rf_scope(req, conn)))
@@ -0,0 +1,118 @@
+"""Shared fixtures: an in-process TestServer on a FileStorage database, and dummy connections to it.
+
+Requests go in through the connection's data_received, exactly as frames off the air would, and responses are read
+back from what the server sent on the connection. The client fixture runs the client library over a loopback to the
+same server connection."""
+import time
+
+import pytest
+from msgpack import Unpacker
+from pe.connect import ConnectionState
+
+from packetserver.client import Client
+from packetserver.common import Message, PacketServerConnection, Request, Response
+from packetserver.common.chunked import ChunkReceiver, is_chunk_frame
+from packetserver.common.testing import DummyPacketServerConnection
+from packetserver.server.testserver import TestServer
+from packetserver.server.users import auth_cache, last_seen_tracker
+
+SERVER_CALLSIGN = "KQ4PEC"
+CLIENT_CALLSIGN = "KQ4PEC-7"
+
+
+@pytest.fixture
+def server(tmp_path):
+    PacketServerConnection.receive_subscribers.clear()
+    PacketServerConnection.connection_subscribers.clear()
+    auth_cache.invalidate()
+    last_seen_tracker.flush_interval = 60
+    ts = TestServer(SERVER_CALLSIGN, data_dir=str(tmp_path / "ps"), zeo=False)
+    ts.start_db()
+    ts.started = True
+    yield ts
+    ts.stop()
+    # Server.__del__ stops it again, by which time the interpreter may be too far gone to close the storage
+    ts.stop = lambda: None
+    PacketServerConnection.receive_subscribers.clear()
+    PacketServerConnection.connection_subscribers.clear()
+
+
+def connect(callsign: str = CLIENT_CALLSIGN) -> DummyPacketServerConnection:
+    conn = DummyPacketServerConnection(callsign, SERVER_CALLSIGN, incoming=True)
+    conn.connected()
+    conn.chunks = ChunkReceiver()
+    return conn
+
+
+@pytest.fixture
+def conn(server):
+    """A connection whose user is already registered with the server."""
+    c = connect()
+    request(c, "user")
+    return c
+
+
+def receive(conn: DummyPacketServerConnection, timeout: float = 10) -> Response:
+    """The next response the server sent on conn, assembling chunked transfers and reading streamed bodies."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            frame = conn.sent_data.unpack()
+        except Exception:
+            time.sleep(0.01)
+            continue
+        if is_chunk_frame(frame):
+            assembler = conn.chunks.accept(frame)
+            if assembler is None:
+                continue
+            msg = Message.from_assembler(assembler)
+            msg.read_body_file()
+            return Response(msg)
+        return Response(Message.partial_unpack(frame))
+    raise TimeoutError("No response from the server.")
+
+
+def request(conn: DummyPacketServerConnection, path: str, method: Request.Method = Request.Method.GET,
+            payload=None, **variables) -> Response:
+    req = Request.blank()
+    req.path = path
+    req.method = method
+    if payload is not None:
+        req.payload = payload
+    for key, value in variables.items():
+        req.set_var(key, value)
+    conn.data_received(0, bytearray(req.pack()))
+    return receive(conn)
+
+
+class LoopbackConnection:
+    """The client's end of a server connection: frames sent here arrive at the server connection, and whatever
+    the server sends there arrives in data."""
+
+    def __init__(self, server_conn: DummyPacketServerConnection):
+        self.remote_callsign = SERVER_CALLSIGN
+        self.state = ConnectionState.CONNECTED
+        self.data = Unpacker()
+        self.frames_sent = 0
+        self.server_conn = server_conn
+        server_conn.send_data = self.feed
+
+    def send_data(self, data):
+        self.frames_sent = self.frames_sent + 1
+        self.server_conn.data_received(0, bytearray(data))
+
+    def feed(self, data):
+        self.data.feed(bytes(data))
+
+
+def loopback_client(server_conn: DummyPacketServerConnection, **kwargs) -> Client:
+    client = Client("localhost", 8000, server_conn.remote_callsign, **kwargs)
+    loopback = LoopbackConnection(server_conn)
+    client.connection_for = lambda callsign: loopback
+    return client
+
+
+@pytest.fixture
+def client(conn):
+    """A chunked client, small chunks, talking to the server over conn."""
+    return loopback_client(conn, chunked=True, chunk_size=4096)
@@ -0,0 +1,62 @@
+from packetserver.common import Request
+from packetserver.server import batch
+
+from conftest import request, SERVER_CALLSIGN
+
+
+def sub(path: str, method: Request.Method = Request.Method.GET, payload=None, **variables) -> Request:
+    req = Request.blank()
+    req.path = path
+    req.method = method
+    if payload is not None:
+        req.payload = payload
+    for key, value in variables.items():
+        req.set_var(key, value)
+    return req
+
+
+def codes(resp) -> list[int]:
+    return [int.from_bytes(r['c']) for r in resp.payload]
+
+
+def test_batch_runs_sub_requests_in_order(conn):
+    resp = request(conn, "batch", Request.Method.POST, [
+        sub("bulletin", Request.Method.POST, {'subject': 'a', 'body': 'b'}).data,
+        sub("bulletin").data,
+        sub("nowhere").data,
+    ])
+    assert resp.status_code == 200
+    assert codes(resp) == [201, 200, 404]
+    assert resp.payload[1]['d'][0]['subject'] == 'a'
+
+
+def test_batch_limits(conn):
+    assert request(conn, "batch", Request.Method.POST, "not a list").status_code == 400
+    too_many = [sub("user").data] * (batch.max_batch_size + 1)
+    assert request(conn, "batch", Request.Method.POST, too_many).status_code == 400
+    assert request(conn, "batch", Request.Method.POST, [sub("batch").data]).status_code == 400
+    assert request(conn, "batch", Request.Method.POST, [sub("user").data, 5]).status_code == 400
+    full = [sub("user").data] * batch.max_batch_size
+    assert codes(request(conn, "batch", Request.Method.POST, full)) == [200] * batch.max_batch_size
+
+
+def test_outer_only_vars_are_dropped_from_sub_requests(conn):
+    resp = request(conn, "batch", Request.Method.POST, [sub("user", rid=5, chunked=10).data], rid=9)
+    assert resp.request_id == 9
+    assert 'rid' not in resp.payload[0].get('v', {})
+
+
+def test_writes_in_a_batch_commit_separately(conn, server):
+    resp = request(conn, "batch", Request.Method.POST, [
+        sub("bulletin", Request.Method.POST, {'subject': 'kept', 'body': 'b'}).data,
+        sub("bulletin", Request.Method.POST, "not a bulletin").data,
+    ])
+    assert codes(resp)[0] == 201
+    assert codes(resp)[1] >= 400
+    assert [b['subject'] for b in request(conn, "bulletin").payload] == ['kept']
+
+
+def test_client_send_batch(client):
+    responses = client.send_batch_callsign([sub("user"), sub("bulletin"), sub("object")], SERVER_CALLSIGN)
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    assert type(responses[0].payload) is list
@@ -0,0 +1,109 @@
+import hashlib
+import os
+
+from packetserver.common import Request
+from packetserver.common.constants import stored_payload_min_size
+from packetserver.runner import RunnerFile
+from packetserver.server.blobs import payload_chunks, payload_store, StoredData
+from packetserver.server.jobs import Job
+from packetserver.server.objects import Object
+
+from conftest import request
+
+
+def big(fill: bytes = b'\x07') -> bytes:
+    return fill * (stored_payload_min_size + 100)
+
+
+def blob_files(server) -> list[str]:
+    found = []
+    for path, dirs, files in os.walk(server.home_dir):
+        found.extend(f for f in files if f.endswith(".blob"))
+    return found
+
+
+def test_large_data_goes_to_a_blob(conn, server):
+    data = big()
+    obj = Object("big.bin", data)
+    assert type(obj._data) is bytes
+    obj_id = obj.write_new(server.db, username="KQ4PEC")
+    with server.db.transaction() as c:
+        stored = c.root.objects[obj_id]._data
+        assert type(stored) is StoredData
+        assert (stored.size, stored.sha256) == (len(data), hashlib.sha256(data).digest())
+        assert stored.read(10, 5) == data[10:15]
+        assert b''.join(c.root.objects[obj_id].data_chunks(1000)) == data
+    assert len(blob_files(server)) == 1
+
+
+def test_small_data_stays_in_the_record(conn, server):
+    obj_id = Object("small.bin", b'tiny').write_new(server.db)
+    with server.db.transaction() as c:
+        assert c.root.objects[obj_id]._data == b'tiny'
+    assert list(payload_chunks(b'')) == []
+
+
+def test_renaming_leaves_the_blob_alone(conn, server):
+    obj_id = Object("big.bin", big()).write_new(server.db)
+    with server.db.transaction() as c:
+        before = c.root.objects[obj_id]._data._p_serial
+    with server.db.transaction() as c:
+        c.root.objects[obj_id].name = "renamed.bin"
+    with server.db.transaction() as c:
+        obj = c.root.objects[obj_id]
+        assert obj.name == "renamed.bin"
+        assert obj._data._p_serial == before
+
+
+def test_streamed_object_fetch(conn, server):
+    data = big(b'\x09')
+    obj_id = Object("big.bin", data).write_new(server.db, username="KQ4PEC")
+    resp = request(conn, "object", uuid=obj_id.bytes, fetch="yes", chunked=4096)
+    assert resp.status_code == 200
+    assert resp.payload['data'] == data
+
+
+def test_payload_store_counts_holders(server):
+    with server.db.transaction() as c:
+        store = payload_store(c.root())
+        first = store.put(big())
+        second = store.put(big())
+        assert first is second
+        assert (len(store), first.refs()) == (1, 2)
+        store.release(first)
+        assert first.sha256 in store
+        store.release(first)
+        assert len(store) == 0
+
+
+def test_one_copy_for_an_object_an_attachment_and_a_job_file(conn, server):
+    data = big(b'\x05')
+    obj_id = Object("shared.bin", data).write_new(server.db, username="KQ4PEC")
+    sent = request(conn, "message", Request.Method.POST,
+                   {'text': "see attached", 'to': ["KQ4PEC"], 'attachments': [{'name': "a.bin", 'data': data}]})
+    assert sent.status_code == 201
+    with server.db.transaction() as c:
+        job = Job(["true"], owner="KQ4PEC", files=[RunnerFile("f.bin", data=data)])
+        job.queue(c.root())
+    with server.db.transaction() as c:
+        store = payload_store(c.root())
+        assert len(store) == 1
+        assert store.get(hashlib.sha256(data).digest()).refs() == 3
+        assert c.root.jobs[job.id].runner_files()[0].data == data
+
+
+def test_deletes_and_replacements_release_payloads(conn, server):
+    data = big(b'\x06')
+    sha256 = hashlib.sha256(data).digest()
+    first = Object("one.bin", data).write_new(server.db, username="KQ4PEC")
+    second = Object("two.bin", data).write_new(server.db, username="KQ4PEC")
+    with server.db.transaction() as c:
+        assert payload_store(c.root()).get(sha256).refs() == 2
+        c.root.objects[first].data = big(b'\x08')
+    with server.db.transaction() as c:
+        assert payload_store(c.root()).get(sha256).refs() == 1
+        assert len(payload_store(c.root())) == 2
+    for obj_id in (first, second):
+        assert request(conn, "object", Request.Method.DELETE, uuid=str(obj_id)).status_code == 200
+    with server.db.transaction() as c:
+        assert len(payload_store(c.root())) == 0
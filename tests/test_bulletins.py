@@ -0,0 +1,77 @@
+import datetime
+
+from persistent.list import PersistentList
+from persistent.mapping import PersistentMapping
+
+from packetserver.common import Request
+from packetserver.server.bulletin import Bulletin
+from packetserver.server.bulletin_store import bulletin_store, BulletinStore, key_before, max_id, query_bulletins
+
+from conftest import connect, request
+
+
+def at(minute: int) -> datetime.datetime:
+    return datetime.datetime(2026, 1, 1, 12, minute, tzinfo=datetime.UTC)
+
+
+def bulletin(bid: int, created: int, updated: int = None) -> Bulletin:
+    bull = Bulletin("KQ4PEC", f"subject {bid}", "body")
+    bull.id = bid
+    bull.created_at = at(created)
+    bull.updated_at = at(created if updated is None else updated)
+    return bull
+
+
+def test_store_orders_by_update_and_creation():
+    store = BulletinStore([bulletin(0, 1, 9), bulletin(1, 2), bulletin(2, 3)])
+    assert [b.id for b in store.newest()] == [0, 2, 1]
+    assert [b.id for b in store.newest("created")] == [2, 1, 0]
+    assert [b.id for b in store.newest(before=store.updated_keys[2])] == [1]
+    store.remove(2)
+    store.remove(7)
+    assert (len(store), 2 in store) == (2, False)
+    assert [b.id for b in store.newest("created")] == [1, 0]
+
+
+def test_edits_move_a_bulletin():
+    store = BulletinStore([bulletin(0, 1), bulletin(1, 2)])
+    first = store.get(0)
+    first.updated_at = at(5)
+    store.touched(first)
+    assert [b.id for b in store.newest()] == [0, 1]
+    assert len(store.updated) == 2
+
+
+def test_key_before():
+    assert key_before((10, 3)) == (10, 2)
+    assert key_before((10, 0)) == (9, max_id)
+
+
+def test_migration_from_a_list():
+    root = PersistentMapping({'bulletins': PersistentList([bulletin(0, 1), bulletin(1, 2)])})
+    store = bulletin_store(root)
+    assert type(store) is BulletinStore
+    assert root['bulletins'] is store
+    assert store.get(1).subject == "subject 1"
+    assert bulletin_store(root) is store
+
+
+def test_query_since_and_order():
+    root = PersistentMapping({'bulletins': BulletinStore([bulletin(n, n) for n in range(5)])})
+    bulls, cursor = query_bulletins(root, order="created", since=at(2))
+    assert ([b.id for b in bulls], cursor) == ([4, 3], None)
+    bulls, cursor = query_bulletins(root, order="created", limit=2)
+    assert [b.id for b in bulls] == [4, 3]
+    assert cursor is not None
+
+
+def test_delete_over_rf(conn, server):
+    bid = request(conn, "bulletin", Request.Method.POST, {'subject': "s", 'body': "b"}).payload['bulletin_id']
+    other = connect("KQ4PED")
+    request(other, "user")
+    assert request(other, "bulletin", Request.Method.DELETE, id=bid).status_code == 401
+    assert request(conn, "bulletin", Request.Method.DELETE, id=bid).status_code == 200
+    assert request(conn, "bulletin", Request.Method.DELETE, id=bid).status_code == 404
+    assert request(conn, "bulletin", id=bid).status_code == 404
+    with server.db.transaction() as c:
+        assert len(bulletin_store(c.root())) == 0
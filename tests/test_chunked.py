@@ -0,0 +1,149 @@
+import hashlib
+import os
+
+import pytest
+from msgpack import unpackb
+
+from packetserver.client import objects, messages
+from packetserver.common import Message, Request
+from packetserver.common.chunked import ChunkError, ChunkReceiver, iter_frames, put_field
+
+from conftest import loopback_client, receive, SERVER_CALLSIGN
+
+
+def assemble(frames, receiver=None):
+    receiver = receiver or ChunkReceiver()
+    result = None
+    for frame in frames:
+        result = receiver.accept(unpackb(frame))
+    return result
+
+
+def test_chunk_round_trip():
+    body = os.urandom(10000)
+    frames = list(iter_frames(1, 0, body, chunk_size=1024))
+    assert len(frames) == 1 + 10
+    assembler = assemble(frames)
+    assert assembler.read_body() == body
+
+
+def test_streamed_iterable_body():
+    body = os.urandom(5000)
+    pieces = [body[i:i + 777] for i in range(0, len(body), 777)]
+    frames = iter_frames(1, 0, iter(pieces), total_size=len(body), sha256=hashlib.sha256(body).digest(),
+                         meta={'p': 'object'}, chunk_size=1000)
+    assembler = assemble(frames)
+    assert assembler.streamed
+    assert assembler.take_body().read() == body
+    with pytest.raises(ValueError):
+        list(iter_frames(1, 0, iter(pieces), chunk_size=1000))
+
+
+def test_out_of_order_chunk_is_refused():
+    frames = list(iter_frames(1, 0, os.urandom(3000), chunk_size=1000))
+    receiver = ChunkReceiver()
+    receiver.accept(unpackb(frames[0]))
+    with pytest.raises(ChunkError):
+        receiver.accept(unpackb(frames[2]))
+    assert receiver.transfers == {}
+
+
+def test_corrupt_chunk_fails_the_hash_check():
+    frames = [unpackb(f) for f in iter_frames(1, 0, os.urandom(2000), chunk_size=1000)]
+    frames[1]['d']['b'] = bytes(1000)
+    receiver = ChunkReceiver()
+    with pytest.raises(ChunkError):
+        for frame in frames:
+            receiver.accept(frame)
+
+
+def test_oversized_transfer_is_refused():
+    frames = iter_frames(1, 0, os.urandom(3000), chunk_size=1000)
+    with pytest.raises(ChunkError):
+        assemble(frames, ChunkReceiver(max_size=2000))
+
+
+def test_put_field_paths():
+    payload = {'text': 'hi', 'attachments': [{'name': 'a'}, {'name': 'b', 'data': None}]}
+    put_field(payload, ['attachments', 1, 'data'], b'xyz')
+    assert payload['attachments'][1]['data'] == b'xyz'
+    put_field(payload, 'text', 'hello')
+    assert payload['text'] == 'hello'
+    with pytest.raises(ValueError):
+        put_field(payload, ['attachments', 5, 'data'], b'')
+
+
+def test_large_response_arrives_chunked(conn):
+    body = os.urandom(20000)
+    req = Request.blank()
+    req.path = "object"
+    req.method = Request.Method.POST
+    req.payload = {'name': 'big.bin', 'data': body, 'binary': True, 'private': True}
+    conn.data_received(0, bytearray(req.pack()))
+    uid = receive(conn).payload
+
+    req = Request.blank()
+    req.path = "object"
+    req.set_var('uuid', bytes.fromhex(uid.replace('-', '')))
+    req.set_var('fetch', True)
+    req.set_var('chunked', 2048)
+    frames = []
+    send_data = conn.send_data
+
+    def count_frames(data):
+        frames.append(data)
+        send_data(data)
+
+    conn.send_data = count_frames
+    conn.data_received(0, bytearray(req.pack()))
+    resp = receive(conn)
+    assert resp.status_code == 200
+    assert resp.payload['data'] == body
+    assert len(frames) > 10
+
+
+def test_server_stores_a_streamed_upload_without_the_body_in_the_payload(conn, server):
+    body = os.urandom(30000)
+    req = Request.blank()
+    req.path = "object"
+    req.method = Request.Method.POST
+    req.payload = {'name': 'streamed.bin', 'data': None, 'binary': True, 'private': True}
+    for frame in req.stream_frames([body], len(body), hashlib.sha256(body).digest(), chunk_size=1024,
+                                   field='data'):
+        conn.data_received(0, bytearray(frame))
+    resp = receive(conn)
+    assert resp.status_code == 201
+    with server.db.transaction() as c:
+        obj = [o for o in c.root.objects.values() if o.name == 'streamed.bin'][0]
+        assert obj.data_bytes == body
+
+
+def test_client_streams_files_and_attachments(client, server, tmp_path):
+    big = tmp_path / "big.bin"
+    big.write_bytes(os.urandom(50000))
+    loopback = client.connection_for(SERVER_CALLSIGN)
+    sent = loopback.frames_sent
+    uid = objects.post_file(client, SERVER_CALLSIGN, str(big))
+    assert loopback.frames_sent - sent > 10
+
+    log = tmp_path / "log.bin"
+    log.write_bytes(os.urandom(40000))
+    messages.send_message(client, SERVER_CALLSIGN, "files", ["KQ4PEC"],
+                          [messages.attachment_from_file(str(log)), messages.MsgAttachment("note.txt", "hello")])
+    received = messages.get_messages(client, SERVER_CALLSIGN)
+    attachments = received[0].attachments
+    assert attachments[0].data == log.read_bytes()
+    assert attachments[1].name == "note.txt"
+    with server.db.transaction() as c:
+        assert c.root.objects[uid].data_bytes == big.read_bytes()
+
+
+def test_non_chunked_client_reads_the_file_into_the_request(conn, server, tmp_path):
+    client = loopback_client(conn, chunked=False)
+    path = tmp_path / "small.bin"
+    path.write_bytes(os.urandom(30000))
+    loopback = client.connection_for(SERVER_CALLSIGN)
+    uid = objects.post_file(client, SERVER_CALLSIGN, str(path))
+    assert loopback.frames_sent <= 2
+    with server.db.transaction() as c:
+        assert c.root.objects[uid].data_bytes == path.read_bytes()
@@ -0,0 +1,49 @@
+import os
+
+import pytest
+from msgpack import packb
+
+from packetserver.common import Message, Request, compression
+
+
+sample = b"The quick brown fox jumps over the lazy dog. " * 40
+
+
+@pytest.mark.parametrize("type_id", [compression.BZIP2, compression.GZIP, compression.DEFLATE, compression.LZMA])
+def test_codec_round_trip(type_id):
+    codec = compression.get_codec(type_id)
+    packed = codec.compress(sample)
+    assert len(packed) < len(sample)
+    assert codec.decompress(packed) == sample
+
+
+def test_compress_smallest_keeps_incompressible_data_as_is():
+    data = os.urandom(2000)
+    assert compression.compress_smallest(data) == (compression.NONE, data)
+
+
+def test_unknown_codec_raises():
+    with pytest.raises(NotImplementedError):
+        compression.get_codec(200)
+    with pytest.raises(ValueError):
+        compression.register_codec(type("Auto", (compression.Codec,), {'type_id': compression.AUTO})())
+
+
+@pytest.mark.parametrize("comp", [Message.CompressionType.NONE, Message.CompressionType.DEFLATE,
+                                  Message.CompressionType.LZMA, Message.CompressionType.AUTO])
+def test_message_pack_round_trip(comp):
+    req = Request.blank()
+    req.path = "message"
+    req.payload = {'text': sample.decode(), 'to': ['KQ4PEC']}
+    req.compression = comp
+    packed = req.pack()
+    msg = Message.unpack(packed)
+    assert msg.data == req.data
+    assert msg.compression is not Message.CompressionType.AUTO
+    if comp is not Message.CompressionType.NONE:
+        assert len(packed) < len(req.data_bytes)
+
+
+def test_auto_is_not_a_wire_value():
+    with pytest.raises(ValueError):
+        Message.unpack(packb({'t': 0, 'c': compression.AUTO, 'd': b''}))
@@ -0,0 +1,57 @@
+import os
+
+from packetserver.common import compression
+from packetserver.common.compression import CompressionPolicy
+
+text = b"CQ CQ de KQ4PEC, net tonight at 8pm on the club repeater. " * 30
+candidates = [compression.DEFLATE, compression.LZMA, compression.BZIP2]
+
+
+def test_high_entropy_frames_skip_compression():
+    policy = CompressionPolicy()
+    data = os.urandom(4096)
+    assert policy.compress(data, candidates, hint="object") == (compression.NONE, data)
+    assert policy.stats("object") == {}
+
+
+def test_incompressible_content_types_skip_compression():
+    policy = CompressionPolicy()
+    assert policy.compress(text, candidates, content_type="image/png") == (compression.NONE, text)
+    assert policy.compress(text, candidates, content_type="image/svg+xml")[0] != compression.NONE
+    assert compression.content_type_for_name("log.txt.gz") == "application/gzip"
+
+
+def test_policy_narrows_to_the_best_codec_then_probes_again():
+    policy = CompressionPolicy(min_samples=2, probe_interval=5)
+    planned = []
+    original_plan = policy.plan
+
+    def plan(c, hint=None):
+        planned.append(original_plan(c, hint))
+        return planned[-1]
+
+    policy.plan = plan
+    for _ in range(5):
+        type_id, output = policy.compress(text, candidates, hint="bulletin")
+        assert compression.decompress(type_id, output) == text
+    assert planned[0] == candidates
+    assert planned[1] == candidates
+    assert len(planned[2]) == 1
+    assert len(planned[3]) == 1
+    assert planned[4] == candidates
+
+
+def test_policy_skips_everything_when_all_codecs_lose():
+    policy = CompressionPolicy(min_samples=1, probe_interval=100)
+    for type_id in candidates:
+        policy.record("tiny", type_id, 20, 40)
+    assert policy.plan(candidates, "tiny") == []
+    assert policy.compress(text, candidates, hint="tiny") == (compression.NONE, text)
+
+
+def test_policy_bounds_the_hints_it_learns():
+    policy = CompressionPolicy(max_hints=2)
+    for hint in ("a", "b", "c"):
+        policy.record(hint, compression.DEFLATE, 100, 50)
+    assert policy.stats("c") == {}
+    assert policy.stats("a")[compression.DEFLATE].samples == 1
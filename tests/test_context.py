@@ -0,0 +1,133 @@
+import time
+
+import pytest
+from persistent.mapping import PersistentMapping
+
+from packetserver.common import Request, send_blank_response
+from packetserver.server import context, users
+from packetserver.server.context import checkpoint, RequestContext
+
+from conftest import request
+
+
+@pytest.fixture
+def counter(server, conn):
+    """A 'count' path whose handler adds one to a counter. Set interfere to make that many of its runs conflict
+    with a write from another connection."""
+    with server.db.transaction() as c:
+        c.root.counter = PersistentMapping({'n': 0})
+    state = {'interfere': 0, 'runs': 0}
+
+    def interfere():
+        with server.db.transaction() as c:
+            c.root.counter['n'] = c.root.counter['n'] + 100
+
+    def handler(req, conn, db):
+        state['runs'] = state['runs'] + 1
+        try:
+            with db.transaction() as storage:
+                storage.root.counter['n'] = storage.root.counter['n'] + 1
+                if req.vars.get('checkpoint'):
+                    checkpoint(db)
+                    storage.root.counter['n'] = storage.root.counter['n'] + 1
+                if state['interfere'] > 0:
+                    state['interfere'] = state['interfere'] - 1
+                    interfere()
+                send_blank_response(conn, req, 201, payload=storage.root.counter['n'])
+        except Exception:
+            if not req.vars.get('swallow'):
+                raise
+            send_blank_response(conn, req, 500)
+
+    server.handlers['count'] = handler
+
+    def value():
+        with server.db.transaction() as c:
+            return c.root.counter['n']
+
+    state['value'] = value
+    return state
+
+
+def no_more_frames(conn):
+    time.sleep(0.2)
+    with pytest.raises(Exception):
+        conn.sent_data.unpack()
+
+
+def test_conflicting_commit_is_retried(conn, counter):
+    counter['interfere'] = 1
+    resp = request(conn, "count", Request.Method.POST)
+    assert (resp.status_code, resp.payload) == (201, '101')
+    assert counter['runs'] == 2
+    assert counter['value']() == 101
+    no_more_frames(conn)
+
+
+def test_repeated_conflicts_answer_409(conn, counter):
+    counter['interfere'] = 100
+    resp = request(conn, "count", Request.Method.POST)
+    assert resp.status_code == 409
+    assert counter['runs'] == context.conflict_retries + 1
+    assert counter['value']() == 100 * counter['runs']
+    no_more_frames(conn)
+
+
+def test_handler_that_committed_early_is_not_rerun(conn, counter):
+    counter['interfere'] = 1
+    resp = request(conn, "count", Request.Method.POST, checkpoint=True)
+    assert resp.status_code == 409
+    assert counter['runs'] == 1
+    assert counter['value']() == 101
+
+
+def test_handler_swallowing_the_conflict_is_still_retried(conn, counter):
+    counter['interfere'] = 1
+    resp = request(conn, "count", Request.Method.POST, swallow=True)
+    assert resp.status_code == 201
+    assert counter['runs'] == 2
+    no_more_frames(conn)
+
+
+def test_real_handler_retries_a_conflicting_user_update(conn, server, monkeypatch):
+    send = users.send_blank_response
+    calls = []
+
+    def interfere_then_send(conn, req, *args, **kwargs):
+        if not calls:
+            calls.append(1)
+            with server.db.transaction() as c:
+                c.root.users['KQ4PEC'].status = 'other'
+        return send(conn, req, *args, **kwargs)
+
+    monkeypatch.setattr(users, 'send_blank_response', interfere_then_send)
+    assert request(conn, "user", Request.Method.UPDATE, {'status': 'mine'}).status_code == 200
+    with server.db.transaction() as c:
+        assert c.root.users['KQ4PEC'].status == 'mine'
+
+
+def test_one_transaction_per_request(conn, server, counter):
+    for _ in range(3):
+        request(conn, "count", Request.Method.POST)
+        request(conn, "user")
+    paths = server.transaction_metrics.snapshot()['paths']
+    assert paths['count']['transactions_per_request'] == 1.0
+    assert paths['user']['transactions_per_request'] == 1.0
+
+
+def test_blocks_share_a_transaction_but_roll_back_alone(server):
+    with server.db.transaction() as c:
+        c.root.counter = PersistentMapping({'n': 0})
+    ctx = RequestContext(server.db)
+    with ctx.transaction() as c:
+        c.root.counter['n'] = 1
+    with pytest.raises(RuntimeError):
+        with ctx.transaction() as c:
+            c.root.counter['n'] = 2
+            raise RuntimeError()
+    with ctx.transaction() as c:
+        assert c.root.counter['n'] == 1
+    ctx.finish()
+    assert (ctx.blocks, ctx.transactions, ctx.connections) == (3, 1, 1)
+    with server.db.transaction() as c:
+        assert c.root.counter['n'] == 1
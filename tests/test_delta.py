@@ -0,0 +1,119 @@
+import hashlib
+import os
+import random
+from uuid import UUID
+
+import pytest
+
+from packetserver.client import objects
+from packetserver.common import Request, delta
+from packetserver.server.objects import Object
+
+from conftest import request, SERVER_CALLSIGN
+
+
+def edited(data: bytes) -> bytes:
+    return data[:1000] + b'inserted' + data[1000:3000] + data[3100:]
+
+
+@pytest.mark.parametrize("block_size", [None, 256, 1000])
+def test_delta_round_trip(block_size):
+    old = os.urandom(8000)
+    new = edited(old)
+    sigs = delta.signatures(old, block_size)
+    ops = delta.compute_delta(sigs, new)
+    assert delta.apply_delta(old, ops, sigs['block_size']) == new
+    assert delta.delta_literal_size(ops) < len(new) // 2
+
+
+def test_delta_of_unrelated_data_is_all_literal():
+    old = os.urandom(3000)
+    new = os.urandom(2000)
+    ops = delta.compute_delta(delta.signatures(old, 256), new)
+    assert ops == [new]
+    assert delta.compute_delta(delta.signatures(b'', 256), new) == [new]
+
+
+def test_rolling_checksum_matches_a_fresh_checksum():
+    data = bytes(random.Random(1).randrange(256) for _ in range(600))
+    rolling = delta.RollingChecksum(data[:100])
+    for i in range(0, 500):
+        rolling.roll(data[i], data[i + 100])
+        assert rolling.digest == delta.weak_checksum(data[i + 1:i + 101])
+
+
+@pytest.mark.parametrize("ops, block_size", [
+    ([[0, 1]], 0),
+    ([[0, 1]], -5),
+    ([[0, 99]], 256),
+    ([['a', 1]], 256),
+    (["text"], 256),
+])
+def test_malformed_deltas_raise_delta_error(ops, block_size):
+    with pytest.raises(delta.DeltaError):
+        delta.apply_delta(os.urandom(1000), ops, block_size)
+
+
+def test_object_apply_delta():
+    old = os.urandom(4000)
+    new = edited(old)
+    obj = Object(name="a.bin", data=old)
+    sigs = delta.signatures(old, 256)
+    ops = delta.compute_delta(sigs, new)
+    with pytest.raises(ValueError):
+        obj.apply_delta(ops, 256, hashlib.sha256(b'other').digest(), hashlib.sha256(new).digest())
+    with pytest.raises(ValueError):
+        obj.apply_delta(ops, 256, obj.sha256, hashlib.sha256(b'wrong').digest())
+    obj.apply_delta(ops, 256, obj.sha256, hashlib.sha256(new).digest())
+    assert obj.data == new
+
+
+def test_text_object_delta_must_leave_utf8():
+    obj = Object(name="t.txt", data="hello world")
+    bad = b'\xff\xfe not text'
+    ops = delta.compute_delta(delta.signatures(obj.data_bytes, 256), bad)
+    with pytest.raises(delta.DeltaError):
+        obj.apply_delta(ops, 256, obj.sha256, hashlib.sha256(bad).digest())
+    assert obj.data == "hello world"
+
+
+def test_delta_update_status_codes(conn):
+    data = os.urandom(5000)
+    uid = UUID(request(conn, "object", Request.Method.POST,
+                       {'name': 'a', 'data': data, 'binary': True, 'private': False}).payload)
+    base = hashlib.sha256(data).digest()
+    new = edited(data)
+    ops = delta.compute_delta(delta.signatures(data, 512), new)
+
+    def update(ops, block_size, sha256=hashlib.sha256(new).digest()):
+        return request(conn, "object", Request.Method.UPDATE,
+                       {'delta': ops, 'block_size': block_size, 'base_sha256': base, 'sha256': sha256},
+                       uuid=uid.bytes).status_code
+
+    assert update(ops, 0) == 400
+    assert update([[0, 999]], 512) == 400
+    assert update(ops, 512, sha256=bytes(32)) == 409
+    assert update(ops, 512) == 200
+    assert update(ops, 512) == 409
+
+
+def test_text_object_delta_to_bad_utf8_is_a_bad_request(conn):
+    uid = UUID(request(conn, "object", Request.Method.POST,
+                       {'name': 't.txt', 'data': 'hello world ' * 100, 'binary': False, 'private': True}).payload)
+    text = ('hello world ' * 100).encode()
+    bad = text[:500] + b'\xff' + text[500:]
+    ops = delta.compute_delta(delta.signatures(text, 256), bad)
+    resp = request(conn, "object", Request.Method.UPDATE,
+                   {'delta': ops, 'block_size': 256, 'base_sha256': hashlib.sha256(text).digest(),
+                    'sha256': hashlib.sha256(bad).digest()}, uuid=uid.bytes)
+    assert resp.status_code == 400
+
+
+def test_sync_object_sends_only_the_changes(client):
+    data = os.urandom(30000)
+    uid = objects.post_object(client, SERVER_CALLSIGN, "sync.bin", data)
+    new = edited(data)
+    sent = objects.sync_object(client, SERVER_CALLSIGN, uid, new)
+    assert 0 < sent < len(new) // 5
+    assert objects.get_object_by_uuid(client, SERVER_CALLSIGN, uid, include_data=True).data == new
+    assert objects.sync_object(client, SERVER_CALLSIGN, uid, new) == 0
@@ -0,0 +1,63 @@
+import os.path
+
+import pytest
+
+from packetserver.common import Message, Request, compression
+from packetserver.common.dictionaries import DICTIONARY_V1, load_corpus
+
+corpus_file = os.path.join(os.path.dirname(__file__), "..", "examples", "misc", "dictionary-corpus-v1.msgpack")
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    return load_corpus(corpus_file)
+
+
+def test_dictionary_v1_is_trained_from_the_checked_in_corpus(corpus):
+    assert compression.train_dictionary(corpus, size=1024) == DICTIONARY_V1
+
+
+def test_dict_round_trip(corpus):
+    codec = compression.get_codec(compression.DICT)
+    for sample in corpus:
+        packed = codec.compress(sample, version=1)
+        assert packed[0] == 1
+        assert codec.decompress(packed) == sample
+
+
+def test_dictionary_beats_plain_deflate(corpus):
+    dict_size = sum(len(compression.compress_one(compression.DICT, s, 1)) for s in corpus)
+    deflate_size = sum(len(compression.compress_one(compression.DEFLATE, s)) for s in corpus)
+    assert dict_size < deflate_size
+
+
+def test_negotiate_dictionary():
+    assert compression.negotiate_dictionary(None) == 1
+    assert compression.negotiate_dictionary([1, 99]) == 1
+    assert compression.negotiate_dictionary([99]) is None
+    assert compression.negotiate_dictionary("junk") is None
+
+
+def test_released_version_cannot_change():
+    compression.register_dictionary(1, DICTIONARY_V1)
+    with pytest.raises(ValueError):
+        compression.register_dictionary(1, b"something else")
+    with pytest.raises(ValueError):
+        compression.register_dictionary(256, b"too new")
+
+
+def test_dict_skipped_for_peer_without_a_dictionary():
+    req = Request.blank()
+    req.path = "user"
+    req.set_var('limit', 10)
+    req.payload = {'bio': 'Operating portable this week.', 'status': 'QRV on 2m'}
+    req.compression = Message.CompressionType.DICT
+    req.peer_dictionaries = [99]
+    msg = Message.unpack(req.pack())
+    assert msg.compression is not Message.CompressionType.DICT
+    assert msg.data == req.data
+
+    req.peer_dictionaries = None
+    msg = Message.unpack(req.pack())
+    assert msg.compression is Message.CompressionType.DICT
+    assert msg.data == req.data
@@ -0,0 +1,75 @@
+import threading
+import time
+
+from packetserver.common import Message, Request, Response
+from packetserver.server.dispatch import Dispatcher
+
+from conftest import connect
+
+
+def numbered(n: int) -> Request:
+    req = Request.blank()
+    req.path = "user"
+    req.set_var('n', n)
+    return req
+
+
+def test_requests_on_one_connection_run_in_order():
+    done = []
+    dispatcher = Dispatcher(lambda req, conn: done.append(req.vars['n']), workers=4)
+    conn = connect()
+    for n in range(50):
+        assert dispatcher.submit(conn, numbered(n))
+    dispatcher.shutdown()
+    assert done == list(range(50))
+
+
+def test_connections_run_in_parallel():
+    release = threading.Event()
+    started = []
+
+    def handle(req, conn):
+        started.append(conn)
+        release.wait(5)
+
+    dispatcher = Dispatcher(handle, workers=2)
+    first, second = connect(), connect("KQ4PED")
+    dispatcher.submit(first, numbered(1))
+    dispatcher.submit(first, numbered(2))
+    dispatcher.submit(second, numbered(1))
+    deadline = time.monotonic() + 5
+    while (len(started) < 2) and (time.monotonic() < deadline):
+        time.sleep(0.01)
+    assert set(started) == {first, second}
+    assert dispatcher.queued(first) == 1
+    release.set()
+    dispatcher.shutdown()
+    assert len(started) == 3
+
+
+def test_full_queue_answers_503():
+    release = threading.Event()
+    dispatcher = Dispatcher(lambda req, conn: release.wait(5), workers=1, max_queued=3)
+    conn = connect()
+    results = [dispatcher.submit(conn, numbered(n)) for n in range(5)]
+    release.set()
+    dispatcher.shutdown()
+    assert results.count(False) >= 1
+    resp = Response(Message.partial_unpack(conn.sent_data.unpack()))
+    assert resp.status_code == 503
+
+
+def test_handler_errors_dont_stop_the_queue():
+    done = []
+
+    def handle(req, conn):
+        if req.vars['n'] == 1:
+            raise RuntimeError("boom")
+        done.append(req.vars['n'])
+
+    dispatcher = Dispatcher(handle, workers=1)
+    conn = connect()
+    for n in range(3):
+        dispatcher.submit(conn, numbered(n))
+    dispatcher.shutdown()
+    assert done == [0, 2]
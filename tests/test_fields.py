@@ -0,0 +1,57 @@
+from packetserver.common import Request
+from packetserver.common.util import compact_rows, expand_rows, project_fields, requested_fields
+
+from conftest import request, SERVER_CALLSIGN
+
+
+def test_requested_fields():
+    assert requested_fields({}) is None
+    assert requested_fields({'fields': "id, subject,,"}) == ["id", "subject"]
+    assert requested_fields({'fields': ["id", " to "]}) == ["id", "to"]
+    assert requested_fields({'fields': " , "}) is None
+
+
+def test_project_fields():
+    assert project_fields({'a': 1, 'b': 2}, ["b", "c"]) == {'b': 2}
+    assert project_fields([{'a': 1, 'b': 2}, "x"], ["a"]) == [{'a': 1}, "x"]
+    assert project_fields("text", ["a"]) == "text"
+
+
+def test_compact_rows_round_trip():
+    rows = [{'a': 1, 'b': 2}, {'b': 3, 'c': 4}]
+    compact = compact_rows(rows)
+    assert compact == {'k': ["a", "b", "c"], 'r': [[1, 2, None], [None, 3, 4]]}
+    assert expand_rows(compact_rows(rows, ["b"])) == [{'b': 2}, {'b': 3}]
+
+
+def test_fields_on_lists_and_single_items(conn):
+    bid = request(conn, "bulletin", Request.Method.POST, {'subject': "s", 'body': "long body"}).payload['bulletin_id']
+    listed = request(conn, "bulletin", fields="id,subject")
+    assert listed.payload == [{'id': bid, 'subject': "s"}]
+    assert request(conn, "bulletin", id=bid, fields=["subject"]).payload == {'subject': "s"}
+    assert set(request(conn, "user", fields="username").payload[0]) == {"username"}
+
+
+def test_compact_listing(conn):
+    for n in range(3):
+        request(conn, "bulletin", Request.Method.POST, {'subject': f"s{n}", 'body': "b"})
+    resp = request(conn, "bulletin", fields="subject", compact="yes")
+    assert resp.vars.get('compact')
+    assert resp.payload == {'k': ["subject"], 'r': [["s2"], ["s1"], ["s0"]]}
+
+
+def test_errors_and_writes_are_not_shaped(conn):
+    resp = request(conn, "bulletin", Request.Method.POST, {'subject': "s", 'body': "b"}, fields="subject",
+                   compact="yes")
+    assert 'bulletin_id' in resp.payload
+    assert request(conn, "bulletin", id=999, fields="subject", compact="yes").vars.get('compact') is None
+
+
+def test_client_expands_compact_rows(client):
+    req = Request.blank()
+    req.path = "user"
+    req.set_var('compact', "yes")
+    resp = client.send_receive_callsign(req, SERVER_CALLSIGN)
+    assert resp.status_code == 200
+    assert 'compact' not in resp.vars
+    assert resp.payload[0]['username'] == "KQ4PEC"
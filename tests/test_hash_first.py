@@ -0,0 +1,93 @@
+import hashlib
+import os
+import uuid
+
+from packetserver.client.messages import MsgAttachment, send_message
+from packetserver.client.objects import post_file, post_object
+from packetserver.common import Request
+from packetserver.common.constants import stored_payload_min_size
+from packetserver.server.blobs import payload_store
+
+from conftest import request, SERVER_CALLSIGN
+
+
+def big() -> bytes:
+    """Random, so compression can't make an upload look smaller than it is."""
+    return os.urandom(stored_payload_min_size + 10)
+
+
+def by_hash(data: bytes, **extra) -> dict:
+    return {'sha256': hashlib.sha256(data).digest(), 'size': len(data), 'binary': True, **extra}
+
+
+def bytes_sent(client) -> list[int]:
+    """A running total of the bytes the client sends to the server."""
+    loopback = client.connection_for(SERVER_CALLSIGN)
+    send = loopback.send_data
+    total = [0]
+
+    def counting(data):
+        total[0] = total[0] + len(data)
+        send(data)
+
+    loopback.send_data = counting
+    return total
+
+
+def test_object_by_hash(conn, server):
+    data = big()
+    offer = by_hash(data, name="copy.bin", private=False)
+    resp = request(conn, "object", Request.Method.POST, offer)
+    assert (resp.status_code, resp.payload) == (412, {'missing': [offer['sha256']]})
+
+    assert request(conn, "object", Request.Method.POST,
+                   {'name': "orig.bin", 'data': data, 'binary': True, 'private': False}).status_code == 201
+    assert request(conn, "object", Request.Method.POST, {**offer, 'size': len(data) + 1}).status_code == 412
+    resp = request(conn, "object", Request.Method.POST, offer)
+    assert resp.status_code == 201
+    with server.db.transaction() as c:
+        assert payload_store(c.root()).get(offer['sha256']).refs() == 2
+        assert c.root.objects[uuid.UUID(resp.payload)].data == data
+
+
+def test_message_names_only_the_missing_attachments(conn, server):
+    known, unknown = big(), big()
+    request(conn, "object", Request.Method.POST, {'name': "k.bin", 'data': known, 'binary': True, 'private': False})
+    attachments = [by_hash(known, name="k.bin"), by_hash(unknown, name="u.bin")]
+    resp = request(conn, "message", Request.Method.POST, {'text': "hi", 'to': ["KQ4PEC"], 'attachments': attachments})
+    assert resp.status_code == 412
+    assert resp.payload['missing'] == [attachments[1]['sha256']]
+
+
+def test_client_skips_data_the_server_has(client):
+    data = big()
+    sent = bytes_sent(client)
+    post_object(client, SERVER_CALLSIGN, "first.bin", data, private=False)
+    first_upload = sent[0]
+    assert first_upload > len(data) // 2
+    second = post_object(client, SERVER_CALLSIGN, "second.bin", data, private=False)
+    assert sent[0] - first_upload < 1000
+    assert second is not None
+
+
+def test_post_file_by_hash(client, tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(os.urandom(stored_payload_min_size * 2))
+    sent = bytes_sent(client)
+    first = post_file(client, SERVER_CALLSIGN, str(path), private=False)
+    first_upload = sent[0]
+    second = post_file(client, SERVER_CALLSIGN, str(path), private=False)
+    assert first != second
+    assert sent[0] - first_upload < 1000
+
+
+def test_send_message_resends_only_what_is_missing(client, server):
+    known, unknown = big(), big()
+    post_object(client, SERVER_CALLSIGN, "k.bin", known, private=False)
+    sent = bytes_sent(client)
+    result = send_message(client, SERVER_CALLSIGN, "files", ["KQ4PEC"],
+                          attachments=[MsgAttachment("k.bin", known), MsgAttachment("u.bin", unknown)])
+    assert len(unknown) < sent[0] < len(known) + len(unknown)
+    with server.db.transaction() as c:
+        body = c.root.message_bodies[uuid.UUID(result['msg_id'])]
+        assert [a.data for a in body.attachments] == [known, unknown]
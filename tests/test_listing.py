@@ -0,0 +1,130 @@
+import datetime
+
+import pytest
+
+from packetserver.common import Request
+from packetserver.common.constants import next_cursor_var
+from packetserver.server.listing import decode_cursor, encode_cursor, micros, page, top_page
+from packetserver.server.messages import open_mailbox
+
+from conftest import connect, request
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor("message", (5, b'\x00' * 16))
+    assert "=" not in cursor
+    assert decode_cursor("message", cursor) == (5, b'\x00' * 16)
+    with pytest.raises(ValueError):
+        decode_cursor("bulletin", cursor)
+    with pytest.raises(ValueError):
+        decode_cursor("message", "!!not a cursor")
+
+
+def test_micros_treats_naive_times_as_utc():
+    aware = datetime.datetime(2026, 1, 1, tzinfo=datetime.UTC)
+    assert micros(aware) == micros(aware.replace(tzinfo=None)) == 1767225600 * 1000000
+
+
+def test_page_resumes_after_the_cursor():
+    items = list(range(10))
+    first, cursor = page(items, lambda i: (i,), limit=4, kind="n")
+    assert first == [0, 1, 2, 3]
+    second, cursor = page(items, lambda i: (i,), after=decode_cursor("n", cursor), limit=4, kind="n")
+    assert second == [4, 5, 6, 7]
+    last, cursor = page(items, lambda i: (i,), after=decode_cursor("n", cursor), limit=4, kind="n")
+    assert (last, cursor) == ([8, 9], None)
+    assert page(items, lambda i: (i,), limit=0) == (items, None)
+    assert page(items[::-1], lambda i: (i,), after=(5,), limit=2, reverse=True, kind="n")[0] == [4, 3]
+
+
+def walk(conn, path: str, **variables) -> list[list]:
+    """Every page of a listing, following next_cursor."""
+    pages = []
+    cursor = None
+    while True:
+        extra = {} if cursor is None else {'cursor': cursor}
+        resp = request(conn, path, **variables, **extra)
+        assert resp.status_code == 200
+        pages.append(resp.payload)
+        cursor = resp.vars.get(next_cursor_var)
+        if cursor is None:
+            return pages
+
+
+def test_paging_bulletins(conn):
+    for n in range(7):
+        request(conn, "bulletin", Request.Method.POST, {'subject': f"b{n}", 'body': "x"})
+    pages = walk(conn, "bulletin", limit=3)
+    assert [[b['subject'] for b in p] for p in pages] == [["b6", "b5", "b4"], ["b3", "b2", "b1"], ["b0"]]
+
+
+def test_paging_messages_both_ways(conn):
+    other = connect("KQ4PED")
+    request(other, "user")
+    for n in range(5):
+        request(other, "message", Request.Method.POST, {'text': f"m{n}", 'to': ["KQ4PEC"]})
+    assert [[m['text'] for m in p] for p in walk(conn, "message", limit=2)] == [["m0", "m1"], ["m2", "m3"], ["m4"]]
+    newest = walk(conn, "message", limit=2, reverse="yes")
+    assert [[m['text'] for m in p] for p in newest] == [["m4", "m3"], ["m2", "m1"], ["m0"]]
+    by_sender = walk(conn, "message", limit=2, sort="from")
+    assert [m['text'] for p in by_sender for m in p] == [f"m{n}" for n in range(5)]
+
+
+def test_paging_users(conn):
+    for call in ("KQ4PED", "KQ4PEE", "KQ4PEF"):
+        request(connect(call), "user")
+    pages = walk(conn, "user", limit=3)
+    assert [[u['username'] for u in p] for p in pages] == [["KQ4PEC", "KQ4PED", "KQ4PEE"], ["KQ4PEF"]]
+
+
+def test_bad_cursors_answer_400(conn):
+    assert request(conn, "bulletin", cursor="garbage").status_code == 400
+    assert request(conn, "bulletin", cursor=encode_cursor("user", ("KQ4PEC",))).status_code == 400
+    assert request(conn, "user", cursor=encode_cursor("user", (1,))).status_code == 400
+    assert request(conn, "message", cursor=encode_cursor("message", ("x",))).status_code == 400
+    assert request(conn, "object", cursor=encode_cursor("message", (1, bytes(16)))).status_code == 400
+
+
+class Row:
+    made = 0
+
+    def __init__(self, n: int):
+        self.n = n
+
+    def to_dict(self) -> dict:
+        Row.made = Row.made + 1
+        return {'n': self.n}
+
+
+def test_top_page_matches_a_full_sort():
+    items = [7, 3, 9, 1, 5, 8, 2]
+    assert top_page(items, lambda i: (i,), limit=3)[0] == [1, 2, 3]
+    assert top_page(items, lambda i: (i,), limit=3, reverse=True)[0] == [9, 8, 7]
+    rest, cursor = top_page(items, lambda i: (i,), after=(3,), limit=3, kind="n")
+    assert rest == [5, 7, 8]
+    assert top_page(items, lambda i: (i,), after=decode_cursor("n", cursor), limit=3) == ([9], None)
+    assert top_page(items, lambda i: (i,)) == (sorted(items), None)
+
+
+def test_top_page_keeps_ties_stable():
+    items = [("b", 1), ("a", 2), ("b", 0), ("a", 1)]
+    assert top_page(items, lambda i: (i[0],), limit=4)[0] == [("a", 2), ("a", 1), ("b", 1), ("b", 0)]
+
+
+def test_top_page_serializes_nothing():
+    Row.made = 0
+    rows, _ = top_page((Row(n) for n in range(1000)), lambda r: (-r.n,), limit=5)
+    assert Row.made == 0
+    assert [r.n for r in rows] == [999, 998, 997, 996, 995]
+
+
+def test_only_returned_messages_are_marked_retrieved(conn, server):
+    other = connect("KQ4PED")
+    request(other, "user")
+    for n in range(5):
+        request(other, "message", Request.Method.POST, {'text': f"m{n}", 'to': ["KQ4PEC"]})
+    request(conn, "message", limit=2, sort="to", reverse="yes")
+    request(conn, "message", limit=1, search="m4")
+    with server.db.transaction() as c:
+        retrieved = sorted(m.text for m in open_mailbox("KQ4PEC", c.root()) if m.retrieved)
+    assert retrieved == ["m3", "m4"]
@@ -0,0 +1,129 @@
+import datetime
+import uuid
+
+from persistent.list import PersistentList
+from persistent.mapping import PersistentMapping
+
+from packetserver.common import Request
+from packetserver.common.constants import stored_payload_min_size
+from packetserver.common.util import to_date_digits
+from packetserver.server.blobs import payload_store
+from packetserver.server.messages import key_before, Mailbox, Message, message_bodies, open_mailbox
+
+from conftest import connect, request
+
+
+def at(minute: int) -> datetime.datetime:
+    return datetime.datetime(2026, 1, 1, 12, minute, tzinfo=datetime.UTC)
+
+
+def message(minute: int, text: str = "hello") -> Message:
+    msg = Message(text, msg_to="KQ4PEC", msg_from="KQ4PED")
+    msg.sent_at = at(minute)
+    return msg
+
+
+def test_mailbox_keeps_time_order():
+    msgs = [message(m) for m in (5, 1, 3)]
+    mb = Mailbox(msgs)
+    assert [m.sent_at for m in mb] == [at(1), at(3), at(5)]
+    assert [m.sent_at for m in mb.newest_first()] == [at(5), at(3), at(1)]
+    assert [m.sent_at for m in mb.since(at(3))] == [at(3), at(5)]
+    assert len(mb) == 3
+    assert mb.get(msgs[1].msg_id) is msgs[1]
+    assert mb.get(uuid.uuid4()) is None
+
+
+def test_mailbox_paging_from_a_key():
+    mb = Mailbox(message(m) for m in range(6))
+    third = mb.key_for(list(mb)[2])
+    assert [m.sent_at for m in mb.oldest_first(after=third)] == [at(m) for m in (3, 4, 5)]
+    assert [m.sent_at for m in mb.newest_first(before=third)] == [at(1), at(0)]
+
+
+def test_key_before():
+    assert key_before((10, (5).to_bytes(16))) == (10, (4).to_bytes(16))
+    assert key_before((10, bytes(16))) == (9, b'\xff' * 16)
+
+
+def test_mailbox_remove_and_reappend():
+    msg = message(1)
+    mb = Mailbox([msg, message(2)])
+    msg.sent_at = at(9)
+    mb.append(msg)
+    assert len(mb) == 2
+    assert list(mb)[-1] is msg
+    mb.remove(msg.msg_id)
+    assert msg.msg_id not in mb
+    assert [m.sent_at for m in mb] == [at(2)]
+
+
+def test_open_mailbox_migrates_a_list():
+    old = [message(2, "second words"), message(1, "first words")]
+    root = PersistentMapping({'messages': PersistentMapping({'KQ4PEC': PersistentList(old)})})
+    mb = open_mailbox("kq4pec", root)
+    assert type(mb) is Mailbox
+    assert root['messages']['KQ4PEC'] is mb
+    assert [m.text for m in mb] == ["first words", "second words"]
+    assert [m.text for m in mb.search("second", root)] == ["second words"]
+    assert open_mailbox("KQ4PEC", root) is mb
+
+
+def test_messages_since_and_by_id(conn, server):
+    other = connect("KQ4PED")
+    request(other, "user")
+    sent = request(other, "message", Request.Method.POST, {'text': "hi there", 'to': ["KQ4PEC"]})
+    assert sent.status_code == 201
+    msg_id = sent.payload['msg_id']
+
+    resp = request(conn, "message", id=msg_id)
+    assert (resp.status_code, resp.payload['text']) == (200, "hi there")
+    assert request(conn, "message", id=str(uuid.uuid4())).status_code == 404
+    assert request(conn, "message", id="bogus").status_code == 400
+
+    past = to_date_digits(datetime.datetime.now(datetime.UTC) - datetime.timedelta(hours=1))
+    future = to_date_digits(datetime.datetime.now(datetime.UTC) + datetime.timedelta(hours=1))
+    assert [m['id'] for m in request(conn, "message", since=past).payload] == [msg_id]
+    assert request(conn, "message", since=future).payload == []
+
+
+def test_broadcast_shares_one_body(conn, server):
+    others = [connect(call) for call in ("KQ4PED", "KQ4PEE")]
+    for other in others:
+        request(other, "user")
+    attachment = {'name': "big.bin", 'data': b'\x01' * stored_payload_min_size}
+    sent = request(conn, "message", Request.Method.POST,
+                   {'text': "to everyone", 'to': ["ALL"], 'attachments': [attachment]})
+    assert sent.status_code == 201
+    msg_id = uuid.UUID(sent.payload['msg_id'])
+    with server.db.transaction() as c:
+        body = message_bodies(c.root())[msg_id]
+        assert body.refs() == 3
+        refs = [open_mailbox(call, c.root()).get(msg_id) for call in ("KQ4PEC", "KQ4PED", "KQ4PEE")]
+        assert all(ref.body is body for ref in refs)
+        assert len(payload_store(c.root())) == 1
+
+    fetched = request(others[0], "message", id=str(msg_id), fetch_attachments="yes")
+    assert fetched.payload['attachments'][0]['data'] == attachment['data']
+    request(others[0], "message")
+    with server.db.transaction() as c:
+        assert open_mailbox("KQ4PED", c.root()).get(msg_id).retrieved
+        assert not open_mailbox("KQ4PEE", c.root()).get(msg_id).retrieved
+
+
+def test_last_delete_drops_the_shared_body(conn, server):
+    other = connect("KQ4PED")
+    request(other, "user")
+    attachment = {'name': "big.bin", 'data': b'\x02' * stored_payload_min_size}
+    sent = request(conn, "message", Request.Method.POST,
+                   {'text': "unusual words", 'to': ["KQ4PED"], 'attachments': [attachment]})
+    msg_id = sent.payload['msg_id']
+    assert request(other, "message", Request.Method.DELETE, id=msg_id).status_code == 200
+    assert request(other, "message", Request.Method.DELETE, id=msg_id).status_code == 404
+    with server.db.transaction() as c:
+        assert message_bodies(c.root())[uuid.UUID(msg_id)].refs() == 1
+    assert request(conn, "message", Request.Method.DELETE, id=msg_id).status_code == 200
+    with server.db.transaction() as c:
+        assert uuid.UUID(msg_id) not in message_bodies(c.root())
+        assert len(payload_store(c.root())) == 0
+    assert request(conn, "message", search="unusual", source="all").payload == []
@@ -0,0 +1,82 @@
+import uuid
+
+from packetserver.common import Request
+from packetserver.server.objects import DisplayOptions, Object, object_display_filter, object_index, ObjectIndex, \
+    ObjectMeta
+
+from conftest import connect, request
+
+
+def post_object(conn, name: str, data: bytes, private: bool = False) -> uuid.UUID:
+    resp = request(conn, "object", Request.Method.POST,
+                   {'name': name, 'data': data, 'binary': True, 'private': private})
+    assert resp.status_code == 201
+    return uuid.UUID(resp.payload)
+
+
+def owner_uuid(server, username: str) -> uuid.UUID:
+    with server.db.transaction() as c:
+        return c.root.users[username].uuid
+
+
+def test_index_follows_writes_and_ownership(conn, server):
+    obj_id = post_object(conn, "first.bin", b'12345')
+    mine = owner_uuid(server, "KQ4PEC")
+    with server.db.transaction() as c:
+        meta = c.root.object_index.owners[mine][obj_id]
+        assert (meta.name, meta.size, meta.binary, meta.private) == ("first.bin", 5, True, False)
+        obj = c.root.objects[obj_id]
+        obj.name = "renamed.bin"
+        obj.private = True
+    with server.db.transaction() as c:
+        meta = c.root.object_index.owners[mine][obj_id]
+        assert (meta.name, meta.private) == ("renamed.bin", True)
+
+    request(connect("KQ4PED"), "user")
+    with server.db.transaction() as c:
+        obj = c.root.objects[obj_id]
+    obj.chown("KQ4PED", server.db)
+    theirs = owner_uuid(server, "KQ4PED")
+    with server.db.transaction() as c:
+        assert mine not in c.root.object_index.owners
+        assert list(c.root.object_index.owned_by(theirs))[0].uuid == obj_id
+
+
+def test_delete_drops_the_index_record(conn, server):
+    obj_id = post_object(conn, "gone.bin", b'x')
+    assert request(conn, "object", Request.Method.DELETE, uuid=str(obj_id)).status_code == 200
+    with server.db.transaction() as c:
+        assert obj_id not in object_index(c.root())
+        assert obj_id not in c.root.objects
+
+
+def test_index_is_built_from_existing_objects(conn, server):
+    obj_id = post_object(conn, "old.bin", b'x')
+    with server.db.transaction() as c:
+        del c.root.object_index
+    with server.db.transaction() as c:
+        index = object_index(c.root())
+        assert type(index) is ObjectIndex
+        assert obj_id in index
+
+
+def test_listing_reads_only_metadata():
+    metas = [ObjectMeta.from_object(Object(name, b'x' * size)) for name, size in (("b", 3), ("a", 9), ("c", 1))]
+    metas = [meta._replace(uuid=uuid.uuid4()) for meta in metas]
+    opts = DisplayOptions(get_data=False, limit=2, sort_by="size", reverse=True, search=None)
+    # no database: listing without data must not load any object
+    rows, cursor = object_display_filter(metas, opts, None)
+    assert [row['name'] for row in rows] == ["a", "b"]
+    assert rows[0]['includes_data'] is False
+    assert cursor is not None
+
+
+def test_listing_over_rf(conn):
+    for name, data in (("b.txt", b'22'), ("a.txt", b'333'), ("c.txt", b'1')):
+        post_object(conn, name, data)
+    by_name = request(conn, "object")
+    assert [o['name'] for o in by_name.payload] == ["a.txt", "b.txt", "c.txt"]
+    assert [o['data'] for o in by_name.payload] == [b'', b'', b'']
+    by_size = request(conn, "object", sort="size", fetch="yes")
+    assert [o['data'] for o in by_size.payload] == [b'1', b'22', b'333']
+    assert [o['name'] for o in request(conn, "object", search="B.").payload] == ["b.txt"]
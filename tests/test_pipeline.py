@@ -0,0 +1,59 @@
+from packetserver.client import Pipeline
+from packetserver.common import Request, Response
+
+from conftest import request, SERVER_CALLSIGN
+
+
+def response_for(rid, status=200):
+    resp = Response.blank()
+    resp.status_code = status
+    if rid is not None:
+        resp.request_id = rid
+    return resp
+
+
+def test_pipeline_matches_responses_by_request_id():
+    pipeline = Pipeline()
+    first, second = pipeline.add(), pipeline.add()
+    pipeline.deliver(response_for(second, 201))
+    pipeline.deliver(response_for(first, 200))
+    assert pipeline.responses[first].status_code == 200
+    assert pipeline.responses[second].status_code == 201
+    assert pipeline.pending == []
+
+
+def test_pipeline_answers_in_order_without_request_ids():
+    pipeline = Pipeline()
+    first, second = pipeline.add(), pipeline.add()
+    pipeline.deliver(response_for(None, 404))
+    assert pipeline.responses[first].status_code == 404
+    assert pipeline.pending == [second]
+    pipeline.forget(first)
+    pipeline.forget(second)
+    assert pipeline.idle
+    pipeline.deliver(response_for(None))
+    assert pipeline.idle
+
+
+def test_server_echoes_request_ids(conn):
+    assert request(conn, "user", rid=77).request_id == 77
+    assert request(conn, "nowhere", rid=78).request_id == 78
+
+
+def test_many_requests_in_flight_on_one_connection(client):
+    reqs = []
+    for subject in ("one", "two", "three"):
+        req = Request.blank()
+        req.path = "bulletin"
+        req.method = Request.Method.POST
+        req.payload = {'subject': subject, 'body': 'b'}
+        reqs.append(req)
+    listing = Request.blank()
+    listing.path = "bulletin"
+    listing.method = Request.Method.GET
+    reqs.append(listing)
+
+    responses = client.send_receive_many_callsign(reqs, SERVER_CALLSIGN)
+    assert [r.status_code for r in responses] == [201, 201, 201, 200]
+    assert [r.request_id for r in responses] == [r.request_id for r in reqs]
+    assert sorted(b['subject'] for b in responses[-1].payload) == ["one", "three", "two"]
@@ -0,0 +1,148 @@
+import datetime
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+import types
+
+import pytest
+
+from packetserver.client import objects
+from packetserver.client.jobs import download_artifact
+from packetserver.common import Request
+from packetserver.common.util import byte_range_payload, parse_byte_range
+from packetserver.runner import RunnerStatus
+from packetserver.server.jobs import Job, migrate_jobs
+
+from conftest import loopback_client, request, SERVER_CALLSIGN
+
+
+def test_parse_byte_range():
+    assert parse_byte_range({}) is None
+    assert parse_byte_range({'range': 'bytes=10-19'}) == (10, 10)
+    assert parse_byte_range({'range': '10-'}) == (10, None)
+    assert parse_byte_range({'range': [5, 7]}) == (5, 7)
+    assert parse_byte_range({'offset': 3}) == (3, None)
+    for bad in ({'range': 'ten'}, {'range': [1]}, {'offset': -1}, {'offset': 0, 'length': -5}):
+        with pytest.raises(ValueError):
+            parse_byte_range(bad)
+
+
+def test_byte_range_payload():
+    data = bytes(range(100))
+    piece = byte_range_payload(data, (90, 50))
+    assert piece['data'] == data[90:]
+    assert piece['total_size'] == 100
+    assert piece['sha256'] == hashlib.sha256(data).digest()
+    with pytest.raises(IndexError):
+        byte_range_payload(data, (100, None))
+    assert byte_range_payload(b'', (0, None))['data'] == b''
+
+
+@pytest.mark.parametrize("size", [500, 60000])
+def test_object_ranges(conn, size):
+    data = os.urandom(size)
+    uid = request(conn, "object", Request.Method.POST,
+                  {'name': 'r.bin', 'data': data, 'binary': True, 'private': True}).payload
+    uid = bytes.fromhex(uid.replace('-', ''))
+
+    resp = request(conn, "object", uuid=uid, offset=100, length=200)
+    assert resp.status_code == 206
+    assert resp.payload['data'] == data[100:300]
+    assert resp.payload['total_size'] == size
+    assert resp.payload['sha256'] == hashlib.sha256(data).digest()
+
+    assert request(conn, "object", uuid=uid, range=f"{size - 10}-").payload['data'] == data[-10:]
+    assert request(conn, "object", uuid=uid, offset=size).status_code == 416
+    assert request(conn, "object", uuid=uid, range="junk").status_code == 400
+
+
+def test_download_object_resumes(client, tmp_path):
+    data = os.urandom(40000)
+    uid = objects.post_object(client, SERVER_CALLSIGN, "resume.bin", data)
+    target = str(tmp_path / "resume.bin")
+    with open(target + ".part", 'wb') as f:
+        f.write(data[:12345])
+    objects.download_object(client, SERVER_CALLSIGN, uid, target, piece_size=8192)
+    with open(target, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(target + ".part")
+    gets = [r for r, _ in client.request_log if r.method is Request.Method.GET]
+    assert gets[0].vars['offset'] == 12345
+
+
+def test_download_object_restarts_a_part_file_for_changed_data(client, tmp_path):
+    data = os.urandom(20000)
+    uid = objects.post_object(client, SERVER_CALLSIGN, "changed.bin", data)
+    target = str(tmp_path / "changed.bin")
+    with open(target + ".part", 'wb') as f:
+        f.write(os.urandom(5000))
+    with open(target + ".part.sha256", 'w') as f:
+        f.write(hashlib.sha256(b'older version').hexdigest())
+    objects.download_object(client, SERVER_CALLSIGN, uid, target, piece_size=8192)
+    with open(target, 'rb') as f:
+        assert f.read() == data
+
+
+def artifact_archive(files: dict) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as t:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            t.addfile(info, io.BytesIO(data))
+    return gzip.compress(buf.getvalue())
+
+
+def test_artifacts_are_indexed_once_and_read_without_writes(conn, server, tmp_path):
+    big = os.urandom(50000)
+    small = b'tiny data' * 10
+    archive = artifact_archive({'big.bin': big, 'small.txt': small})
+    with server.db.transaction() as c:
+        c.root.config['jobs_enabled'] = True
+        job_id = Job(['true'], owner='KQ4PEC').queue(c.root())
+    runner = types.SimpleNamespace(job_id=job_id, is_finished=lambda: True, output=b'', errors=b'', return_code=0,
+                                   _artifact_archive=archive, status=RunnerStatus.SUCCESSFUL)
+    with server.db.transaction() as c:
+        Job.update_job_from_runner(runner, c.root())
+    with server.db.transaction() as c:
+        job = c.root.jobs[job_id]
+        assert job._artifact_archive == b''
+        assert job.num_artifacts == 2
+
+    last = server.db.lastTransaction()
+    resp = request(conn, f"job/{job_id}", artifact='big.bin', offset=49000, length=5000)
+    assert resp.status_code == 206
+    assert resp.payload['data'] == big[49000:]
+    assert request(conn, f"job/{job_id}", artifact=1).payload['data'] == small
+    assert server.db.lastTransaction() == last
+
+    client = loopback_client(conn, chunked=True, chunk_size=4096)
+    target = str(tmp_path / "big.bin")
+    download_artifact(client, SERVER_CALLSIGN, job_id, 'big.bin', target, piece_size=16384)
+    with open(target, 'rb') as f:
+        assert f.read() == big
+
+
+def test_migration_indexes_jobs_stored_with_an_archive(conn, server):
+    small = b'artifact' * 20
+    with server.db.transaction() as c:
+        c.root.config['jobs_enabled'] = True
+        job = Job(['true'], owner='KQ4PEC')
+        job_id = job.queue(c.root())
+        job._artifact_archive = artifact_archive({'out.txt': small})
+        job.finished_at = datetime.datetime.now(datetime.UTC)
+        del c.root()['job_artifacts_indexed']
+
+    last = server.db.lastTransaction()
+    assert request(conn, f"job/{job_id}", artifact='out.txt').payload['data'] == small
+    assert server.db.lastTransaction() == last
+
+    with server.db.transaction() as c:
+        migrate_jobs(c.root())
+    with server.db.transaction() as c:
+        job = c.root.jobs[job_id]
+        assert job._artifact_archive == b''
+        assert [name for name, _, _ in job._artifact_index] == ['out.txt']
+        assert c.root.job_artifacts_indexed
@@ -0,0 +1,64 @@
+from BTrees.OOBTree import OOTreeSet
+
+from packetserver.common import Request
+from packetserver.server.bulletin_store import bulletin_index, get_bulletin
+from packetserver.server.search import max_token_length, SearchIndex, tokenize
+
+from conftest import connect, request
+
+
+def test_tokenize():
+    assert tokenize("Hello, WORLD! hello", None, "") == {"hello", "world"}
+    assert tokenize("x" * 100) == {"x" * max_token_length}
+
+
+def test_search_matches_every_word_by_prefix():
+    index = SearchIndex()
+    index.index(1, "the quick brown fox")
+    index.index(2, "a quick red fox", "KQ4PEC")
+    index.index(3, "slow brown dog")
+    assert list(index.search("quick fox")) == [1, 2]
+    assert list(index.search("bro")) == [1, 3]
+    assert list(index.search("QUICK kq4")) == [2]
+    assert list(index.search("quick cat")) == []
+    assert list(index.search("!!")) == []
+    assert list(index.search("fox", within=OOTreeSet([2, 3]))) == [2]
+
+
+def test_reindex_and_remove():
+    index = SearchIndex()
+    index.index(1, "old words")
+    index.index(1, "new words")
+    assert list(index.search("old")) == []
+    assert list(index.search("new words")) == [1]
+    index.remove(1)
+    assert 1 not in index
+    assert len(index.tokens) == 0
+
+
+def test_message_search(conn):
+    other = connect("KQ4PED")
+    request(other, "user")
+    for text in ("meet at the repeater", "antenna for sale", "repeater is down"):
+        request(other, "message", Request.Method.POST, {'text': text, 'to': ["KQ4PEC"]})
+    resp = request(conn, "message", search="repeater")
+    assert sorted(m['text'] for m in resp.payload) == ["meet at the repeater", "repeater is down"]
+    assert request(conn, "message", search="repeater down").payload[0]['text'] == "repeater is down"
+    assert [m['text'] for m in request(other, "message", search="antenna").payload] == ["antenna for sale"]
+    assert request(conn, "message", search="nothing").payload == []
+
+
+def test_bulletin_search_follows_edits(conn, server):
+    first = request(conn, "bulletin", Request.Method.POST, {'subject': "Net tonight", 'body': "on the repeater"})
+    request(conn, "bulletin", Request.Method.POST, {'subject': "For sale", 'body': "dual band radio"})
+    bid = first.payload['bulletin_id']
+    assert [b['subject'] for b in request(conn, "bulletin", search="repeater").payload] == ["Net tonight"]
+    assert [b['subject'] for b in request(conn, "bulletin", search="kq4pec").payload] == ["For sale",
+                                                                                          "Net tonight"]
+    with server.db.transaction() as c:
+        get_bulletin(bid, c.root()).update_body("on simplex")
+    assert request(conn, "bulletin", search="repeater").payload == []
+    assert len(request(conn, "bulletin", search="simplex").payload) == 1
+    assert request(conn, "bulletin", Request.Method.DELETE, id=bid).status_code == 200
+    with server.db.transaction() as c:
+        assert bid not in bulletin_index(c.root())
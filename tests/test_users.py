@@ -0,0 +1,158 @@
+import datetime
+import uuid
+
+from BTrees.OOBTree import OOBTree
+from persistent.mapping import PersistentMapping
+
+from packetserver.server.users import auth_cache, AuthCache, blacklist_add, blacklist_remove, last_seen_tracker, \
+    LastSeenTracker, migrate_users, User, user_authorized, user_uuid_index
+from packetserver.server.versions import versions
+
+from conftest import connect, request
+
+
+def test_auth_cache_expires():
+    cache = AuthCache(ttl=0)
+    cache.set("kq4pec", True)
+    assert cache.get("KQ4PEC") is None
+    cache = AuthCache(ttl=60)
+    cache.set("kq4pec", False)
+    assert cache.get("KQ4PEC") is False
+    cache.invalidate("KQ4PEC")
+    assert cache.get("KQ4PEC") is None
+
+
+def test_cached_authorization_skips_the_database(conn):
+    class NoDatabase:
+        def transaction(self):
+            raise AssertionError("authorization should have come from the cache")
+
+    auth_cache.set("KQ4PEC", True)
+    assert user_authorized(conn, NoDatabase())
+
+
+def test_disabling_a_user_takes_effect_at_once(conn, server):
+    assert request(conn, "bulletin").status_code == 200
+    with server.db.transaction() as c:
+        c.root.users['KQ4PEC'].enabled = False
+    assert request(conn, "bulletin").status_code == 401
+    with server.db.transaction() as c:
+        c.root.users['KQ4PEC'].enabled = True
+    assert request(conn, "bulletin").status_code == 200
+
+
+def test_blacklisting_takes_effect_at_once(conn, server):
+    assert request(conn, "bulletin").status_code == 200
+    with server.db.transaction() as c:
+        blacklist_add("KQ4PEC", c.root())
+    assert request(conn, "bulletin").status_code == 401
+    with server.db.transaction() as c:
+        blacklist_remove("KQ4PEC", c.root())
+    assert request(conn, "bulletin").status_code == 200
+
+
+def test_migrate_users_from_a_mapping():
+    root = PersistentMapping({'users': PersistentMapping()})
+    uuids = {}
+    for name in ("KQ4PED", "KQ4PEC"):
+        user = User(name)
+        user._uuid = uuids[name] = uuid.uuid4()
+        root['users'][name] = user
+    root['user_uuids'] = OOBTree({uuid.uuid4(): "STALE"})
+    migrate_users(root)
+    assert type(root['users']) is OOBTree
+    assert list(root['users'].keys()) == ["KQ4PEC", "KQ4PED"]
+    assert dict(root['user_uuids']) == {uid: name for name, uid in uuids.items()}
+    migrate_users(root)
+    assert dict(root['user_uuids']) == {uid: name for name, uid in uuids.items()}
+
+
+def test_server_start_migrates_users(server):
+    with server.db.transaction() as c:
+        assert type(c.root.users) is OOBTree
+        system = c.root.users['SYSTEM']
+        assert c.root.user_uuids[system.uuid] == 'SYSTEM'
+
+
+def test_get_user_by_uuid(conn, server):
+    with server.db.transaction() as c:
+        user = User.get_user_by_username("kq4pec", c.root())
+        for form in (user.uuid, user.uuid.bytes, user.uuid.int, str(user.uuid)):
+            assert User.get_user_by_uuid(form, c.root()).username == "KQ4PEC"
+        assert User.get_user_by_uuid(uuid.uuid4(), c.root()) is None
+        assert User.get_user_by_uuid("not a uuid", c.root()) is None
+
+
+def test_write_new_keeps_uuids_unique(monkeypatch):
+    root = PersistentMapping({'users': OOBTree()})
+    User("KQ4PEC").write_new(root)
+    taken = root['users']["KQ4PEC"].uuid
+    fresh = uuid.uuid4()
+    picks = iter([taken, taken, fresh])
+    monkeypatch.setattr(uuid, 'uuid4', lambda: next(picks))
+    User("KQ4PED").write_new(root)
+    assert root['users']["KQ4PED"].uuid == fresh
+    assert dict(user_uuid_index(root)) == {taken: "KQ4PEC", fresh: "KQ4PED"}
+
+
+def test_write_new_keeps_an_existing_user():
+    root = PersistentMapping({'users': OOBTree()})
+    User("KQ4PEC", bio="first").write_new(root)
+    User("KQ4PEC", bio="second").write_new(root)
+    assert root['users']["KQ4PEC"].bio == "first"
+    assert len(user_uuid_index(root)) == 1
+
+
+def at(minute: int) -> datetime.datetime:
+    return datetime.datetime(2026, 1, 1, 12, minute, tzinfo=datetime.UTC)
+
+
+def test_last_seen_updates_coalesce(server):
+    tracker = LastSeenTracker(flush_interval=0)
+    for minute in range(5):
+        tracker.seen("kq4pec ", at(minute))
+    tracker.seen("KQ4PED", at(1))
+    assert tracker.get("KQ4PEC") == at(4)
+    assert tracker.due
+    assert tracker.flush(server.db) == 2
+    assert tracker.get("KQ4PEC") is None
+    assert tracker.flush(server.db) == 0
+    with server.db.transaction() as c:
+        assert dict(c.root.user_last_seen) == {"KQ4PEC": at(4), "KQ4PED": at(1)}
+
+
+def test_flush_never_moves_last_seen_back(server):
+    tracker = LastSeenTracker()
+    tracker.seen("KQ4PEC", at(5))
+    tracker.flush(server.db)
+    tracker.seen("KQ4PEC", at(2))
+    tracker.flush(server.db)
+    with server.db.transaction() as c:
+        assert c.root.user_last_seen["KQ4PEC"] == at(5)
+
+
+def test_failed_flush_keeps_pending_times():
+    class BrokenDatabase:
+        def transaction(self):
+            raise RuntimeError("storage is down")
+
+    tracker = LastSeenTracker()
+    tracker.seen("KQ4PEC", at(3))
+    assert tracker.flush(BrokenDatabase()) == 0
+    assert tracker.get("KQ4PEC") == at(3)
+
+
+def test_connecting_doesnt_rewrite_the_user(conn, server):
+    last_seen_tracker.flush(server.db)
+    assert last_seen_tracker.get("KQ4PEC") is None
+    with server.db.transaction() as c:
+        before = c.root.users['KQ4PEC']._p_serial
+        users_version = versions(c.root()).get('users')
+    connect("KQ4PEC")
+    assert last_seen_tracker.get("KQ4PEC") is not None
+    last_seen_tracker.flush(server.db)
+    with server.db.transaction() as c:
+        user = c.root.users['KQ4PEC']
+        assert user._p_serial == before
+        assert versions(c.root()).get('users') == users_version
+        assert user.last_seen == c.root.user_last_seen['KQ4PEC']
@@ -0,0 +1,77 @@
+from persistent.mapping import PersistentMapping
+from starlette.requests import Request as HttpRequest
+
+from packetserver.common import Request
+from packetserver.common.constants import etag_var, version_var
+from packetserver.http import conditional
+from packetserver.server.objects import Object
+from packetserver.server.versions import bump_version, etag_matches, request_scope, versions
+
+from conftest import connect, request
+
+
+def test_etag_matches():
+    etag = '"bulletins-ab12-3.f00"'
+    assert etag_matches(etag, etag)
+    assert etag_matches(f'"other", W/{etag}', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches(None, etag)
+    assert not etag_matches('"bulletins-ab12-4.f00"', etag)
+
+
+def test_scope_covers_who_what_and_how():
+    base = request_scope("KQ4PEC", "bulletin", {'limit': 5})
+    assert request_scope("kq4pec ", "/bulletin/", {'limit': 5, 'rid': 9, 'if_version': "1", 'chunked': 4096}) == base
+    assert request_scope("KQ4PED", "bulletin", {'limit': 5}) != base
+    assert request_scope("KQ4PEC", "user", {'limit': 5}) != base
+    assert request_scope("KQ4PEC", "bulletin", {'limit': 6}) != base
+
+
+def test_unchanged_collection_answers_304(conn):
+    first = request(conn, "bulletin", limit=5)
+    etag, version = first.vars[etag_var], first.vars[version_var]
+    again = request(conn, "bulletin", limit=5, if_none_match=etag, rid=4)
+    assert (again.status_code, again.payload) == (304, "")
+    assert again.vars[etag_var] == etag
+    assert request(conn, "bulletin", limit=5, if_version=version).status_code == 304
+    assert request(conn, "bulletin", limit=6, if_none_match=etag).status_code == 200
+    request(conn, "bulletin", Request.Method.POST, {'subject': "s", 'body': "b"})
+    changed = request(conn, "bulletin", limit=5, if_none_match=etag)
+    assert changed.status_code == 200
+    assert changed.vars[etag_var] != etag
+
+
+def test_an_etag_doesnt_carry_over_to_another_user(conn):
+    mine = request(conn, "object")
+    other = connect("KQ4PED")
+    request(other, "user")
+    assert request(other, "object", if_none_match=mine.vars[etag_var]).status_code == 200
+    assert request(conn, "object", if_none_match=mine.vars[etag_var]).status_code == 304
+
+
+def test_object_delete_bumps_once(conn, server):
+    obj_id = Object("x.bin", b'x').write_new(server.db, username="KQ4PEC")
+    with server.db.transaction() as c:
+        before = versions(c.root()).get('objects')
+    assert request(conn, "object", Request.Method.DELETE, uuid=str(obj_id)).status_code == 200
+    with server.db.transaction() as c:
+        assert versions(c.root()).get('objects') == before + 1
+
+
+def http_request(path: str, query: str = "", if_none_match: str = None) -> HttpRequest:
+    headers = [] if if_none_match is None else [(b"if-none-match", if_none_match.encode())]
+    return HttpRequest({'type': "http", 'method': "GET", 'path': path, 'query_string': query.encode(),
+                        'headers': headers})
+
+
+def test_http_conditional():
+    root = PersistentMapping()
+    etag = conditional.etag_headers(http_request("/api/v1/bulletins"), root, 'bulletins')["ETag"]
+    answer = conditional.not_modified(http_request("/api/v1/bulletins", if_none_match=etag), root, 'bulletins')
+    assert answer.status_code == 304
+    assert answer.headers["etag"] == etag
+    assert conditional.not_modified(http_request("/api/v1/bulletins", "limit=2", etag), root, 'bulletins') is None
+    assert conditional.not_modified(http_request("/api/v1/bulletins", if_none_match=etag), root, 'bulletins',
+                                    username="KQ4PEC") is None
+    bump_version(root, 'bulletins')
+    assert conditional.not_modified(http_request("/api/v1/bulletins", if_none_match=etag), root, 'bulletins') is None